@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import os, sys, re, json, time, gzip, shutil, socket, random, hashlib, tarfile, platform, argparse, threading
+import multiprocessing, resource
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit
+    from urllib import unquote
+    from Queue import Empty
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, unquote
+    from queue import Empty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vagranttools import download, upload
+from vagranttools.download import RateLimit, default_connections
+from vagranttools.boxhash import hash_file
+
+#-------------------------------------------------------------------------------
+#-- Benchmarks of the download and upload paths
+#
+# Synthetic boxes are generated once in the work folder and reused by later
+# runs. Every run of an operation happens in its own process, so its peak RSS
+# and the bytes it writes are measured alone, while the boxes are served from
+# a threaded HTTP server in this process that can add latency, cap the
+# bandwidth and ignore Range requests.
+
+operations = ['get_box', 'sha1_file', 'decompress_box', 'upload']
+box_kinds = ['sparse', 'dense']
+default_sizes = "1M,64M,1G"
+default_workdir = os.path.join(os.path.expanduser("~"), ".vagrant-tools", "bench")
+block_size = 1024 * 1024
+# Sparse images have one block of data every sparse_stride blocks
+sparse_stride = 16
+seed = 2015
+
+#-------------------------------------------------------------------------------
+
+def parse_size(value):
+    # "64M", "1G" or "20G" as bytes
+
+    match = re.match(r'^(\d+)([KMG]?)B?$', value.strip().upper())
+    if match is None:
+        raise ValueError("Invalid size: %s" % value)
+
+    return int(match.group(1)) * 1024 ** ' KMG'.index(match.group(2) or ' ')
+
+def format_size(size):
+
+    for unit in ['G', 'M', 'K']:
+        if size >= 1024 ** ' KMG'.index(unit) and size % 1024 ** ' KMG'.index(unit) == 0:
+            return "%d%s" % (size // 1024 ** ' KMG'.index(unit), unit)
+
+    return str(size)
+
+def image_blocks(size, kind):
+    # Blocks of a disk image of (size) bytes, the same for every run. Dense
+    # images are random data, sparse ones are mostly zeros like a freshly
+    # installed disk.
+
+    generator = random.Random(seed)
+    pattern = bytearray(generator.getrandbits(8) for i in range(block_size))
+    pattern = bytes(pattern + pattern)
+    zeros = b'\0' * block_size
+
+    for index in range((size + block_size - 1) // block_size):
+        count = min(block_size, size - index * block_size)
+        if kind == 'sparse' and index % sparse_stride != 0:
+            yield zeros[:count]
+        else:
+            # Rotated so no two blocks are the same
+            offset = generator.randrange(block_size)
+            yield pattern[offset:offset + count]
+
+
+class HashingWriter(object):
+    # File-like wrapper around (output) hashing what is written
+
+    def __init__(self, output):
+        self.output = output
+        self.digest = hashlib.sha1()
+
+    def write(self, buffer):
+        self.output.write(buffer)
+        self.digest.update(buffer)
+
+    def flush(self):
+        self.output.flush()
+
+
+def write_member(output, name, size, blocks):
+    # Writes a tar member of (size) bytes made of (blocks), returns the size
+    # of the member in the archive
+
+    member = tarfile.TarInfo(name)
+    member.size = size
+    member.mode = 0o644
+    member.mtime = 0
+    output.write(member.tobuf(tarfile.GNU_FORMAT))
+    for block in blocks:
+        output.write(block)
+    output.write(b'\0' * (-size % tarfile.BLOCKSIZE))
+
+    return tarfile.BLOCKSIZE + size + (-size % tarfile.BLOCKSIZE)
+
+def generate_box(workdir, size, kind, compress=False):
+    # Writes a box with a disk image of (size) bytes into (workdir) unless it
+    # was generated before, and returns its description. The tar is written
+    # directly so even 20G boxes are generated in one streamed pass.
+
+    name = "bench-%s-%s%s.box" % (format_size(size), kind, "-gz" if compress else "")
+    path = os.path.join(workdir, "boxes", name)
+    if os.path.isfile(path) and os.path.isfile(path + '.sha1'):
+        with open(path + '.sha1') as checksum_file:
+            return {'name': name, 'path': path, 'kind': kind, 'image_size': size,
+                    'size': os.path.getsize(path), 'sha1': checksum_file.read().strip()}
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    print("Generating %s..." % name)
+    with open(path + '.tmp', 'wb') as box_file:
+        writer = HashingWriter(box_file)
+        output = gzip.GzipFile(fileobj=writer, mode='wb', compresslevel=1, mtime=0) if compress else writer
+
+        metadata = json.dumps({"provider": "virtualbox"}).encode('utf-8')
+        ovf = b'<?xml version="1.0"?>\n<Envelope/>\n'
+        written = write_member(output, "metadata.json", len(metadata), [metadata]) + \
+                  write_member(output, "box.ovf", len(ovf), [ovf]) + \
+                  write_member(output, "disk.vmdk", size, image_blocks(size, kind))
+        # End of archive marker, padded to a whole record
+        end = 2 * tarfile.BLOCKSIZE
+        output.write(b'\0' * (end + (-(written + end) % tarfile.RECORDSIZE)))
+        if compress:
+            output.close()
+
+    with open(path + '.sha1', 'w') as checksum_file:
+        checksum_file.write(writer.digest.hexdigest())
+    os.rename(path + '.tmp', path)
+
+    return generate_box(workdir, size, kind, compress)
+
+#-------------------------------------------------------------------------------
+#-- HTTP server the boxes are downloaded from
+
+class BoxHandler(BaseHTTPRequestHandler):
+    # Serves the files of server.root, honouring Range requests unless
+    # server.ranges is off. Every request waits server.latency seconds and
+    # all connections share the server.bandwidth RateLimit.
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+
+        name = os.path.basename(unquote(urlsplit(self.path).path))
+        path = os.path.join(self.server.root, name)
+        if not name or not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        size = os.path.getsize(path)
+        etag = '"%x-%x"' % (size, int(os.path.getmtime(path)))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        match = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if self.server.ranges and match is not None:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            if start > end:
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+        with open(path, 'rb') as box_file:
+            box_file.seek(start)
+            remaining = end - start + 1
+            try:
+                while remaining > 0:
+                    buffer = box_file.read(min(block_size, remaining))
+                    if not buffer:
+                        break
+                    if self.server.bandwidth is not None:
+                        self.server.bandwidth.consume(len(buffer))
+                    self.wfile.write(buffer)
+                    remaining = remaining - len(buffer)
+            except socket.error:
+                # Clients close ranged probes early
+                pass
+
+
+class BoxServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_server(root, latency=0, bandwidth=None, ranges=True):
+    # Serves (root) on a free port of localhost and returns its base URL
+
+    server = BoxServer(('127.0.0.1', 0), BoxHandler)
+    server.root = root
+    server.latency = latency
+    server.bandwidth = RateLimit(bandwidth) if bandwidth else None
+    server.ranges = ranges
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return "http://127.0.0.1:%d" % server.server_address[1]
+
+#-------------------------------------------------------------------------------
+#-- Operations, run in a child process
+
+def disk_bytes(path):
+    # Bytes allocated on disk under (path), holes not included
+
+    if os.path.isfile(path):
+        return os.stat(path).st_blocks * 512
+
+    total = 0
+    for folder, folders, files in os.walk(path):
+        for name in files:
+            total = total + os.lstat(os.path.join(folder, name)).st_blocks * 512
+
+    return total
+
+def io_written():
+    # Bytes this process caused to be written to storage (Linux only)
+
+    try:
+        with open('/proc/self/io') as io_file:
+            for line in io_file:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+
+    return None
+
+def run_operation(operation, box, scratch, settings):
+    # Runs (operation) on (box) writing into (scratch). Returns the bytes it
+    # processed and the path its output was written to.
+
+    if operation == 'get_box':
+        fullpath = download.get_box(settings['url'] + "/" + box['name'], scratch, 'sha1', box['sha1'],
+                                    settings['connections'])
+        return box['size'], fullpath
+
+    if operation == 'sha1_file':
+        hash_file(box['path'], ('sha1',), use_cache=False)
+        return box['size'], scratch
+
+    if operation == 'decompress_box':
+        stats = download.decompress_box(box['path'], scratch)
+        return stats['size'], scratch
+
+    if operation == 'upload':
+        target = {'file': box['path'], 'company': 'bench', 'name': os.path.splitext(box['name'])[0],
+                  'server': settings['server'], 'remotepath': settings['remotepath'] or scratch,
+                  'checksum': None}
+        with upload.sftp_session(target['server']) as sftp:
+            upload.sftp_put_box(sftp, target, upload.box_path(target))
+        if target['server'] == upload.local_server:
+            return box['size'], upload.remote_directory(target)
+        return box['size'], None
+
+    raise ValueError("Unknown operation: %s" % operation)
+
+def measure(operation, box, scratch, settings, results):
+    # Body of the child process, puts the measurements in (results)
+
+    download.verbose = False
+    upload.verbose = False
+
+    written = io_written()
+    start = time.time()
+    try:
+        count, output = run_operation(operation, box, scratch, settings)
+    except Exception as e:
+        results.put({'error': "%s: %s" % (e.__class__.__name__, str(e).replace("\n", " "))})
+        return
+    seconds = time.time() - start
+
+    if written is not None:
+        written = io_written() - written
+
+    results.put({'seconds': round(seconds, 6), 'bytes': count,
+                 'mb_per_s': round(count / max(seconds, 0.000001) / 1024 / 1024, 3),
+                 # Kilobytes on Linux
+                 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 'disk_bytes': disk_bytes(output) if output is not None and os.path.exists(output) else None,
+                 'io_write_bytes': written})
+
+def run_case(operation, box, settings):
+    # One run of (operation) in its own process and scratch folder
+
+    scratch = os.path.join(settings['workdir'], "scratch")
+    if os.path.isdir(scratch):
+        shutil.rmtree(scratch)
+    os.makedirs(scratch)
+
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(operation, box, scratch, settings, results))
+    process.start()
+    try:
+        while True:
+            try:
+                result = results.get(timeout=1)
+                break
+            except Empty:
+                if not process.is_alive():
+                    # Killed, i.e by the OOM killer
+                    result = {'error': "process exited with status %s" % process.exitcode}
+                    break
+    finally:
+        process.join()
+        shutil.rmtree(scratch)
+
+    return result
+
+#-------------------------------------------------------------------------------
+
+def median(values):
+
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def summarize(operation, box, runs):
+
+    summary = {'operation': operation, 'box': box['name'], 'kind': box['kind'],
+               'image_size': box['image_size'], 'box_size': box['size'], 'runs': runs}
+
+    passed = [run for run in runs if 'error' not in run]
+    if passed:
+        summary['seconds'] = median([run['seconds'] for run in passed])
+        summary['mb_per_s'] = median([run['mb_per_s'] for run in passed])
+        summary['peak_rss_kb'] = max(run['peak_rss_kb'] for run in passed)
+        summary['disk_bytes'] = passed[-1]['disk_bytes']
+        summary['io_write_bytes'] = passed[-1]['io_write_bytes']
+    else:
+        summary['error'] = runs[-1]['error']
+
+    return summary
+
+def compare(previous, results):
+    # Prints the change of throughput of every case also in (previous)
+
+    before = dict(((entry['operation'], entry['box']), entry) for entry in previous['results'])
+    print("Compared to %s:" % previous['started'])
+    for entry in results:
+        old = before.get((entry['operation'], entry['box']))
+        if old is None or old.get('mb_per_s') is None or entry.get('mb_per_s') is None:
+            continue
+        change = 100.0 * (entry['mb_per_s'] - old['mb_per_s']) / max(old['mb_per_s'], 0.000001)
+        print("  %-15s %-28s %9.1f -> %9.1f MB/s (%+.1f%%)" % (entry['operation'], entry['box'],
+                                                            old['mb_per_s'], entry['mb_per_s'], change))
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmarks the download and upload paths of vagrant-tools with synthetic boxes served from a local HTTP server.")
+    parser.add_argument("--sizes", default=default_sizes, metavar="sizes", help="Comma separated sizes of the disk image of the boxes, from 1M to 20G (Default is %s)." % default_sizes)
+    parser.add_argument("--kinds", default=",".join(box_kinds), metavar="kinds", help="Comma separated kinds of boxes, sparse (mostly zeros) and/or dense (random data) (Default is sparse,dense).")
+    parser.add_argument("--operations", default=",".join(operations), metavar="operations", help="Comma separated operations to measure among %s (Default is all)." % ", ".join(operations))
+    parser.add_argument("--compress", action='store_true', help="Generate gzip compressed boxes (Default no).")
+    parser.add_argument("--repeat", type=int, default=1, metavar="repeat", help="Runs of every case, the median is reported (Default is 1).")
+    parser.add_argument("--latency", type=int, default=0, metavar="ms", help="Milliseconds the HTTP server waits before every response (Default is 0).")
+    parser.add_argument("--bandwidth", type=int, metavar="rate", help="Bandwidth in KB/s shared by all the connections to the HTTP server (Default no limit).")
+    parser.add_argument("--no-ranges", action='store_true', help="Make the HTTP server ignore Range requests so boxes are streamed (Default no).")
+    parser.add_argument("--connections", type=int, default=default_connections, metavar="connections", help="Connections used by get_box for ranged downloads (Default is %d)." % default_connections)
+    parser.add_argument("--server", default=upload.local_server, metavar="server", help="Server the upload operation publishes to, user@host for SFTP or local for a directory (Default is local).")
+    parser.add_argument("--remotepath", metavar="remotepath", help="Path the upload operation publishes to (Default is a scratch folder with the local server).")
+    parser.add_argument("--workdir", default=default_workdir, metavar="workdir", help="Folder the boxes are generated in and kept for later runs (Default is %s)." % default_workdir)
+    parser.add_argument("--output", "-o", metavar="output", help="JSON file the results are written to (Default is bench-<date>.json in the current folder).")
+    parser.add_argument("--compare", metavar="previous", help="JSON results of a previous run to compare the throughput with.")
+
+    args = parser.parse_args()
+
+    selected = [operation.strip() for operation in args.operations.split(",") if operation.strip()]
+    kinds = [kind.strip() for kind in args.kinds.split(",") if kind.strip()]
+    try:
+        sizes = [parse_size(size) for size in args.sizes.split(",") if size.strip()]
+    except ValueError as e:
+        parser.error(str(e))
+    if any(operation not in operations for operation in selected):
+        parser.error("operations must be among %s" % ", ".join(operations))
+    if any(kind not in box_kinds for kind in kinds):
+        parser.error("kinds must be among %s" % ", ".join(box_kinds))
+    if args.server != upload.local_server and args.remotepath is None:
+        parser.error("--remotepath is required with an SFTP server")
+
+    boxes = [generate_box(args.workdir, size, kind, args.compress) for size in sizes for kind in kinds]
+
+    settings = {'workdir': args.workdir, 'connections': args.connections, 'server': args.server,
+                'remotepath': args.remotepath,
+                'url': start_server(os.path.join(args.workdir, "boxes"), args.latency / 1000.0,
+                                    args.bandwidth and args.bandwidth * 1024, not args.no_ranges)}
+
+    started = time.strftime("%Y-%m-%dT%H:%M:%S")
+    results = []
+    for box in boxes:
+        for operation in selected:
+            runs = [run_case(operation, box, settings) for i in range(args.repeat)]
+            entry = summarize(operation, box, runs)
+            results.append(entry)
+            if 'error' in entry:
+                print("%-15s %-28s FAILED (%s)" % (operation, box['name'], entry['error']))
+            else:
+                # Nothing is measured on disk for uploads to an SFTP server
+                disk = "n/a" if entry['disk_bytes'] is None else "%.1f MB" % (entry['disk_bytes'] / 1024.0 / 1024)
+                print("%-15s %-28s %9.1f MB/s %8.2fs %9d KB RSS %12s on disk" %
+                      (operation, box['name'], entry['mb_per_s'], entry['seconds'], entry['peak_rss_kb'], disk))
+
+    report = {'started': started, 'python': platform.python_version(), 'platform': platform.platform(),
+              'cpus': multiprocessing.cpu_count(),
+              'settings': {'latency_ms': args.latency, 'bandwidth_kb': args.bandwidth, 'ranges': not args.no_ranges,
+                           'connections': args.connections, 'compress': args.compress, 'repeat': args.repeat,
+                           'server': args.server},
+              'results': results}
+
+    output = args.output or "bench-%s.json" % started.replace(":", "")
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, sort_keys=True, indent=2, separators=(',', ': '))
+    print("Results written to %s" % output)
+
+    if args.compare is not None:
+        with open(args.compare) as previous_file:
+            compare(json.load(previous_file), results)
+
+    if any('error' in entry for entry in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+import os, sys
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "bench"))
+
+from vagranttools import boxhash, download, upload
+
+#-------------------------------------------------------------------------------
+#-- Local stand-ins shared by the tests
+#
+# Boxes are served by the HTTP server of bench/benchmark.py and published with
+# "server": "local", so nothing leaves this machine.
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    # The metadata and hash caches live in the home directory
+
+    monkeypatch.setattr(download, "metadata_cachedir", str(tmp_path / "cache" / "metadata"))
+    monkeypatch.setattr(boxhash, "hash_cachedir", str(tmp_path / "cache" / "hashes"))
+    monkeypatch.setattr(download, "verbose", False)
+    monkeypatch.setattr(upload, "verbose", False)
+
+@pytest.fixture
+def box_server(tmp_path):
+    # Returns the folder served and its base URL, Range requests honoured
+
+    from benchmark import start_server
+
+    served = tmp_path / "www"
+    served.mkdir()
+
+    return str(served), start_server(str(served))
@@ -0,0 +1,27 @@
+import os, sys, json
+import pytest
+
+if sys.version_info < (3, 7):
+    pytest.skip("the async client needs Python 3.7", allow_module_level=True)
+
+import asyncio
+from vagranttools import download
+from vagranttools.aio import AsyncClient
+
+def test_metadata_cache_is_shared_with_download(box_server):
+
+    served, baseurl = box_server
+    url = baseurl + "/company/box/metadata.json"
+    with open(os.path.join(served, "metadata.json"), "w") as metadata_file:
+        json.dump({"name": "company/box", "versions": []}, metadata_file)
+
+    assert asyncio.run(AsyncClient().fetch_metadata(url)) == {"name": "company/box", "versions": []}
+
+    # Cached by the async client, revalidated by vagranttools.download
+    cached = download.load_cached_metadata(url)
+    assert cached["etag"] is not None
+    cached["metadata"]["description"] = "cached"
+    download.save_cached_metadata(url, cached)
+
+    assert download.read_metadata(url)["description"] == "cached"
+    assert asyncio.run(AsyncClient().fetch_metadata(url))["description"] == "cached"
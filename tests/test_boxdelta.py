@@ -0,0 +1,87 @@
+import os, json, random
+import pytest
+
+from vagranttools import boxdelta
+
+block_size = 4096
+
+def random_bytes(generator, size):
+
+    return bytes(bytearray(generator.getrandbits(8) for i in range(size)))
+
+@pytest.fixture
+def versions(tmp_path):
+    # A base box and a new version with a changed block and 512 inserted
+    # bytes, like a tar member growing
+
+    generator = random.Random(1)
+    base = random_bytes(generator, 64 * block_size)
+    new = base[:10 * block_size] + random_bytes(generator, block_size) + base[11 * block_size:40 * block_size] + \
+          random_bytes(generator, 512) + base[40 * block_size:]
+
+    (tmp_path / "base.box").write_bytes(base)
+    (tmp_path / "new.box").write_bytes(new)
+
+    return tmp_path, new
+
+def make_delta(folder):
+
+    boxdelta.write_signatures(str(folder / "base.box"), str(folder / "signatures"), block_size)
+    with open(str(folder / "data"), "wb") as data_file:
+        recipe = boxdelta.write_delta(str(folder / "new.box"), boxdelta.read_signatures(str(folder / "signatures")),
+                                      data_file, block_size)
+    with open(str(folder / "recipe"), "w") as recipe_file:
+        json.dump(recipe, recipe_file)
+
+    return recipe
+
+def test_round_trip_sends_only_changed_blocks(versions):
+
+    folder, new = versions
+    recipe = make_delta(folder)
+
+    assert recipe["size"] == len(new)
+    # Two blocks changed or moved, the rest is copied from the base
+    assert os.path.getsize(str(folder / "data")) < 4 * block_size
+
+    boxdelta.apply_delta(str(folder / "base.box"), str(folder / "recipe"), str(folder / "data"),
+                         str(folder / "rebuilt.box"))
+
+    assert (folder / "rebuilt.box").read_bytes() == new
+
+def test_checksum_mismatch_is_rejected(versions):
+
+    folder, new = versions
+    recipe = make_delta(folder)
+    recipe["sha1"] = "0" * 40
+    with open(str(folder / "recipe"), "w") as recipe_file:
+        json.dump(recipe, recipe_file)
+
+    with pytest.raises(IOError):
+        boxdelta.apply_delta(str(folder / "base.box"), str(folder / "recipe"), str(folder / "data"),
+                             str(folder / "rebuilt.box"))
+
+    assert not os.path.exists(str(folder / "rebuilt.box"))
+    assert not [name for name in os.listdir(str(folder)) if name.endswith(".tmp")]
+
+def test_changed_base_is_rejected(versions):
+    # The base on the server isn't the one the signatures were computed from
+
+    folder, new = versions
+    make_delta(folder)
+    (folder / "base.box").write_bytes(b"\0" * (64 * block_size))
+
+    with pytest.raises(IOError):
+        boxdelta.apply_delta(str(folder / "base.box"), str(folder / "recipe"), str(folder / "data"),
+                             str(folder / "rebuilt.box"))
+
+    assert not os.path.exists(str(folder / "rebuilt.box"))
+
+def test_block_size_must_be_a_multiple_of_the_step(versions):
+
+    folder, new = versions
+    with pytest.raises(ValueError):
+        boxdelta.write_signatures(str(folder / "base.box"), str(folder / "signatures"), 1000)
+    with open(str(folder / "data"), "wb") as data_file:
+        with pytest.raises(ValueError):
+            boxdelta.write_delta(str(folder / "new.box"), {}, data_file, 1000)
@@ -0,0 +1,85 @@
+import io, os, tarfile
+import pytest
+
+from vagranttools import boxextract
+
+def make_box(path, members):
+    # (members) are (name, type, data or link target) tuples
+
+    with tarfile.open(str(path), "w") as tar:
+        for name, kind, value in members:
+            member = tarfile.TarInfo(name)
+            member.type = kind
+            if kind == tarfile.REGTYPE:
+                member.size = len(value)
+                tar.addfile(member, io.BytesIO(value))
+            else:
+                member.linkname = value
+                tar.addfile(member)
+
+def extract_stream(filename, outputdir):
+
+    with tarfile.open(filename, "r|") as tar:
+        return boxextract.extract_tar(tar, outputdir)
+
+# Uncompressed boxes are extracted concurrently, on one thread and while they
+# are downloaded, every way checks the members the same
+extractions = [lambda filename, outputdir: boxextract.extract_box(filename, outputdir, 4),
+               lambda filename, outputdir: boxextract.extract_box(filename, outputdir, 1),
+               extract_stream]
+
+@pytest.fixture
+def folders(tmp_path):
+
+    output = tmp_path / "output"
+    outside = tmp_path / "outside"
+    output.mkdir()
+    outside.mkdir()
+    (outside / "secret").write_bytes(b"secret")
+
+    return tmp_path, output, outside
+
+@pytest.mark.parametrize("extract", extractions)
+def test_links_inside_output_are_extracted(folders, extract):
+
+    tmp_path, output, outside = folders
+    make_box(tmp_path / "test.box", [("box.ovf", tarfile.REGTYPE, b"<ovf/>"),
+                                      ("link.ovf", tarfile.SYMTYPE, "box.ovf"),
+                                      ("copy.ovf", tarfile.LNKTYPE, "box.ovf")])
+
+    extract(str(tmp_path / "test.box"), str(output))
+
+    assert os.readlink(str(output / "link.ovf")) == "box.ovf"
+    assert (output / "copy.ovf").read_bytes() == b"<ovf/>"
+
+@pytest.mark.parametrize("extract", extractions)
+@pytest.mark.parametrize("members", [
+    [("link", tarfile.SYMTYPE, "../outside/secret")],
+    [("link", tarfile.SYMTYPE, "/etc/passwd")],
+    [("dir", tarfile.SYMTYPE, "../outside"), ("dir/secret", tarfile.REGTYPE, b"overwritten")],
+    [("hard", tarfile.LNKTYPE, "../outside/secret")],
+    [("../outside/secret", tarfile.REGTYPE, b"overwritten")],
+])
+def test_links_leaving_output_are_refused(folders, extract, members):
+
+    tmp_path, output, outside = folders
+    make_box(tmp_path / "test.box", members)
+
+    with pytest.raises(tarfile.ExtractError):
+        extract(str(tmp_path / "test.box"), str(output))
+
+    assert (outside / "secret").read_bytes() == b"secret"
+    assert not os.path.lexists(str(output / "link"))
+    assert not os.path.lexists(str(output / "hard"))
+
+@pytest.mark.parametrize("extract", extractions)
+def test_existing_link_in_output_isnt_followed(folders, extract):
+
+    tmp_path, output, outside = folders
+    os.symlink(str(outside), str(output / "dir"))
+    make_box(tmp_path / "test.box", [("dir/secret", tarfile.REGTYPE, b"overwritten")])
+
+    with pytest.raises(tarfile.ExtractError):
+        extract(str(tmp_path / "test.box"), str(output))
+
+    assert (outside / "secret").read_bytes() == b"secret"
@@ -0,0 +1,96 @@
+import io, os, gzip, random, tarfile
+import pytest
+
+from vagranttools import boxpack, upload
+
+@pytest.fixture
+def box(tmp_path, monkeypatch):
+    # An uncompressed box tar spanning several gzip members
+
+    monkeypatch.setattr(boxpack, "member_size", 64 * 1024)
+
+    generator = random.Random(2)
+    disk = bytes(bytearray(generator.getrandbits(8) for i in range(200 * 1024))) + b"\0" * (300 * 1024)
+
+    path = tmp_path / "plain.box"
+    with tarfile.open(str(path), "w") as tar:
+        member = tarfile.TarInfo("disk.vmdk")
+        member.size = len(disk)
+        tar.addfile(member, io.BytesIO(disk))
+
+    return path
+
+def repack(source, destination):
+
+    with open(str(destination), "wb") as output_file:
+        for chunk in boxpack.repack_chunks(str(source), processes=2):
+            output_file.write(chunk)
+
+def test_round_trip(box, tmp_path):
+
+    repack(box, tmp_path / "repacked.box")
+
+    assert boxpack.is_parallel_gzip(str(tmp_path / "repacked.box"))
+    assert b"".join(boxpack.decompress_chunks(str(tmp_path / "repacked.box"), processes=2)) == box.read_bytes()
+
+def test_repacked_box_is_plain_gzip(box, tmp_path):
+    # Vagrant and any gzip reader can open a repacked box
+
+    repack(box, tmp_path / "repacked.box")
+
+    with gzip.open(str(tmp_path / "repacked.box"), "rb") as repacked:
+        assert repacked.read() == box.read_bytes()
+
+def test_compressed_box_is_repacked_from_its_tar(box, tmp_path):
+
+    with open(str(box), "rb") as source, gzip.open(str(tmp_path / "box.gz"), "wb") as compressed:
+        compressed.write(source.read())
+
+    repack(tmp_path / "box.gz", tmp_path / "repacked.box")
+
+    assert b"".join(boxpack.decompress_chunks(str(tmp_path / "repacked.box"), processes=2)) == box.read_bytes()
+
+def test_plain_gzip_is_not_parallel(box, tmp_path):
+
+    with open(str(box), "rb") as source, gzip.open(str(tmp_path / "box.gz"), "wb") as compressed:
+        compressed.write(source.read())
+
+    assert not boxpack.is_parallel_gzip(str(tmp_path / "box.gz"))
+
+def test_truncated_member_is_rejected(box, tmp_path):
+
+    repack(box, tmp_path / "repacked.box")
+    content = (tmp_path / "repacked.box").read_bytes()
+    (tmp_path / "truncated.box").write_bytes(content[:-100])
+
+    with pytest.raises(IOError):
+        b"".join(boxpack.decompress_chunks(str(tmp_path / "truncated.box"), processes=2))
+
+@pytest.mark.skipif(boxpack.lzma is None, reason="xz needs Python 3")
+def test_xz_box_is_repacked_from_its_tar(box, tmp_path):
+
+    with open(str(box), "rb") as source:
+        (tmp_path / "box.xz").write_bytes(boxpack.lzma.compress(source.read()))
+
+    repack(tmp_path / "box.xz", tmp_path / "repacked.box")
+
+    assert b"".join(boxpack.decompress_chunks(str(tmp_path / "repacked.box"), processes=2)) == box.read_bytes()
+
+def test_unknown_format_isnt_repacked(tmp_path):
+
+    (tmp_path / "zstd.box").write_bytes(b"\x28\xb5\x2f\xfd" + b"\0" * 2000)
+
+    with pytest.raises(ValueError):
+        boxpack.open_tar(str(tmp_path / "zstd.box"))
+
+def test_publish_refuses_to_repack_unknown_format(tmp_path):
+
+    (tmp_path / "zstd.box").write_bytes(b"\x28\xb5\x2f\xfd" + b"\0" * 2000)
+    config = {"server": upload.local_server, "remotepath": str(tmp_path / "remote"), "baseurl": "http://127.0.0.1:1",
+              "name": "company/box", "description": "Test box", "provider": "virtualbox", "version": "1.0.0",
+              "file": str(tmp_path / "zstd.box")}
+
+    with pytest.raises(upload.PublishError):
+        upload.publish_box(config, repack=True)
+
+    assert not os.path.exists(str(tmp_path / "remote"))
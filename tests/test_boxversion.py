@@ -0,0 +1,77 @@
+import pytest
+
+from vagranttools.boxversion import VersionIndex, version_key, parse_constraints
+
+def index(*versions):
+
+    return VersionIndex({"versions": [{"version": version, "providers": [{"name": "virtualbox", "url": version}]}
+                                      for version in versions]})
+
+def latest(versions, constraints=None):
+
+    found = versions.latest("virtualbox", constraints)
+    return found and found[0]
+
+def test_numeric_segments_compare_as_numbers():
+
+    assert version_key("0.10.0") > version_key("0.9.0")
+    assert version_key("1.10") > version_key("1.9.9")
+    assert sorted(["0.10.0", "0.9.0", "0.2"], key=version_key) == ["0.2", "0.9.0", "0.10.0"]
+
+def test_trailing_zeros_do_not_count():
+
+    assert version_key("1.0") == version_key("1")
+    assert version_key("1.0.0") == version_key("1")
+
+def test_prerelease_is_older_than_release():
+
+    assert version_key("1.0.rc1") < version_key("1.0")
+    assert version_key("1.0.beta") < version_key("1.0.rc1")
+    assert version_key("1.0.rc1") > version_key("0.9")
+
+def test_latest_prefers_releases():
+
+    versions = index("0.9.0", "0.10.0", "2.0.0", "2.1.0.beta1")
+
+    assert latest(versions) == "2.0.0"
+    assert versions.newest == "2.0.0"
+
+def test_prerelease_fallback_when_no_release_matches():
+
+    versions = index("0.9.0", "2.0.0", "2.1.0.beta1")
+
+    assert latest(versions, "> 2.0.0") == "2.1.0.beta1"
+    assert latest(index("1.0.rc1", "1.0.rc2")) == "1.0.rc2"
+
+def test_pessimistic_constraint():
+
+    versions = index("1.1", "1.2.0", "1.2.5", "1.3.0", "2.0.0")
+
+    assert latest(versions, "~> 1.2") == "1.3.0"
+    assert latest(versions, "~> 1.2.0") == "1.2.5"
+    assert [version for version, box in versions.matching("virtualbox", "~> 1.2")] == ["1.2.0", "1.2.5", "1.3.0"]
+
+def test_not_equal_constraint():
+
+    versions = index("1.2.0", "1.3.0", "2.0.0")
+
+    assert latest(versions, "!= 2.0.0") == "1.3.0"
+    assert latest(versions, "!= 2.0, != 1.3") == "1.2.0"
+    assert latest(versions, ">= 1.3, != 1.3.0") == "2.0.0"
+
+def test_range_and_exact_constraints():
+
+    versions = index("0.9.0", "0.10.0", "1.0", "1.5")
+
+    assert latest(versions, "< 0.10") == "0.9.0"
+    assert latest(versions, ">= 0.10, < 1.5") == "1.0"
+    assert latest(versions, "= 1") == "1.0"
+    assert latest(versions, "1.0.0") == "1.0"
+    assert latest(versions, "> 1.5") is None
+
+def test_invalid_constraints():
+
+    with pytest.raises(ValueError):
+        parse_constraints(">> 1.0")
+    with pytest.raises(ValueError):
+        parse_constraints("~> beta")
@@ -0,0 +1,177 @@
+import io, os, json, random, hashlib, tarfile
+import pytest
+
+from vagranttools import download
+
+segment_size = 64 * 1024
+
+@pytest.fixture
+def served_box(box_server, monkeypatch):
+    # A box of five segments, the last one partial, on the local HTTP server
+
+    monkeypatch.setattr(download, "segment_size", segment_size)
+
+    generator = random.Random(3)
+    content = bytes(bytearray(generator.getrandbits(8) for i in range(4 * segment_size + 1000)))
+
+    served, baseurl = box_server
+    with open(os.path.join(served, "test.box"), "wb") as box_file:
+        box_file.write(content)
+
+    return baseurl + "/test.box", content, hashlib.sha1(content).hexdigest()
+
+def record_segments(monkeypatch):
+
+    requested = []
+    get_segment = download.get_segment
+
+    def recording(url, fullpath, start, end, current=None):
+        requested.append(start)
+        return get_segment(url, fullpath, start, end, current)
+
+    monkeypatch.setattr(download, "get_segment", recording)
+
+    return requested
+
+def test_download_in_segments(served_box, tmp_path, monkeypatch):
+
+    url, content, checksum = served_box
+    requested = record_segments(monkeypatch)
+
+    download.get_box(url, str(tmp_path), "sha1", checksum, 2)
+
+    assert (tmp_path / "test.box").read_bytes() == content
+    assert sorted(requested) == [index * segment_size for index in range(5)]
+    assert not os.path.exists(str(tmp_path / "test.box.journal"))
+
+def test_resume_from_journal(served_box, tmp_path, monkeypatch):
+    # The first two segments made it to disk before the download stopped
+
+    url, content, checksum = served_box
+    fullpath = str(tmp_path / "test.box")
+    with open(fullpath, "wb") as box_file:
+        box_file.write(content[:2 * segment_size])
+        box_file.truncate(len(content))
+    download.save_journal(fullpath + ".journal", "sha1:" + checksum, len(content), set([0, 1]))
+
+    requested = record_segments(monkeypatch)
+
+    download.get_box(url, str(tmp_path), "sha1", checksum, 2)
+
+    assert sorted(requested) == [2 * segment_size, 3 * segment_size, 4 * segment_size]
+    assert (tmp_path / "test.box").read_bytes() == content
+    assert not os.path.exists(fullpath + ".journal")
+
+def test_journal_of_another_box_is_ignored(served_box, tmp_path, monkeypatch):
+
+    url, content, checksum = served_box
+    fullpath = str(tmp_path / "test.box")
+    with open(fullpath, "wb") as box_file:
+        box_file.truncate(len(content))
+    download.save_journal(fullpath + ".journal", "sha1:" + "0" * 40, len(content), set([0, 1]))
+
+    requested = record_segments(monkeypatch)
+
+    download.get_box(url, str(tmp_path), "sha1", checksum, 2)
+
+    assert sorted(requested) == [index * segment_size for index in range(5)]
+    assert (tmp_path / "test.box").read_bytes() == content
+
+@pytest.fixture
+def served_tar(box_server):
+    # A small uncompressed box, as served by the repository
+
+    content = io.BytesIO()
+    with tarfile.open(fileobj=content, mode="w") as tar:
+        for name, data in (("metadata.json", b'{"provider": "virtualbox"}'), ("box.ovf", b"<ovf/>" * 1000)):
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+    content = content.getvalue()
+
+    served, baseurl = box_server
+    with open(os.path.join(served, "tar.box"), "wb") as box_file:
+        box_file.write(content)
+
+    return {"url": baseurl + "/tar.box", "checksum_type": "sha1", "checksum": hashlib.sha1(content).hexdigest()}, content
+
+def test_unwritable_cache_doesnt_fail_streamed_extraction(served_tar, tmp_path):
+
+    box, content = served_tar
+    (tmp_path / "file").write_bytes(b"")
+    output = tmp_path / "output"
+    output.mkdir()
+
+    boxfile = download.download_box(box, str(output), extract=True, stream=True, keep=True,
+                                    cachedir=str(tmp_path / "file" / "cache"))
+
+    assert open(boxfile, "rb").read() == content
+    assert (output / "box.ovf").read_bytes() == b"<ovf/>" * 1000
+
+def test_streamed_extraction_from_cache_doesnt_copy_the_box(served_tar, tmp_path, monkeypatch):
+
+    box, content = served_tar
+    cachedir = str(tmp_path / "cache" / "boxes")
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    download.download_box(box, str(first), extract=True, stream=True, keep=True, cachedir=cachedir)
+
+    copies = []
+    monkeypatch.setattr(download, "clone_or_copy", lambda source, destination: copies.append(destination))
+    monkeypatch.setattr(download, "urlopen", None)
+
+    assert download.download_box(box, str(second), extract=True, stream=True, cachedir=cachedir) is None
+    assert copies == []
+    assert sorted(os.listdir(str(second))) == ["box.ovf", "metadata.json"]
+    assert open(download.cache_entry(cachedir, box), "rb").read() == content
+
+def test_cache_doesnt_share_data_with_downloaded_boxes(served_box, tmp_path):
+
+    url, content, checksum = served_box
+    box = {"url": url, "checksum_type": "sha1", "checksum": checksum}
+    cachedir = str(tmp_path / "cache" / "boxes")
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+
+    boxfile = download.download_box(box, str(first), cachedir=cachedir)
+    with open(boxfile, "r+b") as box_file:
+        box_file.write(b"changed by the user")
+
+    assert open(download.cache_entry(cachedir, box), "rb").read() == content
+    assert open(download.download_box(box, str(second), cachedir=cachedir), "rb").read() == content
+
+def test_box_isnt_written_through_an_existing_hardlink(served_box, tmp_path):
+
+    url, content, checksum = served_box
+    (tmp_path / "other").write_bytes(b"other file")
+    output = tmp_path / "output"
+    output.mkdir()
+    os.link(str(tmp_path / "other"), str(output / "test.box"))
+
+    download.download_box({"url": url, "checksum_type": "sha1", "checksum": checksum}, str(output))
+
+    assert (output / "test.box").read_bytes() == content
+    assert (tmp_path / "other").read_bytes() == b"other file"
+
+def test_metadata_is_revalidated(box_server):
+
+    served, baseurl = box_server
+    url = baseurl + "/company/box/metadata.json"
+    with open(os.path.join(served, "metadata.json"), "w") as metadata_file:
+        json.dump({"name": "company/box", "versions": []}, metadata_file)
+
+    assert download.read_metadata(url) == {"name": "company/box", "versions": []}
+
+    # Marks the cached copy, only served when the server answers 304
+    cached = download.load_cached_metadata(url)
+    cached["metadata"]["description"] = "cached"
+    download.save_cached_metadata(url, cached)
+
+    assert download.read_metadata(url)["description"] == "cached"
+
+    with open(os.path.join(served, "metadata.json"), "w") as metadata_file:
+        json.dump({"name": "company/box", "versions": [{"version": "1.0.0"}]}, metadata_file)
+
+    assert download.read_metadata(url) == {"name": "company/box", "versions": [{"version": "1.0.0"}]}
@@ -0,0 +1,204 @@
+import os, json, time, hashlib, multiprocessing
+import pytest
+
+from vagranttools import upload
+
+def make_box(tmp_path, version):
+
+    return {"server": upload.local_server, "remotepath": str(tmp_path / "remote"), "baseurl": "http://boxes.example.com",
+            "company": "company", "name": "box", "description": "Test box", "provider": "virtualbox",
+            "version": version, "file": "box-" + version + ".box", "checksum": "0" * 40}
+
+def read_metadata(tmp_path):
+
+    with open(str(tmp_path / "remote" / "company" / "box" / "metadata.json")) as metadata_file:
+        return json.load(metadata_file)
+
+def publish(box, start):
+    # Publishes (box) as soon as (start) is set, the update is slowed down so
+    # the other processes read the same metadata meanwhile
+
+    def update(current):
+        time.sleep(0.05)
+        return upload.merge_box(box, current)
+
+    start.wait()
+    with upload.sftp_session(box["server"]) as sftp:
+        upload.sftp_update_metadata(sftp, box, update)
+
+def test_concurrent_publishes_keep_every_version(tmp_path):
+
+    start = multiprocessing.Event()
+    versions = ["1.0.%d" % index for index in range(6)]
+    processes = [multiprocessing.Process(target=publish, args=(make_box(tmp_path, version), start))
+                 for version in versions]
+    for process in processes:
+        process.start()
+    start.set()
+    for process in processes:
+        process.join(60)
+
+    assert [process.exitcode for process in processes] == [0] * len(processes)
+    assert sorted(version["version"] for version in read_metadata(tmp_path)["versions"]) == versions
+
+    directory = str(tmp_path / "remote" / "company" / "box")
+    assert sorted(os.listdir(directory)) == ["metadata.json"]
+
+def test_same_version_is_already_uploaded(tmp_path):
+
+    box = make_box(tmp_path, "1.0.0")
+    with upload.sftp_session(box["server"]) as sftp:
+        upload.sftp_update_metadata(sftp, box, lambda current: upload.merge_box(box, current))
+        metadata = read_metadata(tmp_path)
+
+        with pytest.raises(upload.AlreadyUploaded):
+            upload.sftp_update_metadata(sftp, box, lambda current: upload.merge_box(box, current))
+
+    assert read_metadata(tmp_path) == metadata
+    assert sorted(os.listdir(str(tmp_path / "remote" / "company" / "box"))) == ["metadata.json"]
+
+def test_new_provider_is_added_to_the_version(tmp_path):
+
+    box = make_box(tmp_path, "1.0.0")
+    other = dict(box, provider="libvirt")
+    with upload.sftp_session(box["server"]) as sftp:
+        for published in (box, other):
+            upload.sftp_update_metadata(sftp, published, lambda current: upload.merge_box(published, current))
+
+    versions = read_metadata(tmp_path)["versions"]
+    assert [version["version"] for version in versions] == ["1.0.0"]
+    assert [provider["name"] for provider in versions[0]["providers"]] == ["virtualbox", "libvirt"]
+
+def test_losing_publish_keeps_the_published_box(tmp_path):
+    # Both publishes saw no metadata.json yet, the second one finds the
+    # version published when it swaps metadata.json
+
+    first = tmp_path / "first" / "u2.box"
+    second = tmp_path / "second" / "u2.box"
+    for path, content in ((first, b"first box"), (second, b"second box")):
+        path.parent.mkdir()
+        path.write_bytes(content)
+
+    box = dict(make_box(tmp_path, "1.0.0"), file=str(first), checksum=None)
+    upload.upload_box(box)
+
+    with pytest.raises(upload.PublishError) as error:
+        upload.upload_box(dict(box, file=str(second), checksum=None))
+
+    assert "ALREADY UPLOADED" in str(error.value)
+    boxes = tmp_path / "remote" / "company" / "box" / "boxes"
+    assert os.listdir(str(boxes)) == ["u2.box"]
+    assert (boxes / "u2.box").read_bytes() == b"first box"
+    assert read_metadata(tmp_path)["versions"][0]["providers"][0]["checksum"] == \
+        hashlib.sha1(b"first box").hexdigest()
+
+@pytest.fixture
+def mirror(box_server, tmp_path, monkeypatch):
+    # A box replicated to a local mirror, its metadata.json served over HTTP.
+    # Records the box transfers and metadata updates.
+
+    monkeypatch.setattr(upload.time, "sleep", lambda seconds: None)
+    (tmp_path / "rep.box").write_bytes(b"replicated box")
+
+    served, baseurl = box_server
+    box = dict(make_box(tmp_path, "1.0.0"), file=str(tmp_path / "rep.box"),
+               checksum=hashlib.sha1(b"replicated box").hexdigest())
+    target = {"server": upload.local_server, "remotepath": box["remotepath"], "baseurl": baseurl}
+
+    calls = {"putfo": 0, "update": 0}
+    putfo = upload.LocalSFTP.putfo
+    update = upload.sftp_update_metadata
+
+    def counted_putfo(self, source, path, *args):
+        # metadata.json is written with putfo too
+        if "/boxes/" in path:
+            calls["putfo"] = calls["putfo"] + 1
+        return putfo(self, source, path, *args)
+
+    def counted_update(*args, **kwargs):
+        calls["update"] = calls["update"] + 1
+        return update(*args, **kwargs)
+
+    monkeypatch.setattr(upload.LocalSFTP, "putfo", counted_putfo)
+    monkeypatch.setattr(upload, "sftp_update_metadata", counted_update)
+
+    return box, target, calls
+
+def boxes_on_server(tmp_path):
+
+    return sorted(os.listdir(str(tmp_path / "remote" / "company" / "box" / "boxes")))
+
+def test_replication_retries_the_box_transfer(mirror, tmp_path, monkeypatch):
+
+    box, target, calls = mirror
+    putfo = upload.LocalSFTP.putfo
+
+    def failing_once(self, source, path, *args):
+        result = putfo(self, source, path, *args)
+        if calls["putfo"] == 1 and "/boxes/" in path:
+            raise IOError("connection reset")
+        return result
+
+    monkeypatch.setattr(upload.LocalSFTP, "putfo", failing_once)
+
+    result = {}
+    upload.replicate_to_target(box, target, result)
+
+    assert result["status"] == "ok"
+    assert calls == {"putfo": 2, "update": 1}
+    assert boxes_on_server(tmp_path) == ["rep.box"]
+    assert [version["version"] for version in read_metadata(tmp_path)["versions"]] == ["1.0.0"]
+
+def test_replication_doesnt_send_the_box_again_when_metadata_fails(mirror, tmp_path, monkeypatch):
+
+    box, target, calls = mirror
+
+    def failing(*args, **kwargs):
+        calls["update"] = calls["update"] + 1
+        raise IOError("metadata lock")
+
+    monkeypatch.setattr(upload, "sftp_update_metadata", failing)
+
+    result = {}
+    upload.replicate_to_target(box, target, result)
+
+    assert result["status"] == "failed"
+    assert calls == {"putfo": 1, "update": 1}
+    assert boxes_on_server(tmp_path) == []
+
+def test_replication_losing_the_race_is_skipped(mirror, tmp_path):
+    # The version was published after the mirror metadata was checked
+
+    box, target, calls = mirror
+    with upload.sftp_session(box["server"]) as sftp:
+        upload.sftp_update_metadata(sftp, box, lambda current: upload.merge_box(box, current))
+    metadata = read_metadata(tmp_path)
+
+    result = {}
+    upload.replicate_to_target(box, target, result)
+
+    assert result["status"] == "skipped"
+    assert calls["putfo"] == 1
+    assert boxes_on_server(tmp_path) == []
+    assert read_metadata(tmp_path) == metadata
+
+@pytest.mark.parametrize("policy", [{"keep_last": -1}, {"keep_last": 0}, {"keep_days": -3},
+                                    {"keep_last": 2, "keep_days": 0}, {"keep_last": "2"}, {"keep_days": 1.5}])
+def test_invalid_retention_policy_is_refused(tmp_path, policy):
+
+    config = {"server": upload.local_server, "remotepath": str(tmp_path / "remote"), "name": "company/box"}
+
+    with pytest.raises(upload.PublishError):
+        upload.validate_prune_settings(config, dict({"keep_last": None, "keep_days": None, "pinned": None,
+                                                     "gzip_metadata": None}, **policy))
+
+def test_retention_policy_keeps_the_newest_versions(tmp_path):
+
+    config = {"server": upload.local_server, "remotepath": str(tmp_path / "remote"), "name": "company/box",
+              "keep_last": 2}
+    policy = {"keep_last": None, "keep_days": None, "pinned": None, "gzip_metadata": None}
+    upload.validate_prune_settings(config, policy)
+    metadata = {"versions": [{"version": version, "providers": [{"name": "virtualbox"}]}
+                             for version in ["0.9.0", "0.10.0", "1.0.0", "1.1.0"]]}
+
+    assert upload.retained_versions(metadata, policy, {}) == set(["1.0.0", "1.1.0"])
@@ -1,231 +1,82 @@
 #!/usr/bin/env python
 
-import os, sys, argparse, time, tempfile, re, json, shutil, urlparse
-import hashlib, tarfile
-from urllib2 import Request, urlopen, URLError, HTTPError
+import sys, argparse
 from validators import url
-
-#----------------------------------------------------------------------
-#-- Script settings
-
-# Default settings
-default_provider = "virtualbox"
-vm_providers = ['vmware_workstation', 'vmware_fusion', 'virtualbox',
-                'docker', 'hyperv']
-keep = True
-
-def is_json(json_string):
-  try:
-    json_object = json.loads(json_string)
-  except ValueError, e:
-    return False
-  return True
-
-def decompress_box(box, outputdir=None):
-
-    tar = tarfile.open(box)
-    tar.extractall(outputdir)
-    tar.close()
-
-def sha1_file(filename):
-   #This function returns the SHA-1 hash of (filename)
-
-   checksum = hashlib.sha1()
-
-   with open(filename,'rb') as file:
-
-       chunk = 0
-       while chunk != b'':
-           chunk = file.read(1024)
-           checksum.update(chunk)
-
-   return checksum.hexdigest()
-
-def md5_file(filename):
-   #This function returns the MD5 hash of (filename)
-
-   checksum = hashlib.md5()
-
-   with open(filename,'rb') as file:
-
-       chunk = 0
-       while chunk != b'':
-           chunk = file.read(1024)
-           checksum.update(chunk)
-
-   return checksum.hexdigest()
-
-def get_metadata(url):
-
-    try:
-        response = urlopen(url)
-    except HTTPError as e:
-        if e.code == 404:
-            print "METADATA NOT FOUND"
-            sys.exit(1)
-        else:
-            print "--->>>> Couldn't connect to server to get current metadata. <<<<---"
-            print "Server failed to fulfill request. Error code: %s" % e.code
-            sys.exit(1)
-    except URLError as e:
-        print "--->>>> Couldn't connect to server to get current metadata. <<<<---"
-        print "Failed to connect to server. Reason: %s" % e.reason
-        sys.exit(1)
-    else:
-        output = response.read().decode("utf-8")
-        if is_json(output):
-            metadata = json.loads(output)
-        else:
-            print "--->>>> URL isn't a valid JSON file, please check URL. <<<<---"
-            sys.exit(1)
-
-    return metadata
-
-def get_latestbox(metadata, selected_provider):
-
-    version = "0.0.0"
-    i = 0
-    for entry in metadata['versions']:
-        if version < entry['version']:
-            version = entry['version']
-            version_id = i
-        i = i + 1
-
-    for provider in metadata['versions'][version_id]["providers"]:
-        if selected_provider == provider['name']:
-            box = provider
-
-    return box
-
-def get_box(url, output_dir=None):
-
-    if output_dir is None:
-        output_dir = os.getcwd()
-
-    output_file = os.path.basename(urlparse.urlsplit(url).path)
-
-    try:
-        response = urlopen(url)
-    except HTTPError as e:
-        if e.code == 404:
-            print "BOX FILE NOT FOUND!"
-            sys.exit(1)
-        else:
-            print "--->>>> Couldn't connect to server to get box file. <<<<---"
-            print "Server failed to fulfill request. Error code: %s" % e.code
-            sys.exit(1)
-    except URLError as e:
-        print "--->>>> Couldn't connect to server to get box file. <<<<---"
-        print "Failed to connect to server. Reason: %s" % e.reason
-        sys.exit(1)
-    else:
-        with open(output_dir + '/' + output_file, 'wb') as file:
-            block_size = 8192
-            while True:
-                buffer = response.read(block_size)
-                if not buffer:
-                    break
-
-                file.write(buffer)
-
-            file.close()
-
-    fullpath = output_dir + '/' + output_file
-
-    return fullpath
+from vagranttools import download, metrics
+from vagranttools.download import (default_provider, default_connections, default_cachesize, vm_providers,
+                                   get_mirror_metadata, resolve_box, download_box, RateLimit)
+from vagranttools.sync import default_jobs, load_catalog, sync_mirror
+from vagranttools.errors import VagrantToolsError
 
 #-------------------------------------------------------------------------------
 parser = argparse.ArgumentParser(description="This script downloads latest version of a vagrant box.")
-parser.add_argument("--url", "-u", required=True, metavar="url", help="URL of the box you want to download.")
+parser.add_argument("--url", "-u", action='append', metavar="url", help="URL of the box you want to download. Repeat it with the URL of every mirror of the box to download from the fastest one. With --sync, the URL of every box to mirror.")
 parser.add_argument("--provider", "-p", metavar="provider", help="Default provider for the box you want to download (i.e vmware) (Default is virtualbox).")
+parser.add_argument("--version", "-v", metavar="version", help="Version constraints of the box you want to download, like Vagrant's (i.e \">= 1.2, < 2.0\" or \"~> 1.2\") (Default is latest version).")
 parser.add_argument("--outputdir", "-o", metavar="outputdir", help="Path to the output folder where you want to store the download box (Default is current directory).")
 parser.add_argument("-d", action='store_true', help="Use this flag if you want to decompress the downloaded box (Default no).")
+parser.add_argument("--connections", "-c", type=int, default=default_connections, metavar="connections", help="Number of parallel connections used when the server supports ranged downloads (Default is 4).")
+parser.add_argument("--cachedir", metavar="cachedir", help="Path to a local cache of validated boxes shared between runs (Default no cache).")
+parser.add_argument("--cachesize", type=int, default=default_cachesize // (1024 * 1024), metavar="cachesize", help="Maximum size of the box cache in MB, least recently used boxes are removed first (Default is 20480).")
+parser.add_argument("--max-age", type=int, metavar="maxage", help="Reuse the cached metadata without contacting the server if it was fetched less than this many seconds ago (Default always revalidate).")
+parser.add_argument("-s", action='store_true', help="Use this flag with -d to extract the box while it is downloaded without storing the .box file unless -k is used (Default no).")
 parser.add_argument("-k", action='store_true', help="Use this flag if you want to keep the downloaded box in case you use the --decompress option (Default no).")
+parser.add_argument("--limit-rate", type=int, metavar="rate", help="Maximum download rate in KB/s shared by all connections (Default no limit).")
+parser.add_argument("--sync", metavar="mirrordir", help="Mirror every version and provider of the boxes given with --url or --catalog into this folder, only downloading the files that changed. --provider and --version filter what is mirrored.")
+parser.add_argument("--catalog", metavar="catalog", help="With --sync, file or URL listing the metadata URL of every box to mirror (JSON list or one URL per line).")
+parser.add_argument("--mirror-url", metavar="mirrorurl", help="With --sync, base URL the mirror folder is served from, used for the box URLs of the mirrored metadata.json (Default file:// URL of the folder).")
+parser.add_argument("--jobs", "-j", type=int, default=default_jobs, metavar="jobs", help="With --sync, number of files downloaded at the same time (Default is 4).")
+parser.add_argument("--metrics-out", metavar="metricsfile", help="Write the duration, bytes and MB/s of every phase of the run to this file, as JSON or as a Prometheus textfile when it ends with .prom (Default no).")
 
 args = parser.parse_args()
+metrics.start("vagrant-download", args.metrics_out)
 
-if len(sys.argv) > 1:
-    if url(args.url):
-        metadata = get_metadata(args.url)
-        if args.provider is not None:
-            for provider in vm_providers:
-                if provider == args.provider.lower():
-                    selected_provider = args.provider.lower()
-                    box = get_latestbox(metadata, selected_provider)
+if args.url is None and (args.sync is None or args.catalog is None):
+    parser.error("argument --url/-u is required")
 
-                    if args.outputdir is not None:
-                        if os.path.isdir(args.outputdir):
-                            boxfile = get_box(box['url'], args.outputdir)
-                            if box['checksum_type'] == 'sha1':
-                                checksum = sha1_file(boxfile)
-                            elif box['checksum_type'] == 'md5':
-                                checksum = md5_file(boxfile)
-                            else:
-                                print "Checksum not supported"
-                                sys.exit(1)
+if args.s and not args.d:
+    parser.error("-s requires -d")
 
-                            if checksum == box['checksum']:
-                                print "Box downloaded and validated"
-                                if args.d is not None:
-                                    if args.d:
-                                        decompress_box(boxfile, args.outputdir)
-                                        if args.k is not None:
-                                            if args.k:
-                                                print "Downloaded box has been kept"
-                                            else:
-                                                os.remove(boxfile)
-                            else:
-                                print "Box file checksum not valid"
-                                sys.exit(1)
-                        else:
-                            print "Outputdir isn't a valid path"
-                            sys.exit(1)
-                    else:
-                        boxfile = get_box(box['url'])
-                        if box['checksum_type'] == 'sha1':
-                            checksum = sha1_file(boxfile)
-                        elif box['checksum_type'] == 'md5':
-                            checksum = md5_file(boxfile)
-                        else:
-                            print "Checksum not supported"
-                            sys.exit(1)
+if args.limit_rate is not None:
+    download.rate_limit = RateLimit(args.limit_rate * 1024)
 
-                        if checksum == box['checksum']:
-                            print "Box downloaded and validated"
-                            if args.d is not None:
-                                if args.d:
-                                    decompress_box(boxfile)
-                                    if args.k is not None:
-                                        if args.k:
-                                            print "Downloaded box has been kept"
-                                        else:
-                                            os.remove(boxfile)
-                        else:
-                            print "Box file checksum not valid"
-                            sys.exit(1)
+if args.sync is not None:
+    try:
+        urls = args.url or []
+        if args.catalog is not None:
+            urls = urls + load_catalog(args.catalog)
 
-        else:
-            selected_provider = default_provider
-            box = get_latestbox(metadata, selected_provider)
+        if not all(url(box) for box in urls):
+            print "Entered URL is not valid, please check and try again"
+            sys.exit(1)
 
-            boxfile = get_box(box['url'])
-            if box['checksum_type'] == 'sha1':
-                checksum = sha1_file(boxfile)
-            elif box['checksum_type'] == 'md5':
-                checksum = md5_file(boxfile)
+        sync_mirror(urls, args.sync, args.mirror_url, args.provider and args.provider.lower(), args.version,
+                    args.jobs, args.connections)
+    except VagrantToolsError as e:
+        print e
+        sys.exit(1)
+elif len(sys.argv) > 1:
+    if all(url(mirror) for mirror in args.url):
+        try:
+            metadata_url, metadata = get_mirror_metadata(args.url, args.max_age)
+            if args.provider is not None:
+                for provider in vm_providers:
+                    if provider == args.provider.lower():
+                        box = resolve_box(metadata, provider, args.version, args.url)
+                        boxfile = download_box(box, args.outputdir, args.d, args.s, args.k,
+                                               args.connections, args.cachedir, args.cachesize * 1024 * 1024)
             else:
-                print "Checksum not supported"
-                sys.exit(1)
+                box = resolve_box(metadata, default_provider, args.version, args.url)
+                boxfile = download_box(box, args.outputdir, args.d, args.s, args.k,
+                                       args.connections, args.cachedir, args.cachesize * 1024 * 1024)
+        except VagrantToolsError as e:
+            print e
+            sys.exit(1)
 
-            if checksum == box['checksum']:
-                if args.d is not None:
-                    if args.d:
-                        decompress_box(boxfile, args.outputdir)
-                        if args.k is not None:
-                            if args.k:
-                                print "Downloaded box has been kept"
-                            else:
-                                os.remove(boxfile)
+        if args.d and not args.s and args.k:
+            print "Downloaded box has been kept"
     else:
         print "Entered URL is not valid, please check and try again"
         sys.exit(1)
+
+metrics.succeed()
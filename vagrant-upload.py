@@ -1,162 +1,18 @@
 #!/usr/bin/env python
 
-import os, sys, argparse, time, tempfile, re, json, shutil
-from urllib2 import Request, urlopen, URLError, HTTPError
-import hashlib
-from collections import OrderedDict
-from pprint import pprint
-from fabric.api import run, env, put, hosts, sudo, settings, hide, get, local
-from fabric.tasks import execute
+import os, sys, argparse
+from vagranttools.upload import (default_settings, display_error, display_ok, load_settings, remote_errors,
+                                 remote_directory, load_manifest, publish_batch, validate_prune_settings, prune_box,
+                                 publish_box)
+from vagranttools.errors import VagrantToolsError
+from vagranttools import metrics
 
-#-------------------------------------------------------------------------------
-#-- Script settings
+def fail(error):
+    # Library errors carry one message per line
 
-env.use_ssh_config = True
-default_settings = "config.json"
-
-#-------------------------------------------------------------------------------
-
-class colors:
-    HEADER = '\033[95m'
-    OKBLUE = '\033[94m'
-    OKGREEN = '\033[92m'
-    WARNING = '\033[93m'
-    FAIL = '\033[91m'
-    ENDC = '\033[0m'
-    BOLD = '\033[1m'
-    UNDERLINE = '\033[4m'
-
-def display_error(message):
-    print colors.FAIL + colors.BOLD + colors.UNDERLINE + message + colors.ENDC
-
-
-def display_ok(message):
-    print colors.OKGREEN + message + colors.ENDC
-
-
-def boxname_parser(name):
-    result = {}
-    boxname_regex = "(?P<company>(?:^[a-zA-Z0-9\-\_\.]*))\/(?P<name>(?:[a-zA-Z0-9\-\_\.]*))"
-
-    regex = re.compile(boxname_regex)
-    if regex.match(name) is not None:
-        regex = re.match(boxname_regex, name)
-        result["company"] = regex.group('company')
-        result["name"] = regex.group('name')
-
-    return result
-
-
-def load_settings(settings="metadata.json"):
-    if os.path.isfile(settings):
-        with open(settings) as defaults_file:
-            defaults = json.load(defaults_file)
-
-        return defaults
-
-
-def sha1_file(filename):
-   #This function returns the SHA-1 hash of (filename)
-
-   checksum = hashlib.sha1()
-
-   with open(filename,'rb') as file:
-
-       chunk = 0
-       while chunk != b'':
-           chunk = file.read(1024)
-           checksum.update(chunk)
-
-   return checksum.hexdigest()
-
-
-def validate_settings(config):
-
-    if config.get("provider") is None:
-        display_error("Provider not defined in metadata file, this is a required field.")
-        display_error("--->>>> Please set provider value in metadata file <<<<---")
-        sys.exit(1)
-
-    if config.get("file") is None:
-        display_error("File not defined in metadata file, this is a required field.")
-        display_error("--->>>> Please set file value in metadata file <<<<---")
-        sys.exit(1)
-    else:
-        if os.path.isfile(config.get("file")):
-            if not config.get("file").lower().endswith('.box'):
-                display_error("Box filename needs to ends with .box")
-                display_error("--->>>> Please change box filename in metadata file <<<<---")
-                sys.exit(1)
-        else:
-                display_error("Box filename path is not a file!")
-                display_error("--->>>> Please change box filename path in metadata file <<<<---")
-                sys.exit(1)
-
-    if config.get("baseurl") is None:
-        display_error("Base URL not defined in metadata file, this is a required field.")
-        display_error("--->>>> Please set baseurl value in metadata file <<<<---")
-        sys.exit(1)
-
-    if config.get("remotepath") is None:
-        display_error("Remote path not defined in metadata file, this is a required field.")
-        display_error("--->>>> Please set remote path value in metadata file <<<<---")
-        sys.exit(1)
-
-    if config.get("server") is None:
-        display_error("Server not defined in metadata file, this is a required field.")
-        display_error("--->>>> Please set server value in metadata file <<<<---")
-        sys.exit(1)
-
-    if config.get("description") is None:
-        config["description"] = "No description provided."
-
-    if config.get("name") is not None:
-        parsedname = boxname_parser(config.get("name"))
-        config["company"] = parsedname.get("company")
-        config["name"] = parsedname.get("name")
-    else:
-        config["company"] = "undefined"
-        config["name"] = "undefined"
-
-    return config
-
-def generate_metadata(box, metadata=None):
-
-    if metadata is not None:
-        version = {}
-        version["version"] = box["version"]
-
-        entry = {}
-        entry["name"] = box["provider"]
-        entry["url"] = box["baseurl"] + "/" + box["company"] + "/" + box["name"] + "/boxes/" + os.path.basename(box["file"])
-        entry["checksum_type"] = "sha1"
-        entry["checksum"] = sha1_file(box["file"])
-
-        providers = version
-        providers["providers"] = [entry]
-
-        metadata["versions"] = metadata["versions"] + [providers]
-
-    else:
-        metadata = {}
-        metadata["name"] = box["company"] + "/" + box["name"]
-        metadata["description"] = box["description"]
-
-        version = {}
-        version["version"] = box["version"]
-
-        entry = {}
-        entry["name"] = box["provider"]
-        entry["url"] = box["baseurl"] + "/" + box["company"] + "/" + box["name"] + "/boxes/" + os.path.basename(box["file"])
-        entry["checksum_type"] = "sha1"
-        entry["checksum"] = sha1_file(box["file"])
-
-        providers = version
-        providers["providers"] = [entry]
-
-        metadata["versions"] = [providers]
-
-    return metadata
+    for line in str(error).split("\n"):
+        display_error(line)
+    sys.exit(1)
 
 #-------------------------------------------------------------------------------
 
@@ -170,8 +26,19 @@ parser.add_argument("--description", "-d", metavar="description", help="The desc
 parser.add_argument("--version", "-v", metavar="version", help="The version number of the box.")
 parser.add_argument("--baseurl", "-b", metavar="baseurl", help="The base URL where box is going to be served.")
 parser.add_argument("--serverpath", "-s", metavar="serverpath", help="Full path to server in the following format username@fqdn.domain.com:/path/to/webroot")
+parser.add_argument("--delta", action='store_true', help="Only upload the blocks that changed since the previous version of the box, the server needs Python (Default no).")
+parser.add_argument("--repack", action='store_true', help="Recompress the box with block parallel gzip on all cores while it is uploaded (Default no).")
+parser.add_argument("--manifest", "-m", metavar="manifest", help="Full path to a manifest listing many boxes to publish in one run (In json format, check manifest.json)")
+parser.add_argument("--prune", action='store_true', help="Remove the versions of the box not kept by the retention policy and delete their box files instead of uploading.")
+parser.add_argument("--keep-last", type=int, metavar="versions", help="With --prune, keep this many of the newest versions.")
+parser.add_argument("--keep-days", type=int, metavar="days", help="With --prune, keep the versions published less than this many days ago.")
+parser.add_argument("--pin", action='append', metavar="version", help="With --prune, always keep this version. Can be repeated.")
+parser.add_argument("--gzip-metadata", action='store_true', default=None, help="With --prune, also publish a precompressed metadata.json.gz for nginx gzip_static (Default no).")
+parser.add_argument("--dry-run", action='store_true', help="With --prune, only report what would be removed and the space reclaimed.")
+parser.add_argument("--metrics-out", metavar="metricsfile", help="Write the duration, bytes and MB/s of every phase of the run to this file, as JSON or as a Prometheus textfile when it ends with .prom (Default no).")
 
 args = parser.parse_args()
+metrics.start("vagrant-upload", args.metrics_out)
 
 # We check if --configfile is configured and use that instead of default name
 if args.config is not None:
@@ -181,111 +48,55 @@ if args.config is not None:
         display_error("Configuration file is not a file, please check config file path")
         sys.exit(1)
 
-# We use default settings file if present
-if os.path.isfile(default_settings):
-    if load_settings(default_settings) is not None:
-        # Load settings
-        display_ok("Loading settings...")
-        config = load_settings(default_settings)
-
-        box = validate_settings(config)
-
-        # We create a temp folder where we are going to copy box and metadata
-        # before uploading it to server
-        if os.path.isfile(box.get("file")):
-            display_ok("Creating temp directory...")
-            # Create a randomic temporary folder
-            tempfolder = tempfile.mkdtemp()
-            directory = os.path.realpath(os.path.join(tempfolder, box.get("company"), box.get("name")))
-            os.makedirs(directory)
-
-            display_ok("Copying box file...")
-            # Copy box to temp folder
-            boxes = os.path.realpath(os.path.join(directory, "boxes"))
-            os.makedirs(boxes)
-            shutil.copy(box.get("file"), boxes)
-
-            display_ok("Checking current metadata...")
-            metadata_url = box.get("baseurl") + "/" + box.get("company") + "/" + box.get("name")
-            remote_metadata = Request(metadata_url)
-            try:
-                response = urlopen(remote_metadata)
-            except HTTPError as e:
-                if e.code == 404:
-                    display_ok("No current metadata found, creating it...")
-                    # This is first upload of box
-                    metadata = generate_metadata(box)
-
-                    with open(directory + '/metadata.json', 'w') as output_file:
-                        json.dump(metadata, output_file, sort_keys=True, indent=2, separators=(',', ': '))
-
-                    display_ok("Uploading box and metadata to repository...")
-                    with hide('output','running','warnings'), settings(warn_only=True, host_string=box["server"]):
-                        result = put(tempfolder + "/" + box.get("company"), box.get("remotepath"))
-
-                        if result.failed:
-                            display_error("--->>>> UPLOADING BOX FAILED! <<<<---")
-                            display_error("Check Internet connection or access to remote server")
-                            sys.exit(1)
-                        else:
-                            display_ok("Box " + box.get("company") + "/" + box.get("name") + " uploaded successfully!")
-
-                    # Delete tempfolder
-                    shutil.rmtree(tempfolder)
-                else:
-                    display_error("--->>>> Couldn't connect to server to get current metadata. <<<<---")
-                    display_error("Server failed to fulfill request. Error code: %s" % e.code)
+try:
+    # Pruning removes old versions of the box defined in the settings file
+    if args.prune:
+        settings = load_settings(default_settings)
+        if settings is not None:
+            display_ok("Loading settings...")
+            policy = {"keep_last": args.keep_last, "keep_days": args.keep_days,
+                      "pinned": args.pin, "gzip_metadata": args.gzip_metadata}
+            reclaimed = 0
+            for box in validate_prune_settings(settings, policy):
+                display_ok("Pruning " + box["server"] + ":" + remote_directory(box) + "...")
+                try:
+                    reclaimed = reclaimed + prune_box(box, policy, args.dry_run)
+                except remote_errors() + (ValueError, KeyError) as e:
+                    display_error("--->>>> PRUNING BOX FAILED! <<<<---")
+                    display_error("Reason: %s" % e)
                     sys.exit(1)
-            except URLError as e:
-                display_error("--->>>> Couldn't connect to server to get current metadata. <<<<---")
-                display_error("Failed to connect to server. Reason: %s" % e.reason)
-                sys.exit(1)
-            else:
-                display_ok("Updating box " + box.get("company") + "/" + box.get("name") + "...")
-                # Box was uploaded before, we need to update metadata
-                # and upload new version if it's not there
-                current_metadata = json.load(response)
-
-                # We check if the box version isn't already uploaded/defined
-                # in server metadata.json
-                already_uploaded = False
-                for entry in current_metadata['versions']:
-                    if box["version"] == entry['version']:
-                        already_uploaded = True
-
-                if not already_uploaded:
-                    metadata = generate_metadata(box, current_metadata)
-
-                    with open(directory + '/metadata.json', 'w') as output_file:
-                        json.dump(metadata, output_file, sort_keys=True, indent=2, separators=(',', ': '))
-
-                    display_ok("Uploading box and metadata to repository...")
-                    with hide('output','running','warnings'), settings(warn_only=True, host_string=box["server"]):
-                        result = put(tempfolder + "/" + box.get("company"), box.get("remotepath"))
-
-                        if result.failed:
-                            display_error("--->>>> UPLOADING BOX FAILED! <<<<---")
-                            display_error("Check Internet connection or access to remote server")
-                            sys.exit(1)
-                        else:
-                            display_ok("Box " + box.get("company") + "/" + box.get("name") + " uploaded successfully!")
-
-                else:
-                    display_error("--->>>> THIS BOX VERSION WAS ALREADY UPLOADED! <<<<---")
-                    display_error("Please check box version")
-                    sys.exit(1)
-
-                # Delete tempfolder
-                shutil.rmtree(tempfolder)
+            display_ok("%.1f MB %s" % (reclaimed / 1024.0 / 1024, "would be reclaimed" if args.dry_run else "reclaimed"))
+        else:
+            display_error("Configuration file is not a file, please check config file path")
+            sys.exit(1)
+    # A manifest publishes every box listed in it
+    elif args.manifest is not None:
+        if os.path.isfile(args.manifest):
+            display_ok("Loading manifest...")
+            boxes = load_manifest(args.manifest)
+            for box in boxes:
+                box["delta"] = box.get("delta") or args.delta
+                box["repack"] = box.get("repack") or args.repack
+            publish_batch(boxes)
         else:
-            display_error("File path defined in metadata file is not a file.")
-            display_error("--->>>> Please correct file value in metadata file <<<<---")
+            display_error("Manifest file is not a file, please check manifest file path")
             sys.exit(1)
-# If no default settings file is present, use args
-else:
-    if len(sys.argv) > 1:
-        print "Hello there!"
-        # TODO
-        # Parse args and do same as before
-        #else:
-        # No args fail hard!
+    # We use default settings file if present
+    elif os.path.isfile(default_settings):
+        settings = load_settings(default_settings)
+        if settings is not None:
+            # Load settings
+            display_ok("Loading settings...")
+            publish_box(settings, args.delta, args.repack)
+    # If no default settings file is present, use args
+    else:
+        if len(sys.argv) > 1:
+            print "Hello there!"
+            # TODO
+            # Parse args and do same as before
+            #else:
+            # No args fail hard!
+except VagrantToolsError as e:
+    fail(e)
+
+metrics.succeed()
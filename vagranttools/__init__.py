@@ -0,0 +1,17 @@
+#-------------------------------------------------------------------------------
+#-- vagranttools, the library behind vagrant-download and vagrant-upload
+#
+#   metadata = fetch_metadata("http://host/vagrant/company/name")
+#   box = resolve_box(metadata, "virtualbox", ">= 1.2")
+#   download_box(box, "/tmp/boxes")
+#   publish_box(load_settings("config.json"))
+#   sync_mirror(["http://host/vagrant/company/name"], "/srv/mirror")
+#
+# Errors raise a VagrantToolsError instead of exiting. Fabric and paramiko are
+# only imported when a server is contacted. vagranttools.aio has an asyncio
+# client to download many boxes from one process (Python 3 only).
+
+from vagranttools.errors import VagrantToolsError, DownloadError, PublishError
+from vagranttools.download import fetch_metadata, resolve_box, download_box
+from vagranttools.sync import sync_mirror
+from vagranttools.upload import publish_box, load_settings
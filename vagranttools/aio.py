@@ -0,0 +1,305 @@
+import os, ssl, json, hashlib, tempfile, asyncio
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, urljoin
+from vagranttools.boxhash import checksum_types
+from vagranttools.download import (resolve_box, box_error, metadata_error, load_cached_metadata, is_fresh,
+                                   conditional_headers, revalidated_metadata, cache_metadata, notify,
+                                   default_provider, stall_timeout)
+from vagranttools.errors import DownloadError
+
+#-------------------------------------------------------------------------------
+#-- asyncio download client (Python 3 only)
+#
+# One process drives many box downloads on a single event loop. Sockets are
+# read by the loop while writing and hashing every block runs on the default
+# executor, hashlib releases the GIL so digests of different boxes are
+# computed in parallel.
+
+read_size = 256 * 1024
+max_redirects = 5
+default_concurrency = 8
+
+#-------------------------------------------------------------------------------
+
+async def receive(call, timeout):
+    # Awaits a read of the connection, (timeout) seconds without data means
+    # the connection stalled
+
+    try:
+        return await asyncio.wait_for(call, timeout)
+    except asyncio.TimeoutError:
+        raise IOError("Connection stalled for %d seconds" % timeout)
+
+
+class Response(object):
+    # Body of an HTTP/1.1 response, read with a Content-Length, chunked or
+    # until the server closes the connection.
+
+    def __init__(self, url, status, headers, reader, writer, timeout):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        self.remaining = int(headers['content-length']) if 'content-length' in headers else None
+        self.chunk = 0
+        self.done = False
+
+    async def receive(self, call):
+        return await receive(call, self.timeout)
+
+    async def read(self):
+        # Returns the next block of the body, b'' at its end
+
+        if self.done:
+            return b''
+
+        if self.chunked:
+            if self.chunk == 0:
+                line = await self.receive(self.reader.readline())
+                self.chunk = int(line.split(b';')[0].strip() or b'0', 16)
+                if self.chunk == 0:
+                    while (await self.receive(self.reader.readline())) not in (b'\r\n', b'\n', b''):
+                        pass
+                    self.done = True
+                    return b''
+
+            buffer = await self.receive(self.reader.read(min(read_size, self.chunk)))
+            if not buffer:
+                raise IOError("Connection closed before end of chunk")
+            self.chunk = self.chunk - len(buffer)
+            if self.chunk == 0:
+                await self.receive(self.reader.readline())
+            return buffer
+
+        if self.remaining is not None:
+            if self.remaining == 0:
+                self.done = True
+                return b''
+            buffer = await self.receive(self.reader.read(min(read_size, self.remaining)))
+            if not buffer:
+                raise IOError("Connection closed before end of body")
+            self.remaining = self.remaining - len(buffer)
+            return buffer
+
+        buffer = await self.receive(self.reader.read(read_size))
+        if not buffer:
+            self.done = True
+        return buffer
+
+    async def body(self):
+        blocks = []
+        while True:
+            buffer = await self.read()
+            if not buffer:
+                return b''.join(blocks)
+            blocks.append(buffer)
+
+    def close(self):
+        self.writer.close()
+
+
+def file_mode():
+    # Mode of a new file under the current umask, mkstemp files are 0600
+
+    umask = os.umask(0)
+    os.umask(umask)
+
+    return 0o666 & ~umask
+
+
+def write_block(output_file, digest, buffer):
+
+    output_file.write(buffer)
+    if digest is not None:
+        digest.update(buffer)
+
+
+class AsyncClient(object):
+    # Downloads boxes concurrently from a single event loop, at most
+    # (concurrency) at a time. Errors raise DownloadError like the
+    # vagranttools.download functions.
+    #
+    #   client = AsyncClient()
+    #   boxes = await client.fetch_many(["http://host/vagrant/company/a",
+    #                                    "http://host/vagrant/company/b"])
+
+    def __init__(self, concurrency=default_concurrency, timeout=stall_timeout):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.semaphore = None
+        self.ssl_context = None
+
+    async def open(self, url, headers=None):
+        # Sends a GET for (url) and returns its Response once the headers are
+        # read, following redirects. Raises HTTPError on error statuses.
+
+        for redirect in range(max_redirects + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise IOError("Unsupported URL scheme: %s" % url)
+
+            context = None
+            if parts.scheme == 'https':
+                if self.ssl_context is None:
+                    self.ssl_context = ssl.create_default_context()
+                context = self.ssl_context
+
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(parts.hostname, parts.port or (443 if context else 80), ssl=context),
+                    self.timeout)
+            except asyncio.TimeoutError:
+                raise IOError("Couldn't connect to %s in %d seconds" % (parts.netloc, self.timeout))
+
+            path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+            request = ["GET %s HTTP/1.1" % path, "Host: %s" % parts.netloc.rpartition('@')[2],
+                       "User-Agent: vagranttools", "Accept-Encoding: identity", "Connection: close"]
+            request.extend("%s: %s" % header for header in (headers or {}).items())
+            writer.write(("\r\n".join(request) + "\r\n\r\n").encode('latin-1'))
+
+            received = {}
+            try:
+                status = (await receive(reader.readline(), self.timeout)).decode('latin-1').split(None, 2)
+                if len(status) < 2 or not status[0].startswith('HTTP/') or not status[1].isdigit():
+                    raise IOError("Invalid HTTP response from %s" % parts.netloc)
+
+                while True:
+                    line = (await receive(reader.readline(), self.timeout)).decode('latin-1')
+                    if line in ('\r\n', '\n', ''):
+                        break
+                    name, _, value = line.partition(':')
+                    received[name.strip().lower()] = value.strip()
+            except BaseException:
+                writer.close()
+                raise
+
+            response = Response(url, int(status[1]), received, reader, writer, self.timeout)
+
+            if response.status in (301, 302, 303, 307, 308) and 'location' in response.headers:
+                writer.close()
+                url = urljoin(url, response.headers['location'])
+                continue
+
+            if response.status >= 400:
+                writer.close()
+                raise HTTPError(url, response.status, status[2].strip() if len(status) > 2 else '',
+                                response.headers, None)
+
+            return response
+
+        raise IOError("Too many redirects for %s" % url)
+
+    async def fetch_metadata(self, url, max_age=None):
+        # Returns the metadata at (url), sharing the conditional request cache
+        # of vagranttools.download. (url) may also be a list of mirrors, tried
+        # in order.
+
+        urls = [url] if isinstance(url, str) else list(url)
+        for index, url in enumerate(urls):
+            cached = load_cached_metadata(url)
+            if is_fresh(cached, max_age):
+                return cached['metadata']
+
+            try:
+                response = await self.open(url, conditional_headers(cached))
+                try:
+                    if response.status == 304 and cached is not None:
+                        return revalidated_metadata(url, cached)
+                    metadata = json.loads((await response.body()).decode('utf-8'))
+                finally:
+                    response.close()
+            except (IOError, ValueError) as e:
+                if index + 1 == len(urls):
+                    raise metadata_error(e)
+                notify("Couldn't get metadata from %s (%s), trying next mirror" % (url, e))
+                continue
+
+            cache_metadata(url, metadata, response.headers.get('etag'), response.headers.get('last-modified'))
+            return metadata
+
+    async def get_file(self, url, fullpath, checksum_type=None, checksum=None):
+        # Streams (url) into a temporary file next to (fullpath), hashing it
+        # on the way, and renames it into place once the checksum matches.
+
+        loop = asyncio.get_running_loop()
+        digest = hashlib.new(checksum_type.lower()) if checksum_type is not None else None
+
+        response = await self.open(url)
+        try:
+            handle, staging = tempfile.mkstemp(prefix='.' + os.path.basename(fullpath) + '.',
+                                               suffix='.tmp', dir=os.path.dirname(fullpath))
+            try:
+                with os.fdopen(handle, 'wb') as output_file:
+                    while True:
+                        buffer = await response.read()
+                        if not buffer:
+                            break
+                        await loop.run_in_executor(None, write_block, output_file, digest, buffer)
+
+                if digest is not None and checksum is not None:
+                    if digest.hexdigest() != checksum.lower():
+                        raise DownloadError("Box file checksum not valid")
+
+                os.chmod(staging, file_mode())
+                os.rename(staging, fullpath)
+            except BaseException:
+                os.remove(staging)
+                raise
+        finally:
+            response.close()
+
+    async def download_box(self, box, output_dir=None):
+        # Downloads and validates (box), as returned by resolve_box, into
+        # (output_dir) and returns its path. The mirrors in box['urls'] are
+        # tried in order.
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        if output_dir is None:
+            output_dir = os.getcwd()
+        if not os.path.isdir(output_dir):
+            raise DownloadError("Outputdir isn't a valid path")
+
+        checksum_type = box.get('checksum_type')
+        if checksum_type is not None and checksum_type.lower() not in checksum_types:
+            raise DownloadError("Checksum not supported")
+
+        urls = box.get('urls') or [box['url']]
+        fullpath = os.path.join(output_dir, os.path.basename(urlsplit(urls[0]).path))
+
+        async with self.semaphore:
+            for index, url in enumerate(urls):
+                try:
+                    await self.get_file(url, fullpath, checksum_type, box.get('checksum'))
+                    break
+                except IOError as e:
+                    if index + 1 == len(urls):
+                        raise box_error(e)
+                    notify("Mirror failed (%s), switching to %s" % (e, urls[index + 1]))
+
+        notify("Box %s downloaded and validated" % os.path.basename(fullpath))
+
+        return fullpath
+
+    async def fetch(self, url, provider=default_provider, version=None, output_dir=None, max_age=None):
+        # Downloads the box of (provider) matching (version) from the metadata
+        # at (url), or the list of its mirrors, and returns its path.
+
+        metadata = await self.fetch_metadata(url, max_age)
+        mirrors = [url] if isinstance(url, str) else list(url)
+        # Ranking mirrors probes them with blocking requests
+        box = await asyncio.get_running_loop().run_in_executor(None, resolve_box, metadata,
+                                                                provider, version, mirrors)
+
+        return await self.download_box(box, output_dir)
+
+    async def fetch_many(self, urls, provider=default_provider, version=None, output_dir=None, max_age=None):
+        # Fetches the box of every metadata URL in (urls) concurrently. Returns
+        # the path of every box, or the DownloadError that stopped it.
+
+        return await asyncio.gather(*[self.fetch(url, provider, version, output_dir, max_age) for url in urls],
+                                    return_exceptions=True)
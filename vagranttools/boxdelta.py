@@ -0,0 +1,242 @@
+import os, sys, json, hashlib, zlib
+from collections import deque
+
+#-------------------------------------------------------------------------------
+#-- Block level deltas between two versions of a box (rsync style)
+#
+# The server computes the signatures of the previous box, the uploader finds
+# the blocks of the new box already present there and sends only the rest
+# plus a recipe, and the server rebuilds the new box checking its SHA-1.
+# This file is also copied to the server and run there, so it only uses the
+# standard library and works with Python 2 and 3:
+#
+#   python boxdelta.py signature <box> <block_size> <output>
+#   python boxdelta.py apply <base> <recipe> <data> <output>
+
+default_block_size = 64 * 1024
+# Boxes are tar files, members start at multiples of the tar record size so a
+# block that moved did so by a multiple of it.
+default_step = 512
+read_size = 4 * 1024 * 1024
+# The weak checksum of a block is a polynomial hash of the CRC-32 of its step
+# sized records, so it rolls one record at a time
+weak_base = 0x01000193
+weak_modulus = 4294967291
+
+try:
+    # Python 2, crc32 doesn't accept memoryviews there
+    window = buffer
+except NameError:
+    def window(data, offset, size):
+        return memoryview(data)[offset:offset + size]
+
+#-------------------------------------------------------------------------------
+
+def check_block_size(block_size, step):
+
+    if block_size <= 0 or block_size % step:
+        raise ValueError("Block size must be a multiple of %d" % step)
+
+
+def roll_in(weak, record):
+    # Appends (record) to a weak checksum, returns the CRC-32 of (record) too
+
+    crc = zlib.crc32(record) & 0xffffffff
+    return (weak * weak_base + crc) % weak_modulus, crc
+
+
+def weak_checksum(block, step=default_step):
+
+    weak = 0
+    for offset in range(0, len(block), step):
+        weak = roll_in(weak, window(block, offset, step))[0]
+
+    return weak
+
+
+def write_signatures(filename, output, block_size=default_block_size, step=default_step):
+    # Writes the weak and strong (SHA-1) checksum of every full block of
+    # (filename) to (output), one block per line.
+
+    check_block_size(block_size, step)
+
+    with open(filename, 'rb') as input_file:
+        with open(output, 'w') as output_file:
+            while True:
+                block = input_file.read(block_size)
+                if len(block) < block_size:
+                    break
+
+                output_file.write("%08x %s\n" % (weak_checksum(block, step), hashlib.sha1(block).hexdigest()))
+
+
+def read_signatures(filename):
+    # Returns a dict mapping every weak checksum to [(strong, block), ...]
+
+    signatures = {}
+    with open(filename) as input_file:
+        for block, line in enumerate(input_file):
+            weak, strong = line.split()
+            signatures.setdefault(int(weak, 16), []).append((strong, block))
+
+    return signatures
+
+
+def write_delta(filename, signatures, data_file, block_size=default_block_size, step=default_step):
+    # Compares (filename) against the (signatures) of the base box. Blocks
+    # found in the base become copy operations, everything else is appended
+    # to (data_file). Returns the recipe to rebuild (filename) on the server,
+    # including its size and SHA-1 computed in the same pass. The weak
+    # checksum of the block at every step is rolled from the previous one, so
+    # each byte of the box is only checksummed once.
+
+    check_block_size(block_size, step)
+
+    checksum = hashlib.sha1()
+    operations = []
+    size = 0
+
+    # CRC-32 of the records of the block at (position) and its weak checksum
+    records = deque()
+    weak = 0
+    count = block_size // step
+    # Weight of the oldest record, removed when the block moves by a step
+    oldest = pow(weak_base, count - 1, weak_modulus)
+
+    def add_copy(block):
+        offset = block * block_size
+        if operations and operations[-1][0] == "copy" and \
+           operations[-1][1] + operations[-1][2] == offset:
+            operations[-1][2] = operations[-1][2] + block_size
+        else:
+            operations.append(["copy", offset, block_size])
+
+    def add_data(data):
+        if not len(data):
+            return
+        data_file.write(data)
+        if operations and operations[-1][0] == "data":
+            operations[-1][1] = operations[-1][1] + len(data)
+        else:
+            operations.append(["data", len(data)])
+
+    with open(filename, 'rb') as input_file:
+        pending = b''
+        position = 0
+        literal = 0
+        eof = False
+
+        while True:
+            if len(pending) - position < block_size and not eof:
+                # Keep only what wasn't sent yet and read some more
+                add_data(pending[literal:position])
+                pending = pending[position:]
+                position = 0
+                literal = 0
+
+                chunk = input_file.read(read_size)
+                if chunk:
+                    checksum.update(chunk)
+                    size = size + len(chunk)
+                    pending = pending + chunk
+                else:
+                    eof = True
+                continue
+
+            if len(pending) - position < block_size:
+                break
+
+            while len(records) < count:
+                weak, crc = roll_in(weak, window(pending, position + len(records) * step, step))
+                records.append(crc)
+
+            match = None
+            candidates = signatures.get(weak)
+            if candidates is not None:
+                strong = hashlib.sha1(window(pending, position, block_size)).hexdigest()
+                for candidate, block in candidates:
+                    if candidate == strong:
+                        match = block
+                        break
+
+            if match is not None:
+                add_data(pending[literal:position])
+                add_copy(match)
+                position = position + block_size
+                literal = position
+                records.clear()
+                weak = 0
+            else:
+                position = position + step
+                weak = (weak - records.popleft() * oldest) % weak_modulus
+
+        add_data(pending[literal:])
+
+    return {"size": size, "sha1": checksum.hexdigest(), "block_size": block_size,
+            "operations": operations}
+
+
+def apply_delta(base, recipe, data, output):
+    # Rebuilds a box from (base), the (recipe) and its (data). The result is
+    # only renamed to (output) when its size and SHA-1 match the recipe.
+
+    with open(recipe) as recipe_file:
+        recipe = json.load(recipe_file)
+
+    checksum = hashlib.sha1()
+    size = 0
+    staging = output + '.%d.tmp' % os.getpid()
+
+    try:
+        with open(base, 'rb') as base_file:
+            with open(data, 'rb') as data_file:
+                with open(staging, 'wb') as output_file:
+                    for operation in recipe["operations"]:
+                        if operation[0] == "copy":
+                            base_file.seek(operation[1])
+                            source = base_file
+                            remaining = operation[2]
+                        else:
+                            source = data_file
+                            remaining = operation[1]
+
+                        while remaining > 0:
+                            chunk = source.read(min(read_size, remaining))
+                            if not chunk:
+                                raise IOError("Unexpected end of delta source")
+                            output_file.write(chunk)
+                            checksum.update(chunk)
+                            size = size + len(chunk)
+                            remaining = remaining - len(chunk)
+
+        if size != recipe["size"] or checksum.hexdigest() != recipe["sha1"]:
+            raise IOError("Rebuilt box doesn't match, expected SHA-1 %s got %s" %
+                          (recipe["sha1"], checksum.hexdigest()))
+
+        os.rename(staging, output)
+    except:
+        if os.path.exists(staging):
+            os.remove(staging)
+        raise
+
+
+def main(argv):
+
+    try:
+        if len(argv) == 5 and argv[1] == "signature":
+            write_signatures(argv[2], argv[4], int(argv[3]))
+        elif len(argv) == 6 and argv[1] == "apply":
+            apply_delta(argv[2], argv[3], argv[4], argv[5])
+        else:
+            sys.stderr.write("usage: boxdelta.py signature <box> <block_size> <output>\n"
+                             "       boxdelta.py apply <base> <recipe> <data> <output>\n")
+            return 2
+    except (IOError, OSError, ValueError) as e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
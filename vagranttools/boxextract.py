@@ -0,0 +1,251 @@
+import os, operator, tarfile, threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from vagranttools.boxpack import ChunkReader, decompress_chunks, is_parallel_gzip
+
+#-------------------------------------------------------------------------------
+#-- Sparse aware box extraction used by vagrant-download
+#
+# Disk images are mostly zeros. Every all-zero block is skipped with a seek
+# instead of written, so the filesystem leaves a hole there, and the file is
+# truncated to its size at the end for trailing holes. GNU sparse members are
+# read through tarfile, which returns their holes as zeros, and end up sparse
+# the same way. Uncompressed boxes can be read at any offset, their large
+# members are extracted concurrently, each thread with its own file handle.
+
+block_size = 64 * 1024
+default_threads = 4
+# Members smaller than this are extracted in the main thread
+parallel_min_size = 8 * 1024 * 1024
+zero_block = b'\0' * block_size
+
+#-------------------------------------------------------------------------------
+
+def write_sparse(source, path, size):
+    # Copies (size) bytes read from (source) to (path), seeking over all zero
+    # blocks. Returns the number of bytes actually written.
+
+    written = 0
+    remaining = size
+
+    # Don't write through a hard link to a file outside of this extraction
+    if os.path.lexists(path):
+        os.remove(path)
+
+    with open(path, 'wb') as output_file:
+        while remaining > 0:
+            chunk = source.read(min(block_size, remaining))
+            if not chunk:
+                raise IOError("Unexpected end of data in %s" % path)
+
+            if chunk == zero_block[:len(chunk)]:
+                output_file.seek(len(chunk), os.SEEK_CUR)
+            else:
+                output_file.write(chunk)
+                written = written + len(chunk)
+            remaining = remaining - len(chunk)
+
+        output_file.truncate(size)
+
+    return written
+
+
+def is_within(path, root):
+
+    return path == root or path.startswith(os.path.join(root, ''))
+
+
+def member_path(member, outputdir):
+    # Returns where (member) is extracted, refusing names leaving (outputdir)
+    # and links pointing out of it. Symlinks already extracted are resolved,
+    # so a member can't be written through a link to a directory outside.
+
+    root = os.path.normpath(outputdir)
+    path = os.path.normpath(os.path.join(root, member.name))
+    if os.path.isabs(member.name) or not is_within(path, root):
+        raise tarfile.ExtractError("Refusing to extract %s outside of %s" % (member.name, outputdir))
+
+    real_root = os.path.realpath(root)
+    # Directories get their attributes set through the path itself
+    real_path = os.path.realpath(path if member.isdir() else os.path.dirname(path))
+    if not is_within(real_path, real_root):
+        raise tarfile.ExtractError("Refusing to extract %s through a link leaving %s" % (member.name, outputdir))
+
+    if member.issym() or member.islnk():
+        if member.issym():
+            target = os.path.join(os.path.dirname(path), member.linkname)
+        else:
+            # Hardlink targets are names of the archive
+            target = os.path.join(root, member.linkname)
+        if not is_within(os.path.realpath(target), real_root):
+            raise tarfile.ExtractError("Refusing to extract link %s to %s outside of %s" %
+                                       (member.name, member.linkname, outputdir))
+
+    return path
+
+
+def make_parent(path):
+
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+
+
+def set_attributes(tar, member, path):
+    # Ownership is left alone, like extracting as a regular user would
+
+    tar.chmod(member, path)
+    tar.utime(member, path)
+
+
+def new_stats():
+
+    return {'files': 0, 'size': 0, 'written': 0}
+
+
+def add_stats(stats, size, written, lock=None):
+
+    if lock is not None:
+        lock.acquire()
+    try:
+        stats['files'] = stats['files'] + 1
+        stats['size'] = stats['size'] + size
+        stats['written'] = stats['written'] + written
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+def finish_directories(tar, directories, outputdir):
+    # Directories get their attributes last, deepest first, as extractall does
+
+    for member in sorted(directories, key=operator.attrgetter('name'), reverse=True):
+        set_attributes(tar, member, member_path(member, outputdir))
+
+
+def extract_member(tar, member, outputdir, stats, directories):
+    # Extracts one (member) of (tar), which may be read in stream mode
+
+    path = member_path(member, outputdir)
+
+    if member.isdir():
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        directories.append(member)
+    elif member.isreg():
+        make_parent(path)
+        source = tar.extractfile(member)
+        written = write_sparse(source, path, member.size)
+        source.close()
+        set_attributes(tar, member, path)
+        add_stats(stats, member.size, written)
+    else:
+        tar.extract(member, outputdir)
+
+
+def extract_tar(tar, outputdir):
+    # Extracts every member of an open (tar) one after another. Works on
+    # stream mode archives. Returns the extraction stats.
+
+    stats = new_stats()
+    directories = []
+
+    for member in tar:
+        extract_member(tar, member, outputdir, stats, directories)
+
+    finish_directories(tar, directories, outputdir)
+
+    return stats
+
+
+def extract_concurrently(filename, outputdir, threads=default_threads):
+    # Extracts the uncompressed tar (filename), copying its large regular
+    # members on (threads) threads straight from their offset in the file.
+    # Links are created once every file they may point to exists.
+
+    stats = new_stats()
+    directories = []
+    deferred = []
+    jobs = queue.Queue()
+    lock = threading.Lock()
+    errors = []
+
+    tar = tarfile.open(filename)
+    try:
+        for member in tar.getmembers():
+            if member.isreg() and not member.issparse() and member.size >= parallel_min_size:
+                path = member_path(member, outputdir)
+                make_parent(path)
+                jobs.put((member, path))
+            elif member.issym() or member.islnk():
+                deferred.append(member)
+            else:
+                extract_member(tar, member, outputdir, stats, directories)
+
+        def worker():
+            with open(filename, 'rb') as source:
+                while not errors:
+                    try:
+                        member, path = jobs.get_nowait()
+                    except queue.Empty:
+                        return
+
+                    try:
+                        source.seek(member.offset_data)
+                        written = write_sparse(source, path, member.size)
+                        set_attributes(tar, member, path)
+                        add_stats(stats, member.size, written, lock)
+                    except (IOError, OSError, tarfile.TarError) as e:
+                        errors.append(e)
+
+        workers = [threading.Thread(target=worker) for index in range(min(threads, jobs.qsize()))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+        for member in deferred:
+            extract_member(tar, member, outputdir, stats, directories)
+
+        finish_directories(tar, directories, outputdir)
+    finally:
+        tar.close()
+
+    return stats
+
+
+def is_compressed(filename):
+
+    with open(filename, 'rb') as box:
+        magic = box.read(6)
+
+    return magic[:2] == b'\x1f\x8b' or magic[:3] == b'BZh' or magic == b'\xfd7zXZ\x00'
+
+
+def extract_box(filename, outputdir=None, threads=default_threads):
+    # Extracts the box (filename) into (outputdir) and returns a dict with
+    # the number of files, their logical size and the bytes written to disk.
+    # Boxes repacked by vagrant-upload are decompressed on all cores and
+    # uncompressed ones are extracted on (threads) threads.
+
+    if outputdir is None:
+        outputdir = os.getcwd()
+
+    if is_parallel_gzip(filename):
+        tar = tarfile.open(fileobj=ChunkReader(decompress_chunks(filename)), mode='r|')
+    else:
+        if not is_compressed(filename) and threads > 1:
+            return extract_concurrently(filename, outputdir, threads)
+
+        tar = tarfile.open(filename)
+
+    try:
+        return extract_tar(tar, outputdir)
+    finally:
+        tar.close()
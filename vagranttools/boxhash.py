@@ -0,0 +1,125 @@
+import os, json, hashlib
+from vagranttools import metrics
+
+#-------------------------------------------------------------------------------
+#-- Hashing helpers shared by vagrant-upload and vagrant-download
+
+checksum_types = ['md5', 'sha1', 'sha256', 'sha384', 'sha512']
+block_size = 1024 * 1024
+hash_cachedir = os.path.join(os.path.expanduser("~"), ".vagrant-tools", "hashes")
+
+#-------------------------------------------------------------------------------
+
+class TeeReader(object):
+    # File-like wrapper around (stream) that feeds everything read to
+    # (digest) and writes a copy to (copy) when given, so a stream is hashed
+    # in the same pass that consumes it.
+
+    def __init__(self, stream, digest=None, copy=None):
+        self.stream = stream
+        self.digest = digest
+        self.copy = copy
+
+    def read(self, size=-1):
+        buffer = self.stream.read(size)
+        if self.digest is not None:
+            self.digest.update(buffer)
+        if self.copy is not None:
+            self.copy.write(buffer)
+
+        return buffer
+
+
+def file_key(filename):
+    # A file is considered unchanged while its path, size, modification time
+    # and inode stay the same.
+
+    stat = os.stat(filename)
+    mtime_ns = getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1000000000))
+
+    return {'realpath': os.path.realpath(filename), 'size': stat.st_size,
+            'mtime_ns': mtime_ns, 'inode': stat.st_ino}
+
+
+def hash_cache_file(key):
+
+    realpath = key['realpath']
+    if not isinstance(realpath, bytes):
+        realpath = realpath.encode('utf-8')
+
+    return os.path.join(hash_cachedir, hashlib.sha1(realpath).hexdigest() + '.json')
+
+
+def load_cached_hashes(key):
+    # Returns the digests cached for (key), or an empty dict when the file
+    # changed since they were computed.
+
+    cache_file = hash_cache_file(key)
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file) as input_file:
+                entry = json.load(input_file)
+        except (IOError, ValueError):
+            return {}
+
+        if entry.get('key') == key:
+            return entry.get('digests', {})
+
+    return {}
+
+
+def store_hashes(filename, digests):
+    # Records (digests) computed elsewhere, i.e while uploading (filename).
+    # The cache is only an optimization, failing to write it isn't an error.
+
+    try:
+        key = file_key(filename)
+        cached = load_cached_hashes(key)
+        cached.update(digests)
+
+        if not os.path.isdir(hash_cachedir):
+            os.makedirs(hash_cachedir)
+
+        cache_file = hash_cache_file(key)
+        with open(cache_file + '.%d.tmp' % os.getpid(), 'w') as output_file:
+            json.dump({'key': key, 'digests': cached}, output_file)
+
+        os.rename(cache_file + '.%d.tmp' % os.getpid(), cache_file)
+    except (IOError, OSError):
+        pass
+
+
+def hash_file(filename, algorithms=('sha1',), use_cache=True):
+    # Returns a dict with the hex digest of (filename) for every algorithm in
+    # (algorithms). Digests missing from the cache are computed together in a
+    # single read pass using one reusable buffer.
+
+    key = file_key(filename)
+    if use_cache:
+        digests = load_cached_hashes(key)
+    else:
+        digests = {}
+
+    missing = [algorithm for algorithm in algorithms if algorithm not in digests]
+    if missing:
+        checksums = [hashlib.new(algorithm) for algorithm in missing]
+        buffer = bytearray(block_size)
+        view = memoryview(buffer)
+
+        with metrics.phase('hashing') as current, open(filename, 'rb', 0) as file:
+            while True:
+                count = file.readinto(buffer)
+                if not count:
+                    break
+
+                for checksum in checksums:
+                    checksum.update(view[:count])
+                current.add(count)
+
+        for algorithm, checksum in zip(missing, checksums):
+            digests[algorithm] = checksum.hexdigest()
+
+        if use_cache:
+            store_hashes(filename, dict((algorithm, digests[algorithm]) for algorithm in missing))
+
+    return dict((algorithm, digests[algorithm]) for algorithm in algorithms)
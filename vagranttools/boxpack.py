@@ -0,0 +1,190 @@
+import struct, zlib, gzip, bz2, tarfile, multiprocessing
+from collections import deque
+try:
+    import lzma
+except ImportError:
+    # Python 2
+    lzma = None
+
+#-------------------------------------------------------------------------------
+#-- Block parallel gzip shared by vagrant-upload and vagrant-download
+#
+# A repacked box is a plain multi-member gzip of the box tar, so Vagrant and
+# any gzip reader can open it. Every member compresses member_size bytes on
+# its own and stores its compressed size in a "VB" extra field (like BGZF
+# does), which lets members be found and decompressed in parallel.
+
+member_size = 4 * 1024 * 1024
+default_level = 6
+header_size = 20
+trailer_size = 8
+
+#-------------------------------------------------------------------------------
+
+class ChunkReader(object):
+    # File-like object reading from an iterable of byte strings
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b''
+        self.offset = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.offset >= len(self.chunk):
+                try:
+                    self.chunk = next(self.chunks)
+                    self.offset = 0
+                except StopIteration:
+                    break
+                continue
+
+            if size < 0:
+                part = self.chunk[self.offset:]
+            else:
+                part = self.chunk[self.offset:self.offset + size]
+                size = size - len(part)
+
+            self.offset = self.offset + len(part)
+            parts.append(part)
+
+        return b''.join(parts)
+
+
+def compress_member(data, level=default_level):
+    # Returns (data) as a complete gzip member
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    size = header_size + len(body) + trailer_size
+
+    # FLG.FEXTRA, no mtime, unknown OS, one "VB" subfield with the member size
+    header = struct.pack('<BBBBIBBH', 0x1f, 0x8b, 8, 4, 0, 0, 255, 8) + b'VB' + struct.pack('<HI', 4, size)
+    trailer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+    return header + body + trailer
+
+
+def decompress_member(member):
+
+    data = zlib.decompress(member[header_size:-trailer_size], -zlib.MAX_WBITS)
+    crc, size = struct.unpack('<II', member[-trailer_size:])
+    if zlib.crc32(data) & 0xffffffff != crc or len(data) & 0xffffffff != size:
+        raise IOError("Corrupted gzip member")
+
+    return data
+
+
+def member_length(header):
+    # Returns the size of the member starting with (header) or None when it
+    # wasn't written by compress_member.
+
+    if len(header) < header_size:
+        return None
+
+    magic1, magic2, method, flags, mtime, xfl, os_type, xlen = struct.unpack('<BBBBIBBH', header[:12])
+    if (magic1, magic2, method, flags, xlen) != (0x1f, 0x8b, 8, 4, 8) or header[12:14] != b'VB':
+        return None
+
+    return struct.unpack('<HI', header[14:20])[1]
+
+
+def is_parallel_gzip(filename):
+
+    with open(filename, 'rb') as box:
+        return member_length(box.read(header_size)) is not None
+
+
+def ordered_map(pool, function, items, args=()):
+    # Yields function(item, *args) for every item, in order, computed on
+    # (pool) while keeping at most two tasks per process in flight so large
+    # inputs aren't read into memory at once.
+
+    window = 2 * (getattr(pool, '_processes', None) or multiprocessing.cpu_count())
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item,) + tuple(args)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def open_tar(filename):
+    # Returns the uncompressed tar stream of a box compressed with gzip, bzip2
+    # or xz, or not compressed. Raises ValueError for anything else, which
+    # would be repacked as it is and couldn't be extracted.
+
+    with open(filename, 'rb') as box:
+        magic = box.read(6)
+
+    if magic[:2] == b'\x1f\x8b':
+        return gzip.GzipFile(filename, 'rb')
+    elif magic[:3] == b'BZh':
+        return bz2.BZ2File(filename, 'rb')
+    elif magic == b'\xfd7zXZ\x00':
+        if lzma is None:
+            raise ValueError("xz compressed boxes can only be decompressed with Python 3")
+        return lzma.LZMAFile(filename, 'rb')
+    elif not tarfile.is_tarfile(filename):
+        raise ValueError("not a tar file nor a gzip, bzip2 or xz compressed one")
+
+    return open(filename, 'rb')
+
+
+def run_pool(function, items, args=(), processes=None):
+    # Runs ordered_map on its own pool. When the consumer or (items) fail or
+    # stop early the tasks still in flight, at most two per process, are
+    # waited for: terminate() can deadlock while the pool is still handing
+    # them to the workers.
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in ordered_map(pool, function, items, args):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def repack_chunks(filename, processes=None, level=default_level):
+    # Yields the box (filename) recompressed as block parallel gzip, its
+    # members compressed on a process pool across all cores.
+
+    source = open_tar(filename)
+    try:
+        blocks = iter(lambda: source.read(member_size), b'')
+        for member in run_pool(compress_member, blocks, (level,), processes):
+            yield member
+    finally:
+        source.close()
+
+
+def read_members(fileobj):
+    # Yields the complete members of a block parallel gzip
+
+    while True:
+        header = fileobj.read(header_size)
+        if not header:
+            return
+
+        size = member_length(header)
+        if size is None:
+            raise IOError("Not a block parallel gzip member")
+
+        body = fileobj.read(size - header_size)
+        if len(body) != size - header_size:
+            raise IOError("Truncated gzip member")
+
+        yield header + body
+
+
+def decompress_chunks(filename, processes=None):
+    # Yields the uncompressed content of a block parallel gzip (filename),
+    # its members decompressed on a process pool across all cores.
+
+    with open(filename, 'rb') as box:
+        for data in run_pool(decompress_member, read_members(box), (), processes):
+            yield data
@@ -0,0 +1,202 @@
+import re
+from bisect import bisect_left, bisect_right
+try:
+    basestring_type = basestring
+except NameError:
+    basestring_type = str
+
+#-------------------------------------------------------------------------------
+#-- Box version index shared by vagrant-upload and vagrant-download
+#
+# Versions are ordered like Vagrant (RubyGems) does: numeric segments compare
+# as numbers, trailing zeros don't count ("1.0" == "1") and a version with a
+# letter is a prerelease older than the release ("1.0.rc1" < "1.0").
+# Constraints use Vagrant's syntax, a comma separated list of "op version"
+# with =, !=, >, <, >=, <= and ~> (pessimistic, "~> 1.2" is ">= 1.2, < 2.0").
+
+segment_pattern = re.compile(r'[0-9]+|[a-z]+', re.IGNORECASE)
+constraint_pattern = re.compile(r'^\s*(=|!=|>=|<=|>|<|~>)?\s*([0-9A-Za-z.\-+]+)\s*$')
+# Sorts after any prerelease (string) segment and before any number, it ends
+# every key so that a missing segment behaves like a zero.
+end_of_version = (1,)
+
+#-------------------------------------------------------------------------------
+
+def split_version(version):
+    # Returns the release (numbers) and prerelease segments of (version)
+
+    segments = [int(part) if part.isdigit() else part
+                for part in segment_pattern.findall(str(version))]
+    if not segments:
+        raise ValueError("Invalid version %r" % version)
+
+    for index, segment in enumerate(segments):
+        if not isinstance(segment, int):
+            return segments[:index], segments[index:]
+
+    return segments, []
+
+
+def version_segments(version):
+    # Returns the canonical segments of (version), trailing zeros of the
+    # release and prerelease parts removed.
+
+    release, prerelease = split_version(version)
+
+    while len(release) > 1 and release[-1] == 0:
+        release = release[:-1]
+    while prerelease and prerelease[-1] == 0:
+        prerelease = prerelease[:-1]
+
+    return release + prerelease
+
+
+def version_key(version):
+    # Sort key of (version)
+
+    return tuple((2, segment) if isinstance(segment, int) else (0, segment)
+                 for segment in version_segments(version)) + (end_of_version,)
+
+
+def pessimistic_bound(version):
+    # "~> 1.2.3" allows versions below 1.3, "~> 1.2" below 2
+
+    release = split_version(version)[0]
+    if not release:
+        raise ValueError("Invalid pessimistic constraint ~> %s" % version)
+    if len(release) > 1:
+        release = release[:-1]
+    release[-1] = release[-1] + 1
+
+    return version_key('.'.join(str(segment) for segment in release))
+
+
+def parse_constraints(constraints):
+    # Returns [(op, key), ...] for a constraint string like ">= 1.2, < 2.0".
+    # A bare version means "= version". Raises ValueError when it's invalid.
+
+    parsed = []
+    for constraint in str(constraints).split(','):
+        match = constraint_pattern.match(constraint)
+        if match is None:
+            raise ValueError("Invalid version constraint %r" % constraint.strip())
+
+        op = match.group(1) or '='
+        version = match.group(2)
+        if op == '~>':
+            parsed.append(('>=', version_key(version)))
+            parsed.append(('<', pessimistic_bound(version)))
+        else:
+            parsed.append((op, version_key(version)))
+
+    return parsed
+
+
+class VersionIndex(object):
+    # Index of a metadata.json document, built once and then queried with
+    # bisect. For every provider it keeps the keys of the versions offering
+    # it in order, next to the matching (version, provider entry) pairs, once
+    # for all versions and once for releases only.
+
+    def __init__(self, metadata):
+        versions = {}
+        for entry in metadata.get('versions', []):
+            key = version_key(entry['version'])
+            for provider in entry.get('providers', []):
+                versions.setdefault(provider['name'], {})[key] = (entry['version'], provider)
+
+        self.keys = {}
+        self.boxes = {}
+        self.release_keys = {}
+        self.release_boxes = {}
+        for name, boxes in versions.items():
+            self.keys[name] = sorted(boxes)
+            self.boxes[name] = [boxes[key] for key in self.keys[name]]
+            self.release_keys[name] = [key for key in self.keys[name]
+                                       if all(segment[0] != 0 for segment in key)]
+            self.release_boxes[name] = [boxes[key] for key in self.release_keys[name]]
+
+        # Newest version published, releases preferred
+        self.newest = None
+        entries = sorted((version_key(entry['version']), entry['version'])
+                         for entry in metadata.get('versions', []))
+        releases = [entry for entry in entries if all(segment[0] != 0 for segment in entry[0])]
+        if entries:
+            self.newest = (releases or entries)[-1][1]
+
+    def providers(self):
+
+        return sorted(self.keys)
+
+    def versions(self, provider):
+        # Versions offering (provider), oldest first
+
+        return [version for version, box in self.boxes.get(provider, [])]
+
+    def bounds(self, keys, constraints):
+        # Returns the slice of the sorted (keys) allowed by the range
+        # constraints, != is left to the caller.
+
+        low = 0
+        high = len(keys)
+        for op, key in constraints:
+            if op == '=':
+                low = max(low, bisect_left(keys, key))
+                high = min(high, bisect_right(keys, key))
+            elif op == '>=':
+                low = max(low, bisect_left(keys, key))
+            elif op == '>':
+                low = max(low, bisect_right(keys, key))
+            elif op == '<=':
+                high = min(high, bisect_right(keys, key))
+            elif op == '<':
+                high = min(high, bisect_left(keys, key))
+
+        return low, high
+
+    def latest(self, provider, constraints=None):
+        # Returns (version, provider entry) of the newest version offering
+        # (provider) that satisfies (constraints), or None. Prereleases are
+        # only picked when no release matches.
+
+        if isinstance(constraints, basestring_type):
+            constraints = parse_constraints(constraints)
+        constraints = constraints or []
+
+        excluded = set(key for op, key in constraints if op == '!=')
+
+        # Releases first, prereleases only when no release matches
+        for keys, boxes in ((self.release_keys, self.release_boxes), (self.keys, self.boxes)):
+            keys = keys.get(provider, [])
+            low, high = self.bounds(keys, constraints)
+            for index in range(high - 1, low - 1, -1):
+                if keys[index] not in excluded:
+                    return boxes[provider][index]
+
+        return None
+
+    def matching(self, provider, constraints=None):
+        # Returns every (version, provider entry) of (provider) that satisfies
+        # (constraints), prereleases included, oldest first.
+
+        if isinstance(constraints, basestring_type):
+            constraints = parse_constraints(constraints)
+        constraints = constraints or []
+
+        excluded = set(key for op, key in constraints if op == '!=')
+        keys = self.keys.get(provider, [])
+        low, high = self.bounds(keys, constraints)
+
+        return [self.boxes[provider][index] for index in range(low, high) if keys[index] not in excluded]
+
+    def find(self, version, provider):
+        # Returns the entry of (provider) for exactly (version), or None
+
+        keys = self.keys.get(provider, [])
+        key = version_key(version)
+        index = bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            return self.boxes[provider][index][1]
+
+        return None
+
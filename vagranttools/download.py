@@ -0,0 +1,985 @@
+from __future__ import print_function
+
+import os, time, tempfile, re, json, shutil, hashlib, tarfile, threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from urllib2 import Request, urlopen, URLError, HTTPError
+    from urlparse import urlsplit
+    from Queue import Queue, Empty
+    from httplib import HTTPException
+    string_types = basestring
+except ImportError:
+    from urllib.request import Request, urlopen
+    from urllib.error import URLError, HTTPError
+    from urllib.parse import urlsplit
+    from queue import Queue, Empty
+    from http.client import HTTPException
+    string_types = str
+from vagranttools.boxhash import TeeReader, checksum_types
+from vagranttools.boxextract import extract_box, extract_tar
+from vagranttools.boxversion import VersionIndex, version_key
+from vagranttools.errors import DownloadError
+from vagranttools import metrics
+
+#-------------------------------------------------------------------------------
+#-- Download settings
+
+default_provider = "virtualbox"
+vm_providers = ['vmware_workstation', 'vmware_fusion', 'virtualbox',
+                'docker', 'hyperv']
+block_size = 8192
+hash_block_size = 1024 * 1024
+segment_size = 8 * 1024 * 1024
+segment_retries = 3
+default_connections = 4
+default_cachesize = 20480 * 1024 * 1024
+# Seconds without receiving data before a connection is considered stalled
+stall_timeout = 30
+probe_timeout = 10
+probe_size = 256 * 1024
+metadata_cachedir = os.path.join(os.path.expanduser("~"), ".vagrant-tools", "metadata")
+# ioctl used to reflink files on btrfs/xfs
+FICLONE = 0x40049409
+# Progress messages are printed unless the caller turns them off
+verbose = True
+# RateLimit shared by every download, None for no limit
+rate_limit = None
+
+#-------------------------------------------------------------------------------
+
+class RateLimit(object):
+    # Token bucket capping the bytes per second read by all the threads
+    # sharing it. Readers take what they read and sleep off the debt, so the
+    # total rate stays at (rate) whatever the number of connections.
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.burst = max(block_size, self.rate / 10)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate) - count
+            self.last = now
+            debt = -self.tokens
+
+        if debt > 0:
+            time.sleep(debt / self.rate)
+
+class RateLimitedReader(object):
+    # File-like wrapper around (stream) reading within the global rate_limit
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def read(self, size=-1):
+        buffer = self.stream.read(size)
+        if rate_limit is not None:
+            rate_limit.consume(len(buffer))
+
+        return buffer
+
+    def close(self):
+        self.stream.close()
+
+def limited(response):
+
+    if rate_limit is None:
+        return response
+
+    return RateLimitedReader(response)
+
+def notify(message):
+
+    if verbose:
+        metrics.clear_progress()
+        print(message)
+
+def is_json(json_string):
+  try:
+    json_object = json.loads(json_string)
+  except ValueError as e:
+    return False
+  return True
+
+def move_into(source, destination):
+    # Moves the content of (source) into (destination), merging directories
+    # that already exist there.
+
+    for name in os.listdir(source):
+        src = os.path.join(source, name)
+        dst = os.path.join(destination, name)
+        if os.path.isdir(dst) and not os.path.islink(dst) and os.path.isdir(src):
+            move_into(src, dst)
+        else:
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                shutil.rmtree(dst)
+            os.rename(src, dst)
+
+def report_extraction(stats):
+
+    if stats['size']:
+        saved = 100.0 * (stats['size'] - stats['written']) / stats['size']
+    else:
+        saved = 0
+    notify("Extracted %d files, %.1f MB written for %.1f MB of data (%.0f%% left as holes)" %
+           (stats['files'], stats['written'] / 1024.0 / 1024, stats['size'] / 1024.0 / 1024, saved))
+
+def decompress_box(box, outputdir=None):
+    # Zero blocks of the disk images are left as holes and large members of
+    # uncompressed boxes are extracted concurrently, see boxextract
+
+    try:
+        with metrics.phase('extraction') as current:
+            stats = extract_box(box, outputdir)
+            current.add(stats['size'])
+    except (IOError, OSError, tarfile.TarError) as e:
+        raise DownloadError("Error extracting box: %s" % e)
+    report_extraction(stats)
+
+    return stats
+
+def metadata_cache_file(url):
+
+    return os.path.join(metadata_cachedir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+def load_cached_metadata(url):
+    # Returns the cache entry stored for (url) or None
+
+    cache_file = metadata_cache_file(url)
+    if os.path.isfile(cache_file):
+        with open(cache_file) as input_file:
+            output = input_file.read()
+
+        if is_json(output):
+            entry = json.loads(output)
+            if entry.get('url') == url:
+                return entry
+
+    return None
+
+def save_cached_metadata(url, entry):
+    # The cache is only an optimization, failing to write it isn't an error
+
+    cache_file = metadata_cache_file(url)
+    try:
+        if not os.path.isdir(metadata_cachedir):
+            os.makedirs(metadata_cachedir)
+
+        with open(cache_file + '.tmp', 'w') as output_file:
+            json.dump(entry, output_file)
+
+        os.rename(cache_file + '.tmp', cache_file)
+    except (IOError, OSError):
+        pass
+
+def is_fresh(cached, max_age):
+    # While the cache is younger than (max_age) seconds no request is made
+
+    return cached is not None and max_age is not None and time.time() - cached.get('fetched', 0) < max_age
+
+def conditional_headers(cached):
+    # Request headers revalidating the (cached) entry
+
+    headers = {}
+    if cached is not None:
+        if cached.get('etag') is not None:
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified') is not None:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    return headers
+
+def revalidated_metadata(url, cached):
+    # The server answered 304 Not Modified, returns the (cached) metadata
+
+    cached['fetched'] = time.time()
+    save_cached_metadata(url, cached)
+
+    return cached['metadata']
+
+def cache_metadata(url, metadata, etag, last_modified):
+    # Stores (metadata) just received with the validators of the response
+
+    save_cached_metadata(url, {'url': url, 'fetched': time.time(), 'etag': etag,
+                               'last_modified': last_modified, 'metadata': metadata})
+
+def read_metadata(url, max_age=None):
+    # Metadata is cached on disk with its ETag and Last-Modified headers, so
+    # following requests are conditional and a 304 reuses the cached copy.
+    # While the cache is younger than (max_age) seconds no request is made.
+    # Raises HTTPError/URLError when the metadata can't be fetched and
+    # ValueError when it isn't JSON.
+
+    cached = load_cached_metadata(url)
+    if is_fresh(cached, max_age):
+        return cached['metadata']
+
+    try:
+        response = urlopen(Request(url, headers=conditional_headers(cached)), timeout=stall_timeout)
+    except HTTPError as e:
+        if e.code == 304 and cached is not None:
+            return revalidated_metadata(url, cached)
+        raise
+
+    output = response.read().decode("utf-8")
+    if not is_json(output):
+        raise ValueError("URL isn't a valid JSON file")
+
+    metadata = json.loads(output)
+    cache_metadata(url, metadata, response.info().get('ETag'), response.info().get('Last-Modified'))
+
+    return metadata
+
+def metadata_error(e):
+    # Returns the error explaining why the metadata couldn't be fetched
+
+    if isinstance(e, HTTPError):
+        if e.code == 404:
+            return DownloadError("METADATA NOT FOUND")
+        return DownloadError("--->>>> Couldn't connect to server to get current metadata. <<<<---\n"
+                             "Server failed to fulfill request. Error code: %s" % e.code)
+    elif isinstance(e, URLError):
+        return DownloadError("--->>>> Couldn't connect to server to get current metadata. <<<<---\n"
+                             "Failed to connect to server. Reason: %s" % e.reason)
+    elif isinstance(e, ValueError):
+        return DownloadError("--->>>> URL isn't a valid JSON file, please check URL. <<<<---")
+
+    return DownloadError("--->>>> Couldn't connect to server to get current metadata. <<<<---\n"
+                         "Reason: %s" % e)
+
+def get_metadata(url, max_age=None):
+
+    try:
+        with metrics.phase('metadata'):
+            metadata = read_metadata(url, max_age)
+    except (URLError, ValueError) as e:
+        raise metadata_error(e)
+
+    return metadata
+
+def run_concurrently(function, items):
+    # Calls (function) for every item on its own thread and waits for them
+
+    threads = []
+    for item in items:
+        thread = threading.Thread(target=function, args=(item,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+
+def probe_mirrors(urls):
+    # Sends a HEAD request for the metadata of every mirror concurrently and
+    # returns the mirrors that answered, lowest latency first.
+
+    results = []
+
+    def probe(url):
+        request = Request(url)
+        request.get_method = lambda: 'HEAD'
+        start = time.time()
+        try:
+            urlopen(request, timeout=probe_timeout).close()
+        except (IOError, HTTPException):
+            return
+        results.append((time.time() - start, url))
+
+    run_concurrently(probe, urls)
+
+    return [url for latency, url in sorted(results)]
+
+def rank_box_urls(urls):
+    # Downloads the first probe_size bytes of the box from every mirror
+    # concurrently and returns the mirrors that answered, fastest first.
+
+    results = []
+
+    def probe(url):
+        start = time.time()
+        count = 0
+        try:
+            response = urlopen(Request(url, headers={'Range': 'bytes=0-%d' % (probe_size - 1)}),
+                               timeout=probe_timeout)
+            while count < probe_size:
+                buffer = response.read(min(block_size, probe_size - count))
+                if not buffer:
+                    break
+                count = count + len(buffer)
+            response.close()
+        except (IOError, HTTPException):
+            return
+        results.append((count / max(time.time() - start, 0.000001), url))
+
+    run_concurrently(probe, urls)
+
+    return [url for throughput, url in sorted(results, reverse=True)]
+
+def get_mirror_metadata(urls, max_age=None):
+    # Returns the metadata URL used and its metadata. With several mirrors
+    # they are tried from the lowest latency one until one serves it.
+
+    if len(urls) == 1:
+        return urls[0], get_metadata(urls[0], max_age)
+
+    ranked = probe_mirrors(urls)
+    for url in ranked + [url for url in urls if url not in ranked]:
+        try:
+            with metrics.phase('metadata'):
+                return url, read_metadata(url, max_age)
+        except (IOError, ValueError, HTTPException) as e:
+            notify("Couldn't get metadata from %s (%s), trying next mirror" % (url, e))
+
+    raise DownloadError("--->>>> Couldn't get current metadata from any mirror. <<<<---")
+
+def mirror_base(url):
+    # http://host/vagrant/company/name/metadata.json and
+    # http://host/vagrant/company/name share the same base
+
+    if url.endswith('.json'):
+        return url.rsplit('/', 1)[0] + '/'
+
+    return url.rstrip('/') + '/'
+
+def mirror_urls(box_url, mirrors):
+    # Maps the box URL to every mirror. Mirrors share the same layout below
+    # the metadata URL, the box is published below one of them.
+
+    for mirror in mirrors:
+        base = mirror_base(mirror)
+        if box_url.startswith(base):
+            break
+    else:
+        return [box_url]
+
+    urls = []
+    for mirror in mirrors:
+        if mirror_base(mirror) + box_url[len(base):] not in urls:
+            urls.append(mirror_base(mirror) + box_url[len(base):])
+
+    return urls
+
+def get_latestbox(metadata, selected_provider, constraints=None):
+    # Returns the newest box of (selected_provider) matching (constraints),
+    # i.e ">= 1.2, < 2.0", or None. Versions are compared like Vagrant does
+    # and the newest version that has the provider is used even when a newer
+    # version only has other providers.
+
+    index = VersionIndex(metadata)
+    found = index.latest(selected_provider, constraints)
+    if found is None:
+        return None
+
+    version, box = found
+    if constraints is None and version_key(version) != version_key(index.newest):
+        notify("Version %s has no %s box, using version %s" % (index.newest, selected_provider, version))
+
+    return box
+
+def select_box(metadata, selected_provider, mirrors=(), constraints=None):
+    # Returns the latest box for (selected_provider). With several mirrors
+    # box['urls'] lists the box on every mirror, fastest first.
+
+    try:
+        box = get_latestbox(metadata, selected_provider, constraints)
+    except (ValueError, KeyError) as e:
+        raise DownloadError("Invalid box version: %s" % e)
+
+    if box is None:
+        if constraints is None:
+            raise DownloadError("No %s box found" % selected_provider)
+        raise DownloadError("No %s box found matching version %s" % (selected_provider, constraints))
+
+    if len(mirrors) > 1:
+        urls = mirror_urls(box['url'], mirrors)
+        if len(urls) > 1:
+            ranked = rank_box_urls(urls)
+            box['urls'] = ranked + [url for url in urls if url not in ranked]
+
+    return box
+
+def box_error(e):
+    # Returns the error explaining why the box couldn't be downloaded
+
+    if isinstance(e, HTTPError):
+        if e.code == 404:
+            return DownloadError("BOX FILE NOT FOUND!")
+        return DownloadError("--->>>> Couldn't connect to server to get box file. <<<<---\n"
+                             "Server failed to fulfill request. Error code: %s" % e.code)
+    elif isinstance(e, URLError):
+        return DownloadError("--->>>> Couldn't connect to server to get box file. <<<<---\n"
+                             "Failed to connect to server. Reason: %s" % e.reason)
+
+    return DownloadError("--->>>> Couldn't download box file. <<<<---\n"
+                         "Reason: %s" % e)
+
+def probe_box(url):
+    # Asks for the first byte of (url). Returns (None, size, validator) when
+    # the server honours Range requests, or (response, None, None) with the
+    # full body stream when it doesn't.
+
+    response = urlopen(Request(url, headers={'Range': 'bytes=0-0'}), timeout=stall_timeout)
+
+    if response.getcode() == 206:
+        content_range = response.info().get('Content-Range') or ''
+        match = re.match(r'bytes\s+0-0/(\d+)$', content_range.strip())
+        if match is not None:
+            validator = response.info().get('ETag') or \
+                        response.info().get('Last-Modified')
+            response.close()
+            return None, int(match.group(1)), validator
+
+        # Unknown total size, start again as a single stream
+        response.close()
+        response = urlopen(url, timeout=stall_timeout)
+
+    return response, None, None
+
+def load_journal(journal, identity, size):
+    # Returns the set of segments already completed according to (journal)
+    # if it belongs to the same remote file, otherwise an empty set.
+
+    if os.path.isfile(journal):
+        with open(journal) as journal_file:
+            output = journal_file.read()
+
+        if is_json(output):
+            state = json.loads(output)
+            if state.get('identity') == identity and state.get('size') == size and \
+               state.get('segment_size') == segment_size:
+                return set(state.get('done', []))
+
+    return set()
+
+def save_journal(journal, identity, size, done):
+
+    with open(journal + '.tmp', 'w') as journal_file:
+        json.dump({'identity': identity, 'size': size,
+                   'segment_size': segment_size, 'done': sorted(done)},
+                  journal_file)
+
+    os.rename(journal + '.tmp', journal)
+
+def get_segment(url, fullpath, start, end, current=None):
+    # Downloads bytes (start)-(end) of (url) into the same offset of (fullpath)
+    # counting them in the (current) phase
+
+    response = urlopen(Request(url, headers={'Range': 'bytes=%d-%d' % (start, end)}),
+                       timeout=stall_timeout)
+    if response.getcode() != 206:
+        raise IOError("Server ignored range request")
+    if current is not None:
+        response = metrics.metered(response, current)
+    response = limited(response)
+
+    with open(fullpath, 'r+b') as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            buffer = response.read(min(block_size, remaining))
+            if not buffer:
+                raise IOError("Connection closed before end of segment")
+
+            file.write(buffer)
+            remaining = remaining - len(buffer)
+
+    response.close()
+
+def get_box_ranged(urls, fullpath, size, identity, digest=None, connections=default_connections, current=None):
+    # Downloads the box as segment_size byte ranges on (connections) threads
+    # into a preallocated (fullpath). Completed segments are recorded in a
+    # journal next to the file so an interrupted download is resumed. Segments
+    # are hashed in order as soon as the preceding ones are on disk. When a
+    # mirror in (urls) keeps failing or stalls the next one takes over.
+
+    journal = fullpath + '.journal'
+    segments = range(0, (size + segment_size - 1) // segment_size)
+
+    if os.path.isfile(fullpath) and os.path.getsize(fullpath) == size:
+        done = load_journal(journal, identity, size)
+    else:
+        done = set()
+
+    if not done:
+        remove_output(fullpath)
+        with open(fullpath, 'wb') as file:
+            file.truncate(size)
+        save_journal(journal, identity, size, done)
+    else:
+        notify("Resuming download, %d of %d segments already downloaded" % (len(done), len(segments)))
+
+    pending = Queue()
+    for index in segments:
+        if index not in done:
+            pending.put(index)
+
+    condition = threading.Condition()
+    errors = []
+    mirror = {'index': 0}
+
+    def worker():
+        while not errors:
+            try:
+                index = pending.get_nowait()
+            except Empty:
+                return
+
+            start = index * segment_size
+            end = min(size, start + segment_size) - 1
+            while True:
+                with condition:
+                    active = mirror['index']
+
+                for attempt in range(segment_retries):
+                    try:
+                        get_segment(urls[active], fullpath, start, end, current)
+                        break
+                    except (IOError, HTTPException) as e:
+                        error = e
+                else:
+                    with condition:
+                        if mirror['index'] == active:
+                            mirror['index'] = active + 1
+                            if mirror['index'] < len(urls):
+                                notify("Mirror failed (%s), switching to %s" % (error, urls[mirror['index']]))
+
+                        if mirror['index'] >= len(urls):
+                            errors.append(error)
+                            condition.notify_all()
+                            return
+                    continue
+
+                break
+
+            with condition:
+                done.add(index)
+                save_journal(journal, identity, size, done)
+                condition.notify_all()
+
+    threads = []
+    for i in range(max(1, connections)):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    hashing = [0.0, 0]
+    with open(fullpath, 'rb') as file:
+        for index in segments:
+            with condition:
+                while index not in done and not errors:
+                    condition.wait(1)
+
+            if errors:
+                break
+
+            if digest is not None:
+                started = time.time()
+                file.seek(index * segment_size)
+                remaining = min(size, (index + 1) * segment_size) - index * segment_size
+                while remaining > 0:
+                    buffer = file.read(min(hash_block_size, remaining))
+                    digest.update(buffer)
+                    remaining = remaining - len(buffer)
+                    hashing[1] = hashing[1] + len(buffer)
+                hashing[0] = hashing[0] + time.time() - started
+
+    for thread in threads:
+        thread.join()
+
+    # Segments are hashed while the next ones download, only the time spent
+    # hashing is counted
+    if digest is not None:
+        metrics.record('checksum', hashing[0], hashing[1])
+
+    if errors:
+        raise DownloadError("--->>>> Couldn't download box file, run again to resume. <<<<---\n"
+                            "Failed to download segment. Reason: %s" % errors[0])
+
+    os.remove(journal)
+
+def get_box(url, output_dir=None, checksum_type=None, checksum=None, connections=default_connections):
+    # Downloads (url) into (output_dir) validating it against (checksum).
+    # Servers honouring Range requests are downloaded in parallel segments,
+    # otherwise the box is streamed and hashed as it is written. (url) may
+    # also be a list of mirrors of the box, tried in order on failures.
+
+    if isinstance(url, string_types):
+        urls = [url]
+    else:
+        urls = list(url)
+
+    if output_dir is None:
+        output_dir = os.getcwd()
+
+    if checksum_type is not None:
+        if checksum_type.lower() not in checksum_types:
+            raise DownloadError("Checksum not supported")
+        digest = hashlib.new(checksum_type.lower())
+    else:
+        digest = None
+
+    output_file = os.path.basename(urlsplit(urls[0]).path)
+    fullpath = output_dir + '/' + output_file
+
+    with metrics.phase('download') as current:
+        for index, url in enumerate(urls):
+            try:
+                response, size, validator = probe_box(url)
+                break
+            except (IOError, HTTPException) as e:
+                if index + 1 == len(urls):
+                    raise box_error(e)
+                notify("Mirror failed (%s), switching to %s" % (e, urls[index + 1]))
+
+        if response is None:
+            # Mirrors serve the same box, a checksum identifies it across them
+            if checksum is not None:
+                identity = checksum_type.lower() + ':' + checksum.lower()
+            else:
+                identity = url + ' ' + str(validator)
+            get_box_ranged(urls[index:], fullpath, size, identity, digest, connections, current)
+        else:
+            while True:
+                try:
+                    if response is None:
+                        response = urlopen(urls[index], timeout=stall_timeout)
+                    response = limited(metrics.metered(response, current))
+
+                    remove_output(fullpath)
+                    with open(fullpath, 'wb') as file:
+                        while True:
+                            buffer = response.read(block_size)
+                            if not buffer:
+                                break
+
+                            file.write(buffer)
+                            if digest is not None:
+                                digest.update(buffer)
+
+                        file.close()
+                    break
+                except (IOError, HTTPException) as e:
+                    response = None
+                    index = index + 1
+                    if index == len(urls):
+                        if os.path.isfile(fullpath):
+                            os.remove(fullpath)
+                        raise box_error(e)
+
+                    notify("Mirror failed (%s), switching to %s" % (e, urls[index]))
+                    if digest is not None:
+                        digest = hashlib.new(checksum_type.lower())
+
+    if digest is not None and checksum is not None:
+        if digest.hexdigest() != checksum.lower():
+            os.remove(fullpath)
+            raise DownloadError("Box file checksum not valid")
+
+    return fullpath
+
+def cache_entry(cachedir, box):
+    # Cache entries are addressed by the checksum published in the metadata
+
+    return os.path.join(cachedir, box['checksum_type'].lower(), box['checksum'].lower())
+
+def remove_output(fullpath):
+    # Boxes are written to a new file instead of over an existing one, which
+    # may be shared with another file (i.e a hard link made by the user)
+
+    if os.path.lexists(fullpath):
+        os.remove(fullpath)
+
+def clone_or_copy(source, destination):
+    # Reflinks (source) to (destination) on filesystems supporting it and
+    # falls back to a plain copy. Hardlinks aren't used so the cache and the
+    # boxes served from it never share data: writing over one can't corrupt
+    # the other and evicting an entry frees its space.
+
+    remove_output(destination)
+
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            if fcntl is None:
+                raise IOError("Reflinks not supported")
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except (IOError, OSError):
+            shutil.copyfileobj(src, dst, hash_block_size)
+
+def evict_cache(cachedir, limit):
+    # Removes least recently used entries until the cache holds at most
+    # (limit) bytes.
+
+    entries = []
+    total = 0
+    for checksum_type in checksum_types:
+        directory = os.path.join(cachedir, checksum_type)
+        if not os.path.isdir(directory):
+            continue
+
+        for name in os.listdir(directory):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(directory, name)))
+            total = total + stat.st_size
+
+    for mtime, size, entry in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+        total = total - size
+
+def lookup_cache(box, cachedir):
+    # Returns the cache entry of (box) or None on a cache miss
+
+    entry = cache_entry(cachedir, box)
+    if not os.path.isfile(entry):
+        return None
+
+    # Entries are evicted by modification time, mark this one as used
+    os.utime(entry, None)
+
+    return entry
+
+def get_cached_box(box, cachedir, output_dir=None):
+    # Serves (box) from the cache into (output_dir). Returns the path of the
+    # box or None on a cache miss.
+
+    if output_dir is None:
+        output_dir = os.getcwd()
+
+    entry = lookup_cache(box, cachedir)
+    if entry is None:
+        return None
+
+    fullpath = output_dir + '/' + os.path.basename(urlsplit(box['url']).path)
+    with metrics.phase('cache') as current:
+        clone_or_copy(entry, fullpath)
+        current.add(os.path.getsize(fullpath))
+
+    return fullpath
+
+def cache_box(boxfile, box, cachedir, cachesize=default_cachesize):
+    # Inserts an already validated (boxfile) in the cache. The entry is staged
+    # under a temporary name and renamed into place so concurrent runs never
+    # see a partial box.
+
+    entry = cache_entry(cachedir, box)
+    if os.path.isfile(entry):
+        os.utime(entry, None)
+        return
+
+    size = os.path.getsize(boxfile)
+    if size > cachesize:
+        return
+
+    evict_cache(cachedir, cachesize - size)
+
+    if not os.path.isdir(os.path.dirname(entry)):
+        try:
+            os.makedirs(os.path.dirname(entry))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(entry)):
+                raise
+
+    staging = "%s.%d.tmp" % (entry, os.getpid())
+    clone_or_copy(boxfile, staging)
+    os.rename(staging, entry)
+
+def fetch_box(box, output_dir=None, connections=default_connections, cachedir=None, cachesize=default_cachesize):
+    # Returns the path of (box) in (output_dir), serving it from the cache
+    # when possible and adding it to the cache once downloaded.
+
+    if cachedir is not None and box['checksum_type'].lower() in checksum_types:
+        boxfile = get_cached_box(box, cachedir, output_dir)
+        if boxfile is not None:
+            notify("Box served from cache")
+            return boxfile
+
+    boxfile = get_box(box.get('urls', box['url']), output_dir, box['checksum_type'], box['checksum'], connections)
+
+    if cachedir is not None:
+        # The cache is only an optimization, the box was downloaded anyway
+        try:
+            cache_box(boxfile, box, cachedir, cachesize)
+        except (IOError, OSError) as e:
+            notify("Couldn't add box to cache: %s" % e)
+
+    notify("Box downloaded and validated")
+
+    return boxfile
+
+def get_box_extracted(url, output_dir=None, checksum_type=None, checksum=None, keep=False):
+    # Extracts (url) while it is downloaded. The HTTP stream is read by
+    # tarfile in stream mode and hashed at the same time, members land in a
+    # staging directory that is only moved into (output_dir) once the
+    # checksum matches. With (keep) the .box is also written to (output_dir).
+    # (url) may also be a list of mirrors, a failing one is replaced by the
+    # next and the extraction starts over.
+
+    if isinstance(url, string_types):
+        urls = [url]
+    else:
+        urls = list(url)
+
+    if output_dir is None:
+        output_dir = os.getcwd()
+
+    if checksum_type is not None and checksum_type.lower() not in checksum_types:
+        raise DownloadError("Checksum not supported")
+
+    fullpath = output_dir + '/' + os.path.basename(urlsplit(urls[0]).path)
+
+    for index, url in enumerate(urls):
+        if checksum_type is not None:
+            digest = hashlib.new(checksum_type.lower())
+        else:
+            digest = None
+
+        staging = tempfile.mkdtemp(prefix='.extract-', dir=output_dir)
+        if keep:
+            remove_output(fullpath)
+        copy = open(fullpath, 'wb') if keep else None
+        try:
+            # Extraction runs as the stream is read, both are one phase
+            with metrics.phase('download') as current:
+                response = urlopen(url, timeout=stall_timeout)
+                reader = TeeReader(limited(metrics.metered(response, current)), digest, copy)
+                tar = tarfile.open(fileobj=reader, mode='r|*')
+                stats = extract_tar(tar, staging)
+                tar.close()
+
+                # tarfile stops at the end of archive marker, hash the padding too
+                while reader.read(block_size):
+                    pass
+        except (IOError, OSError, tarfile.TarError, HTTPException) as e:
+            shutil.rmtree(staging)
+            if copy is not None:
+                copy.close()
+                os.remove(fullpath)
+
+            if index + 1 < len(urls):
+                notify("Mirror failed (%s), switching to %s" % (e, urls[index + 1]))
+                continue
+
+            raise box_error(e)
+
+        if copy is not None:
+            copy.close()
+        break
+
+    if digest is not None and checksum is not None:
+        if digest.hexdigest() != checksum.lower():
+            shutil.rmtree(staging)
+            if copy is not None:
+                os.remove(fullpath)
+            raise DownloadError("Box file checksum not valid")
+
+    move_into(staging, output_dir)
+    os.rmdir(staging)
+    report_extraction(stats)
+
+    if keep:
+        return fullpath
+
+def fetch_extracted_box(box, output_dir=None, keep=False, cachedir=None, cachesize=default_cachesize):
+    # Extracts (box) into (output_dir) without storing the .box file unless
+    # (keep) is set. Cached boxes are extracted from the cache entry itself,
+    # only copied to (output_dir) when kept. Returns the path of the kept
+    # .box or None.
+
+    if cachedir is not None and box['checksum_type'].lower() in checksum_types:
+        if keep:
+            boxfile = get_cached_box(box, cachedir, output_dir)
+            if boxfile is not None:
+                notify("Box served from cache")
+                decompress_box(boxfile, output_dir)
+                return boxfile
+        else:
+            entry = lookup_cache(box, cachedir)
+            if entry is not None:
+                notify("Box served from cache")
+                decompress_box(entry, output_dir)
+                return None
+
+    boxfile = get_box_extracted(box.get('urls', box['url']), output_dir, box['checksum_type'], box['checksum'], keep)
+
+    if boxfile is not None and cachedir is not None:
+        # The cache is only an optimization, the box was extracted anyway
+        try:
+            cache_box(boxfile, box, cachedir, cachesize)
+        except (IOError, OSError) as e:
+            notify("Couldn't add box to cache: %s" % e)
+
+    notify("Box downloaded, validated and extracted")
+
+    return boxfile
+
+#-------------------------------------------------------------------------------
+#-- Library API
+
+def fetch_metadata(url, max_age=None):
+    # Returns the metadata of a box. (url) may also be a list of mirrors of
+    # the metadata, the lowest latency one serving it is used and box URLs
+    # resolved from it are mapped to every mirror.
+
+    if isinstance(url, string_types):
+        urls = [url]
+    else:
+        urls = list(url)
+
+    metadata_url, metadata = get_mirror_metadata(urls, max_age)
+
+    return metadata
+
+def resolve_box(metadata, provider=default_provider, version=None, mirrors=()):
+    # Returns the box of (provider) matching the (version) constraints, the
+    # latest one by default. (mirrors) are the metadata URLs the metadata
+    # was fetched from, with several of them box['urls'] lists the box on
+    # every mirror, fastest first.
+
+    if provider.lower() not in vm_providers:
+        raise DownloadError("Provider %s isn't supported" % provider)
+
+    if isinstance(mirrors, string_types):
+        mirrors = [mirrors]
+
+    return select_box(metadata, provider.lower(), list(mirrors), version)
+
+def download_box(box, output_dir=None, extract=False, stream=False, keep=False,
+                 connections=default_connections, cachedir=None, cachesize=default_cachesize):
+    # Downloads and validates (box), as returned by resolve_box, into
+    # (output_dir). With (extract) it is also decompressed there, while it is
+    # downloaded with (stream), and removed afterwards unless (keep) is set.
+    # Returns the path of the .box file, or None when it wasn't kept.
+
+    if output_dir is not None and not os.path.isdir(output_dir):
+        raise DownloadError("Outputdir isn't a valid path")
+
+    if extract and stream:
+        return fetch_extracted_box(box, output_dir, keep, cachedir, cachesize)
+
+    boxfile = fetch_box(box, output_dir, connections, cachedir, cachesize)
+    if extract:
+        decompress_box(boxfile, output_dir)
+        if not keep:
+            os.remove(boxfile)
+            return None
+
+    return boxfile
@@ -0,0 +1,16 @@
+#-------------------------------------------------------------------------------
+#-- Errors raised by the vagranttools library
+#
+# The library never exits, the scripts print the message of these errors
+# (one line per problem and what to do about it) and exit with status 1.
+
+class VagrantToolsError(Exception):
+    pass
+
+
+class DownloadError(VagrantToolsError):
+    pass
+
+
+class PublishError(VagrantToolsError):
+    pass
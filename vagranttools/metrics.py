@@ -0,0 +1,261 @@
+from __future__ import print_function
+
+import os, sys, json, time, threading, atexit
+from collections import OrderedDict
+from contextlib import contextmanager
+
+#-------------------------------------------------------------------------------
+#-- Per phase timing of vagrant-download and vagrant-upload
+#
+# The library wraps every phase (metadata, hashing, connect, upload, download,
+# checksum, extraction...) in phase(), which records its duration and the
+# bytes it moved while a Metrics recorder is installed and costs nothing
+# otherwise.
+
+# Metrics collecting the phases of the running tool, None when not measuring
+recorder = None
+progress_interval = 0.5
+
+#-------------------------------------------------------------------------------
+
+class Phase(object):
+    # One run of a phase, bytes are added while it runs
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.seconds = None
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, count):
+        with self.lock:
+            self.bytes = self.bytes + count
+
+
+class MeteredReader(object):
+    # File-like wrapper around (stream) adding what is read to (phase)
+
+    def __init__(self, stream, phase):
+        self.stream = stream
+        self.phase = phase
+
+    def read(self, size=-1):
+        buffer = self.stream.read(size)
+        self.phase.add(len(buffer))
+
+        return buffer
+
+    def close(self):
+        self.stream.close()
+
+
+def rate(count, seconds):
+    # MB/s
+
+    return count / max(seconds, 0.000001) / 1024 / 1024
+
+
+class Metrics(object):
+    # Phases of one run of (tool). With (progress) a line with the bytes and
+    # throughput of the running phases is refreshed on stderr.
+
+    def __init__(self, tool, progress=False):
+        self.tool = tool
+        self.started = time.time()
+        self.finished = None
+        self.status = "failed"
+        self.phases = []
+        self.active = []
+        self.lock = threading.Lock()
+        self.shown = False
+        self.stopped = threading.Event()
+        self.progress = None
+        if progress:
+            self.progress = threading.Thread(target=self.show_progress)
+            self.progress.daemon = True
+            self.progress.start()
+
+    def begin(self, name):
+        current = Phase(name)
+        with self.lock:
+            self.active.append(current)
+
+        return current
+
+    def end(self, current):
+        current.seconds = time.time() - current.start
+        with self.lock:
+            self.active.remove(current)
+            self.phases.append(current)
+
+    def record(self, name, seconds, count=0):
+        # Adds a phase measured by the caller, i.e time spread over a loop
+
+        current = Phase(name)
+        current.start = current.start - seconds
+        current.seconds = seconds
+        current.bytes = count
+        with self.lock:
+            self.phases.append(current)
+
+    def show_progress(self):
+        last = {}
+        while not self.stopped.wait(progress_interval):
+            now = time.time()
+            parts = []
+            with self.lock:
+                for current in self.active:
+                    if current.bytes:
+                        previous = last.get(current, (current.start, 0))
+                        parts.append("%s %.1f MB %.1f MB/s" % (current.name, current.bytes / 1024.0 / 1024,
+                                                               rate(current.bytes - previous[1], now - previous[0])))
+                        last[current] = (now, current.bytes)
+
+            if parts:
+                sys.stderr.write("\r[%.0fs] %s\033[K" % (now - self.started, " | ".join(parts)))
+                sys.stderr.flush()
+                self.shown = True
+
+    def clear_progress(self):
+        if self.shown:
+            sys.stderr.write("\r\033[K")
+            sys.stderr.flush()
+            self.shown = False
+
+    def summary(self):
+        # Totals of every phase name, in the order they first ran
+
+        totals = OrderedDict()
+        with self.lock:
+            for current in self.phases:
+                total = totals.setdefault(current.name, OrderedDict([("count", 0), ("seconds", 0.0), ("bytes", 0)]))
+                total["count"] = total["count"] + 1
+                total["seconds"] = total["seconds"] + current.seconds
+                total["bytes"] = total["bytes"] + current.bytes
+
+        for total in totals.values():
+            total["mb_per_s"] = round(rate(total["bytes"], total["seconds"]), 3) if total["bytes"] else None
+            total["seconds"] = round(total["seconds"], 6)
+
+        return totals
+
+    def report(self):
+        finished = self.finished or time.time()
+        with self.lock:
+            runs = [OrderedDict([("phase", current.name), ("offset", round(current.start - self.started, 6)),
+                                 ("seconds", round(current.seconds, 6)), ("bytes", current.bytes)])
+                    for current in self.phases]
+
+        return OrderedDict([("tool", self.tool), ("status", self.status), ("started", self.started),
+                            ("seconds", round(finished - self.started, 6)),
+                            ("phases", self.summary()), ("runs", runs)])
+
+    def prometheus(self):
+        # Prometheus text format, for the node_exporter textfile collector
+
+        labels = 'tool="%s"' % self.tool
+        report = self.report()
+        lines = ["# HELP vagrant_tools_run_seconds Duration of the last run.",
+                 "# TYPE vagrant_tools_run_seconds gauge",
+                 "vagrant_tools_run_seconds{%s} %s" % (labels, report["seconds"]),
+                 "# HELP vagrant_tools_run_success Whether the last run succeeded.",
+                 "# TYPE vagrant_tools_run_success gauge",
+                 "vagrant_tools_run_success{%s} %d" % (labels, self.status == "ok"),
+                 "# HELP vagrant_tools_run_timestamp_seconds Start time of the last run.",
+                 "# TYPE vagrant_tools_run_timestamp_seconds gauge",
+                 "vagrant_tools_run_timestamp_seconds{%s} %.3f" % (labels, self.started)]
+
+        for metric, field, text in (("phase_seconds", "seconds", "Time spent in each phase of the last run."),
+                                    ("phase_bytes", "bytes", "Bytes moved by each phase of the last run."),
+                                    ("phase_runs", "count", "Times each phase ran in the last run.")):
+            lines.append("# HELP vagrant_tools_%s %s" % (metric, text))
+            lines.append("# TYPE vagrant_tools_%s gauge" % metric)
+            for name, total in report["phases"].items():
+                lines.append('vagrant_tools_%s{%s,phase="%s"} %s' % (metric, labels, name, total[field]))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # JSON, or Prometheus text when (path) ends with .prom. Written to a
+        # temporary file and renamed so collectors never read a partial one.
+
+        with open(path + '.tmp', 'w') as output_file:
+            if path.endswith('.prom'):
+                output_file.write(self.prometheus())
+            else:
+                json.dump(self.report(), output_file, indent=2, separators=(',', ': '))
+                output_file.write("\n")
+
+        os.rename(path + '.tmp', path)
+
+    def finish(self):
+        if self.finished is None:
+            self.finished = time.time()
+        self.stopped.set()
+        if self.progress is not None:
+            self.progress.join()
+        self.clear_progress()
+
+#-------------------------------------------------------------------------------
+
+@contextmanager
+def phase(name):
+    # Measures the block as a run of phase (name), the Phase yielded counts
+    # its bytes
+
+    if recorder is None:
+        yield Phase(name)
+        return
+
+    current = recorder.begin(name)
+    try:
+        yield current
+    finally:
+        recorder.end(current)
+
+def record(name, seconds, count=0):
+
+    if recorder is not None:
+        recorder.record(name, seconds, count)
+
+def metered(stream, current):
+
+    if recorder is None:
+        return stream
+
+    return MeteredReader(stream, current)
+
+def clear_progress():
+    # Called before printing a message so it doesn't land on the progress line
+
+    if recorder is not None:
+        recorder.clear_progress()
+
+def start(tool, path=None, progress=None):
+    # Installs the recorder for a run of (tool). The report is written to
+    # (path) when the process exits, with status "failed" unless succeed()
+    # was called. The progress line is shown when stderr is a terminal.
+
+    global recorder
+
+    if progress is None:
+        progress = sys.stderr.isatty()
+    recorder = Metrics(tool, progress)
+
+    def finish():
+        recorder.finish()
+        if path is not None:
+            try:
+                recorder.write(path)
+            except (IOError, OSError) as e:
+                sys.stderr.write("Couldn't write metrics to %s: %s\n" % (path, e))
+
+    atexit.register(finish)
+
+    return recorder
+
+def succeed():
+
+    if recorder is not None:
+        recorder.status = "ok"
@@ -0,0 +1,274 @@
+from __future__ import print_function
+
+import os, re, json, threading
+try:
+    from urllib2 import urlopen
+    from urlparse import urlsplit
+    from urllib import pathname2url
+    from Queue import Queue, Empty
+except ImportError:
+    from urllib.request import urlopen, pathname2url
+    from urllib.parse import urlsplit
+    from queue import Queue, Empty
+from vagranttools import download
+from vagranttools.download import (get_metadata, get_box, notify, stall_timeout, default_connections,
+                                   RateLimit, string_types)
+from vagranttools.boxhash import hash_file, store_hashes, checksum_types
+from vagranttools.boxversion import VersionIndex
+from vagranttools.errors import DownloadError
+
+#-------------------------------------------------------------------------------
+#-- Local mirror of a box catalog
+#
+# Boxes are mirrored under the same <company>/<name> folders vagrant-upload
+# publishes, but unlike its flat boxes/<file> every provider file goes under
+# boxes/<version>/<provider>/, as the mirrored boxes may come from anywhere
+# and equally named files of different versions mustn't collide:
+#
+#   <directory>/<company>/<name>/metadata.json
+#   <directory>/<company>/<name>/boxes/<version>/<provider>/<file>.box
+
+default_jobs = 4
+box_name_pattern = re.compile(r'^[A-Za-z0-9_.-]+/[A-Za-z0-9_.-]+$')
+
+#-------------------------------------------------------------------------------
+
+def load_catalog(catalog):
+    # Returns the metadata URLs listed in (catalog), a file or a URL holding
+    # a JSON list, a JSON object with a "boxes" list, or one URL per line
+    # where blank lines and # comments are skipped.
+
+    try:
+        if urlsplit(catalog).scheme in ('http', 'https', 'file'):
+            content = urlopen(catalog, timeout=stall_timeout).read()
+        else:
+            with open(catalog, 'rb') as catalog_file:
+                content = catalog_file.read()
+    except (IOError, OSError) as e:
+        raise DownloadError("--->>>> Couldn't read catalog %s <<<<---\n"
+                            "Reason: %s" % (catalog, e))
+
+    content = content.decode('utf-8')
+    try:
+        entries = json.loads(content)
+    except ValueError:
+        entries = [line.strip() for line in content.splitlines()
+                   if line.strip() and not line.strip().startswith('#')]
+
+    if isinstance(entries, dict):
+        entries = entries.get('boxes')
+    if not isinstance(entries, list) or not all(isinstance(entry, string_types) for entry in entries):
+        raise DownloadError("Catalog %s isn't a list of metadata URLs" % catalog)
+
+    return entries
+
+def path_segment(value):
+    # Versions and provider names become directory names
+
+    return re.sub(r'[^A-Za-z0-9_.+-]', '_', value).lstrip('.') or '_'
+
+def artifact_path(version, provider):
+    # Path of the file of (provider) relative to the mirrored box
+
+    return '/'.join(['boxes', path_segment(version), path_segment(provider['name']),
+                     os.path.basename(urlsplit(provider['url']).path) or 'box'])
+
+def is_current(path, provider):
+    # A file is current when it has the checksum published for it. Digests
+    # are cached by boxhash so unchanged files aren't hashed again.
+
+    if not os.path.isfile(path) or os.path.exists(path + '.journal'):
+        return False
+
+    checksum_type = (provider.get('checksum_type') or '').lower()
+    if not provider.get('checksum') or checksum_type not in checksum_types:
+        return True
+
+    return hash_file(path, (checksum_type,))[checksum_type] == provider['checksum'].lower()
+
+def plan_box(url, directory, provider=None, constraints=None):
+    # Reads the metadata at (url) and returns the plan to mirror it: every
+    # selected (version, provider entry, relative path) and which of them
+    # aren't in (directory) yet.
+
+    metadata = get_metadata(url)
+    if not box_name_pattern.match(metadata.get('name') or '') or '..' in metadata['name']:
+        raise DownloadError("Metadata at %s doesn't have a company/name box name" % url)
+
+    index = VersionIndex(metadata)
+    providers = index.providers() if provider is None else [provider]
+
+    try:
+        selected = [(version, entry, artifact_path(version, entry))
+                    for name in providers for version, entry in index.matching(name, constraints)]
+    except (ValueError, KeyError) as e:
+        raise DownloadError("Invalid box version: %s" % e)
+
+    root = os.path.join(directory, *metadata['name'].split('/'))
+
+    return {'url': url, 'metadata': metadata, 'root': root, 'selected': selected,
+            'missing': [artifact for artifact in selected
+                        if not is_current(os.path.join(root, artifact[2]), artifact[1])]}
+
+def fetch_artifact(plan, artifact, connections=default_connections):
+    # Downloads a missing file of (plan) next to where it's mirrored and
+    # records its digest, so the next sync doesn't hash it again.
+
+    version, provider, relative = artifact
+    path = os.path.join(plan['root'], relative)
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+
+    checksum_type = provider.get('checksum_type') if provider.get('checksum') else None
+    boxfile = get_box(provider['url'], os.path.dirname(path), checksum_type, provider.get('checksum'),
+                      connections)
+
+    if checksum_type is not None and checksum_type.lower() in checksum_types:
+        store_hashes(boxfile, {checksum_type.lower(): provider['checksum'].lower()})
+
+    return os.path.getsize(boxfile)
+
+def mirror_metadata(plan, base_url, failed):
+    # The metadata of (plan) with the selected providers pointing at the
+    # mirror, leaving out the ones that couldn't be downloaded.
+
+    selected = dict(((version, provider['name']), relative) for version, provider, relative in plan['selected'])
+
+    versions = []
+    for entry in plan['metadata'].get('versions', []):
+        providers = []
+        for provider in entry.get('providers', []):
+            relative = selected.get((entry['version'], provider['name']))
+            if relative is not None and relative not in failed:
+                providers.append(dict(provider, url=base_url + '/' + plan['metadata']['name'] + '/' + relative))
+
+        if providers:
+            versions.append(dict(entry, providers=providers))
+
+    return dict(plan['metadata'], versions=versions)
+
+def write_metadata(path, metadata):
+    # Written to a temporary file and renamed, so Vagrant never reads a
+    # partial metadata.json from the mirror
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(path + '.tmp', 'w') as output_file:
+        json.dump(metadata, output_file, sort_keys=True, indent=2, separators=(',', ': '))
+
+    os.rename(path + '.tmp', path)
+
+def run_pool(function, items, jobs):
+    # Calls (function) for every item on at most (jobs) threads. Returns the
+    # result or the exception raised for every item, in order.
+
+    results = [None] * len(items)
+    pending = Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = pending.get_nowait()
+            except Empty:
+                return
+
+            try:
+                results[index] = function(item)
+            except Exception as e:
+                # Reported with the other failures once every item is done
+                results[index] = e
+
+    threads = []
+    for i in range(max(1, min(jobs, len(items)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+
+    return results
+
+def sync_mirror(urls, directory, base_url=None, provider=None, version=None,
+                jobs=default_jobs, connections=default_connections, rate=None):
+    # Mirrors every version and provider of the boxes whose metadata is at
+    # (urls) into (directory), only (provider) and the versions matching the
+    # (version) constraints when given. Only files whose checksum differs
+    # from the published one are downloaded, on (jobs) threads sharing a
+    # limit of (rate) bytes per second. Every box gets a metadata.json with
+    # its URLs rewritten to (base_url), the directory as a file:// URL by
+    # default. Returns a summary, or raises DownloadError listing the boxes
+    # and files that failed once the rest is mirrored.
+
+    if not os.path.isdir(directory):
+        raise DownloadError("Outputdir isn't a valid path")
+
+    if base_url is None:
+        base_url = 'file://' + pathname2url(os.path.abspath(directory))
+    base_url = base_url.rstrip('/')
+
+    previous = download.rate_limit
+    if rate is not None:
+        download.rate_limit = RateLimit(rate)
+
+    try:
+        notify("Checking %d boxes..." % len(urls))
+        plans = run_pool(lambda url: plan_box(url, directory, provider, version), list(urls), jobs)
+
+        errors = []
+        for url, plan in zip(urls, plans):
+            if isinstance(plan, Exception):
+                errors.append("%s: %s" % (url, str(plan).replace("\n", " ")))
+        plans = [plan for plan in plans if not isinstance(plan, Exception)]
+
+        tasks = [(plan, artifact) for plan in plans for artifact in plan['missing']]
+        total = sum(len(plan['selected']) for plan in plans)
+        notify("%d of %d files to download" % (len(tasks), total))
+
+        lock = threading.Lock()
+        progress = {'done': 0}
+
+        def fetch(task):
+            plan, artifact = task
+            size = fetch_artifact(plan, artifact, connections)
+            with lock:
+                progress['done'] = progress['done'] + 1
+                notify("[%d/%d] %s %s (%s) %.1f MB" % (progress['done'], len(tasks), plan['metadata']['name'],
+                                                      artifact[0], artifact[1]['name'], size / 1024.0 / 1024))
+            return size
+
+        results = run_pool(fetch, tasks, jobs)
+
+        failed = {}
+        for (plan, artifact), result in zip(tasks, results):
+            if isinstance(result, Exception):
+                failed.setdefault(plan['root'], set()).add(artifact[2])
+                errors.append("%s %s (%s): %s" % (plan['metadata']['name'], artifact[0], artifact[1]['name'],
+                                                  str(result).replace("\n", " ")))
+
+        for plan in plans:
+            write_metadata(os.path.join(plan['root'], 'metadata.json'),
+                           mirror_metadata(plan, base_url, failed.get(plan['root'], set())))
+    finally:
+        download.rate_limit = previous
+
+    sizes = [result for result in results if not isinstance(result, Exception)]
+    summary = {'boxes': len(plans), 'files': total, 'current': total - len(tasks),
+               'downloaded': len(sizes), 'bytes': sum(sizes), 'errors': errors}
+    notify("Synced %d boxes: %d files up to date, %d downloaded (%.1f MB), %d failed" %
+           (summary['boxes'], summary['current'], summary['downloaded'], summary['bytes'] / 1024.0 / 1024,
+            len(errors)))
+
+    if errors:
+        raise DownloadError("--->>>> Couldn't sync every box, run again to retry. <<<<---\n" + "\n".join(errors))
+
+    return summary
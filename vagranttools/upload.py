@@ -0,0 +1,1164 @@
+from __future__ import print_function
+
+import os, sys, time, tempfile, re, json, shutil, multiprocessing, threading, gzip, subprocess
+import errno, random, binascii, hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+try:
+    from urllib2 import URLError, HTTPError
+    from urlparse import urlsplit
+    from httplib import HTTPException
+    string_types = basestring
+    integer_types = (int, long)
+except ImportError:
+    from urllib.error import URLError, HTTPError
+    from urllib.parse import urlsplit
+    from http.client import HTTPException
+    string_types = str
+    integer_types = (int,)
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+from vagranttools.boxhash import TeeReader, hash_file, store_hashes
+from vagranttools import boxdelta
+from vagranttools.boxversion import VersionIndex, version_key
+from vagranttools.download import read_metadata
+from vagranttools.boxpack import ChunkReader, open_tar, repack_chunks
+from vagranttools.errors import VagrantToolsError, PublishError
+from vagranttools import metrics
+
+#-------------------------------------------------------------------------------
+#-- Publish settings
+
+default_settings = "config.json"
+upload_retries = 3
+# A "server" publishing to a directory of this machine, i.e a mounted webroot
+local_server = "local"
+# Attempts to swap metadata.json while other publishes keep changing it
+metadata_retries = 10
+# Seconds a metadata lock can stay unchanged before it's considered left by a
+# publish that crashed
+lock_timeout = 60
+# Files in boxes/ referenced by no version are only removed by a prune once
+# they are this old, so a box being uploaded right now isn't deleted.
+orphan_grace = 24 * 60 * 60
+output_lock = threading.Lock()
+# Progress messages are printed unless the caller turns them off
+verbose = True
+
+#-------------------------------------------------------------------------------
+#-- Fabric and paramiko are only imported once a server is contacted, they
+#-- take most of the startup time and aren't needed to publish locally.
+
+def fabric_api():
+    # Returns fabric.api, configured on first use. Fabric aborts raise
+    # PublishError and connection failures NetworkError instead of exiting.
+
+    import fabric.api
+
+    if fabric.api.env.abort_exception is not PublishError:
+        fabric.api.env.use_ssh_config = True
+        fabric.api.env.abort_exception = PublishError
+        fabric.api.env.use_exceptions_for['network'] = True
+
+    return fabric.api
+
+
+def remote_errors():
+    # The errors of a failed transfer, paramiko and Fabric ones only when
+    # they were imported as nothing else can raise them.
+
+    errors = (IOError, OSError)
+    if 'paramiko' in sys.modules:
+        errors = errors + (sys.modules['paramiko'].SSHException,)
+    if 'fabric.exceptions' in sys.modules:
+        errors = errors + (sys.modules['fabric.exceptions'].NetworkError,)
+
+    return errors
+
+
+@contextmanager
+def remote_output_hidden(servers):
+    # Hides Fabric output while talking to (servers). Fabric output settings
+    # are global, they apply to every thread.
+
+    if all(server == local_server for server in servers):
+        yield
+    else:
+        with fabric_api().hide('output','running','warnings'):
+            yield
+
+#-------------------------------------------------------------------------------
+
+class colors:
+    HEADER = '\033[95m'
+    OKBLUE = '\033[94m'
+    OKGREEN = '\033[92m'
+    WARNING = '\033[93m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+
+def display_error(message):
+    if verbose:
+        metrics.clear_progress()
+        print(colors.FAIL + colors.BOLD + colors.UNDERLINE + message + colors.ENDC)
+
+
+def display_ok(message):
+    if verbose:
+        metrics.clear_progress()
+        print(colors.OKGREEN + message + colors.ENDC)
+
+
+def boxname_parser(name):
+    result = {}
+    boxname_regex = "(?P<company>(?:^[a-zA-Z0-9\-\_\.]*))\/(?P<name>(?:[a-zA-Z0-9\-\_\.]*))"
+
+    regex = re.compile(boxname_regex)
+    if regex.match(name) is not None:
+        regex = re.match(boxname_regex, name)
+        result["company"] = regex.group('company')
+        result["name"] = regex.group('name')
+
+    return result
+
+
+def load_settings(settings="metadata.json"):
+    if os.path.isfile(settings):
+        with metrics.phase('settings'), open(settings) as defaults_file:
+            defaults = json.load(defaults_file)
+
+        return defaults
+
+
+def validate_settings(config):
+
+    if config.get("provider") is None:
+        raise PublishError("Provider not defined in metadata file, this is a required field.\n"
+                           "--->>>> Please set provider value in metadata file <<<<---")
+
+    if config.get("file") is None:
+        raise PublishError("File not defined in metadata file, this is a required field.\n"
+                           "--->>>> Please set file value in metadata file <<<<---")
+    else:
+        if os.path.isfile(config.get("file")):
+            if not config.get("file").lower().endswith('.box'):
+                raise PublishError("Box filename needs to ends with .box\n"
+                                   "--->>>> Please change box filename in metadata file <<<<---")
+        else:
+                raise PublishError("Box filename path is not a file!\n"
+                                   "--->>>> Please change box filename path in metadata file <<<<---")
+
+    if config.get("targets") is not None:
+        # Mirrors, every one with its own server and remotepath. The baseurl
+        # defaults to the one defined for the box.
+        if not isinstance(config.get("targets"), list) or not config.get("targets"):
+            raise PublishError("Targets needs to be a list of mirrors.\n"
+                               "--->>>> Please correct targets value in metadata file <<<<---")
+
+        targets = []
+        for target in config.get("targets"):
+            target = dict(target)
+            target.setdefault("baseurl", config.get("baseurl"))
+            for field in ["baseurl", "remotepath", "server"]:
+                if target.get(field) is None:
+                    raise PublishError("Target without " + field + ", this is a required field for every mirror.\n"
+                                       "--->>>> Please set " + field + " value for every target in metadata file <<<<---")
+            targets.append(target)
+
+        config["targets"] = targets
+    else:
+        if config.get("baseurl") is None:
+            raise PublishError("Base URL not defined in metadata file, this is a required field.\n"
+                               "--->>>> Please set baseurl value in metadata file <<<<---")
+
+        if config.get("remotepath") is None:
+            raise PublishError("Remote path not defined in metadata file, this is a required field.\n"
+                               "--->>>> Please set remote path value in metadata file <<<<---")
+
+        if config.get("server") is None:
+            raise PublishError("Server not defined in metadata file, this is a required field.\n"
+                               "--->>>> Please set server value in metadata file <<<<---")
+
+    if config.get("description") is None:
+        config["description"] = "No description provided."
+
+    if config.get("name") is not None:
+        parsedname = boxname_parser(config.get("name"))
+        config["company"] = parsedname.get("company")
+        config["name"] = parsedname.get("name")
+    else:
+        config["company"] = "undefined"
+        config["name"] = "undefined"
+
+    return config
+
+def get_metadata(url):
+    # Returns the metadata currently published at (url) or None if the box
+    # was never uploaded. It shares the metadata cache of vagrant-download, so
+    # the request is conditional and a 304 reuses the cached copy.
+
+    try:
+        with metrics.phase('metadata'):
+            return read_metadata(url)
+    except HTTPError as e:
+        if e.code == 404:
+            return None
+        raise PublishError("--->>>> Couldn't connect to server to get current metadata. <<<<---\n"
+                           "Server failed to fulfill request. Error code: %s" % e.code)
+    except URLError as e:
+        raise PublishError("--->>>> Couldn't connect to server to get current metadata. <<<<---\n"
+                           "Failed to connect to server. Reason: %s" % e.reason)
+    except ValueError:
+        raise PublishError("--->>>> Current metadata isn't a valid JSON file. <<<<---\n"
+                           "Please check baseurl")
+    except (IOError, HTTPException) as e:
+        # i.e the connection timed out while reading the metadata
+        raise PublishError("--->>>> Couldn't connect to server to get current metadata. <<<<---\n"
+                           "Reason: %s" % e)
+
+def generate_metadata(box, metadata=None):
+    # Adds (box) to (metadata), creating it when None. A provider for a
+    # version that already exists is added to that version's providers.
+
+    entry = {}
+    entry["name"] = box["provider"]
+    entry["url"] = box["baseurl"] + "/" + box["company"] + "/" + box["name"] + "/boxes/" + os.path.basename(box["file"])
+    entry["checksum_type"] = "sha1"
+    entry["checksum"] = box.get("checksum") or hash_file(box["file"])["sha1"]
+
+    if metadata is None:
+        metadata = {}
+        metadata["name"] = box["company"] + "/" + box["name"]
+        metadata["description"] = box["description"]
+        metadata["versions"] = []
+
+    for version in metadata["versions"]:
+        if version["version"] == box["version"]:
+            version["providers"] = version.get("providers", []) + [entry]
+            break
+    else:
+        version = {}
+        version["version"] = box["version"]
+        version["providers"] = [entry]
+
+        metadata["versions"] = metadata["versions"] + [version]
+
+    return metadata
+
+
+def already_uploaded(box, metadata):
+    # We check if the box version and provider aren't already defined in
+    # (metadata)
+
+    for version in metadata['versions']:
+        if box["version"] == version['version']:
+            for provider in version.get('providers', []):
+                if box["provider"] == provider['name']:
+                    return True
+
+    return False
+
+def sftp_makedirs(sftp, path):
+    # Creates (path) and any missing parent directory on the server
+
+    parts = path.rstrip('/').split('/')
+    for i in range(1, len(parts) + 1):
+        directory = '/'.join(parts[:i])
+        if directory == '':
+            continue
+        try:
+            sftp.stat(directory)
+        except IOError:
+            try:
+                sftp.mkdir(directory)
+            except IOError:
+                # Created meanwhile by a concurrent publish
+                sftp.stat(directory)
+
+
+def remote_directory(box):
+
+    return box["remotepath"] + "/" + box["company"] + "/" + box["name"]
+
+
+class LocalAttributes(object):
+    # The fields of a paramiko SFTPAttributes that are used
+
+    def __init__(self, stat, filename):
+        self.filename = filename
+        self.st_size = stat.st_size
+        self.st_mode = stat.st_mode
+        self.st_mtime = stat.st_mtime
+
+
+class LocalSFTP(object):
+    # Stands in for a paramiko SFTPClient when the server is "local", the
+    # remotepath is then a directory of this machine. Errors are raised as
+    # IOError like paramiko does.
+
+    def call(self, function, *args):
+        try:
+            return function(*args)
+        except OSError as e:
+            raise IOError(e.errno, e.strerror, e.filename)
+
+    def stat(self, path):
+        return self.call(os.stat, path)
+
+    def mkdir(self, path, mode=0o777):
+        self.call(os.mkdir, path, mode)
+
+    def rmdir(self, path):
+        self.call(os.rmdir, path)
+
+    def remove(self, path):
+        self.call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        self.call(os.rename, oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        self.call(os.rename, oldpath, newpath)
+
+    def open(self, path, mode='r'):
+        # paramiko files are always binary
+        return self.call(open, path, mode.replace('b', '') + 'b')
+
+    def listdir_attr(self, path='.'):
+        return [LocalAttributes(self.stat(os.path.join(path, name)), name)
+                for name in self.call(os.listdir, path)]
+
+    def putfo(self, source, path, file_size=0, callback=None):
+        transferred = 0
+        with open(path, 'wb') as output_file:
+            for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                output_file.write(chunk)
+                transferred = transferred + len(chunk)
+                if callback is not None:
+                    callback(transferred, file_size)
+
+    def put(self, localpath, path, callback=None):
+        with open(localpath, 'rb') as source:
+            self.putfo(source, path, os.path.getsize(localpath), callback)
+
+    def get(self, path, localpath):
+        shutil.copyfile(path, localpath)
+
+    def close(self):
+        pass
+
+
+class CommandResult(str):
+    # Output of a local command with the "failed" flag of Fabric results
+
+    failed = False
+
+
+def open_sftp(server):
+
+    if server == local_server:
+        return LocalSFTP()
+
+    fabric_api()
+    from fabric.state import connections
+
+    # The SSH connection is made on first use of connections[server]
+    with metrics.phase('connect'):
+        return connections[server].open_sftp()
+
+
+@contextmanager
+def sftp_session(server):
+    # SFTP session to (server), opened over the Fabric connection that
+    # remote_run also uses.
+
+    if server == local_server:
+        sftp = LocalSFTP()
+        try:
+            yield sftp
+        finally:
+            sftp.close()
+        return
+
+    api = fabric_api()
+    with api.hide('output','running','warnings'), api.settings(warn_only=True, host_string=server):
+        sftp = open_sftp(server)
+        try:
+            yield sftp
+        finally:
+            sftp.close()
+
+
+def remote_run(box, command):
+    # Runs (command) where the box is published, inside its sftp_session
+
+    if box["server"] == local_server:
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        result = CommandResult(process.communicate()[0].decode('utf-8', 'replace').strip())
+        result.failed = process.returncode != 0
+        return result
+
+    return fabric_api().run(command)
+
+
+def box_path(box):
+
+    return remote_directory(box) + "/boxes/" + os.path.basename(box["file"])
+
+
+def staging_suffix():
+    # Suffix of the temp files written next to the ones they replace, unique
+    # across concurrent publishes
+
+    return ".%d-%s.tmp" % (os.getpid(), binascii.hexlify(os.urandom(4)).decode('ascii'))
+
+
+def sftp_discard(sftp, paths):
+    # Removes the temp files in (paths) left on the server, the ones already
+    # renamed into place or never written are ignored
+
+    for path in paths:
+        try:
+            sftp.remove(path)
+        except IOError:
+            pass
+
+
+def check_repack(box):
+    # Repacking decompresses the box, fail before anything is uploaded when
+    # its format can't be decompressed
+
+    if box.get("repack"):
+        try:
+            open_tar(box["file"]).close()
+        except ValueError as e:
+            raise PublishError("Box " + box["file"] + " can't be repacked: " + str(e) + "\n"
+                               "--->>>> Please upload it without --repack <<<<---")
+
+
+def sftp_put_box(sftp, box, path):
+    # Streams the box from its original path to (path) on the server. When
+    # its SHA-1 isn't known yet it is computed in the same read pass. With
+    # "repack" the box is recompressed as block parallel gzip on the way, so
+    # the SHA-1 is always computed from the repacked stream.
+
+    sftp_makedirs(sftp, remote_directory(box) + "/boxes")
+
+    checksum = None
+    if box.get("checksum") is None or box.get("repack"):
+        checksum = hashlib.sha1()
+
+    with open(box["file"], 'rb') as box_file:
+        if box.get("repack"):
+            display_ok("Repacking box on " + str(multiprocessing.cpu_count()) + " cores...")
+            source = ChunkReader(repack_chunks(box["file"]))
+            size = 0
+        else:
+            source = box_file
+            size = os.path.getsize(box["file"])
+
+        with metrics.phase('upload') as current:
+            sftp.putfo(metrics.metered(TeeReader(source, checksum), current), path, size)
+
+    if checksum is not None:
+        box["checksum"] = checksum.hexdigest()
+        if not box.get("repack"):
+            store_hashes(box["file"], {'sha1': box["checksum"]})
+
+
+def previous_box(box, metadata):
+    # Returns the file name of the latest box published in (metadata) for
+    # the same provider, or None.
+
+    found = VersionIndex(metadata).latest(box["provider"])
+    if found is None:
+        return None
+
+    return os.path.basename(urlsplit(found[1]["url"]).path)
+
+
+def sftp_put_box_delta(sftp, box, metadata, path):
+    # Sends only the blocks of the box that aren't in the previous version on
+    # the server. The server computes the signatures of the previous box and
+    # rebuilds the new one from it into (path), checking its SHA-1. Returns
+    # False when a delta isn't possible, so the full box is uploaded instead.
+
+    base_name = previous_box(box, metadata)
+    if base_name is None:
+        return False
+
+    boxes = remote_directory(box) + "/boxes"
+    try:
+        sftp.stat(boxes + "/" + base_name)
+    except IOError:
+        return False
+
+    prefix = boxes + "/.boxdelta-%d" % os.getpid()
+    python = "$(command -v python3 || command -v python)"
+    tempfolder = tempfile.mkdtemp()
+    try:
+        sftp.put(os.path.splitext(boxdelta.__file__)[0] + ".py", prefix + ".py")
+
+        display_ok("Computing signatures of " + base_name + " on server...")
+        result = remote_run(box, " ".join([python, quote(prefix + ".py"), "signature", quote(boxes + "/" + base_name),
+                               str(boxdelta.default_block_size), quote(prefix + ".sig")]))
+        if result.failed:
+            display_error("Couldn't compute signatures on server, uploading full box...")
+            return False
+
+        sftp.get(prefix + ".sig", tempfolder + "/signatures")
+
+        display_ok("Computing delta against " + base_name + "...")
+        with metrics.phase('delta') as current, open(tempfolder + "/data", 'wb') as data_file:
+            recipe = boxdelta.write_delta(box["file"], boxdelta.read_signatures(tempfolder + "/signatures"),
+                                          data_file)
+            current.add(recipe["size"])
+        with open(tempfolder + "/recipe", 'w') as recipe_file:
+            json.dump(recipe, recipe_file)
+
+        with metrics.phase('upload') as current:
+            sftp.put(tempfolder + "/data", prefix + ".data")
+            sftp.put(tempfolder + "/recipe", prefix + ".recipe")
+            current.add(os.path.getsize(tempfolder + "/data") + os.path.getsize(tempfolder + "/recipe"))
+
+        result = remote_run(box, " ".join([python, quote(prefix + ".py"), "apply", quote(boxes + "/" + base_name),
+                               quote(prefix + ".recipe"), quote(prefix + ".data"), quote(path)]))
+        if result.failed:
+            display_error("Couldn't rebuild box on server (" + result + "), uploading full box...")
+            return False
+
+        box["checksum"] = recipe["sha1"]
+        store_hashes(box["file"], {'sha1': box["checksum"]})
+        display_ok("Delta upload sent %d of %d bytes" % (os.path.getsize(tempfolder + "/data"), recipe["size"]))
+
+        return True
+    finally:
+        for suffix in [".py", ".sig", ".data", ".recipe"]:
+            try:
+                sftp.remove(prefix + suffix)
+            except IOError:
+                pass
+        shutil.rmtree(tempfolder)
+
+
+def sftp_read_metadata(sftp, box):
+    # Returns the metadata on the server, None when there's none yet, and the
+    # SHA-1 of what was read, compared before replacing it.
+
+    try:
+        with sftp.open(remote_directory(box) + "/metadata.json") as metadata_file:
+            content = metadata_file.read()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None, None
+        raise
+
+    return json.loads(content), hashlib.sha1(content).hexdigest()
+
+
+def sftp_write_metadata(sftp, box, metadata, suffix, compact=False, precompress=False):
+    # Writes (metadata) next to metadata.json with (suffix) appended to the
+    # name, with a gzipped copy for nginx gzip_static when (precompress).
+    # Returns the names of the files written, without (suffix).
+
+    names = ["metadata.json"]
+    handle, metadata_file = tempfile.mkstemp(suffix='.json')
+    try:
+        with os.fdopen(handle, 'w') as output_file:
+            if compact:
+                json.dump(metadata, output_file, sort_keys=True, separators=(',', ':'))
+            else:
+                json.dump(metadata, output_file, sort_keys=True, indent=2, separators=(',', ': '))
+
+        sftp.put(metadata_file, remote_directory(box) + "/metadata.json" + suffix)
+
+        if precompress:
+            with open(metadata_file, 'rb') as input_file:
+                with open(metadata_file + '.gz', 'wb') as raw_file:
+                    output_file = gzip.GzipFile('metadata.json', 'wb', 9, raw_file, 0)
+                    shutil.copyfileobj(input_file, output_file)
+                    output_file.close()
+            sftp.put(metadata_file + '.gz', remote_directory(box) + "/metadata.json.gz" + suffix)
+            names.append("metadata.json.gz")
+    finally:
+        os.remove(metadata_file)
+        if os.path.exists(metadata_file + '.gz'):
+            os.remove(metadata_file + '.gz')
+
+    return names
+
+
+def sftp_replace(sftp, source, destination):
+    # Renames (source) over (destination) atomically with the OpenSSH
+    # posix-rename extension, which paramiko 1.15 doesn't wrap. Servers
+    # without it get a remove and a rename, done while holding the lock.
+
+    if hasattr(sftp, "posix_rename"):
+        sftp.posix_rename(source, destination)
+        return
+
+    from paramiko.sftp import CMD_EXTENDED, SFTPError
+
+    try:
+        sftp._request(CMD_EXTENDED, "posix-rename@openssh.com", source, destination)
+    except (IOError, SFTPError):
+        try:
+            sftp.remove(destination)
+        except IOError:
+            pass
+        sftp.rename(source, destination)
+
+
+def sftp_lock_metadata(sftp, box):
+    # Takes the metadata lock of (box), a directory as mkdir is atomic on any
+    # SFTP server. A lock that doesn't change for lock_timeout seconds while
+    # waiting was left by a crashed publish and is removed. Returns its path.
+
+    lock = remote_directory(box) + "/.metadata.lock"
+    waiting = None
+    start = time.time()
+
+    while True:
+        try:
+            sftp.mkdir(lock)
+            return lock
+        except IOError:
+            pass
+
+        try:
+            mtime = sftp.stat(lock).st_mtime
+        except IOError:
+            mtime = None
+
+        if mtime is not None and waiting is not None and waiting[0] == mtime and \
+           time.time() - waiting[1] > lock_timeout:
+            display_ok("Removing stale metadata lock " + lock + "...")
+            try:
+                sftp.rmdir(lock)
+            except IOError:
+                pass
+            waiting = None
+            continue
+
+        if waiting is None or waiting[0] != mtime:
+            waiting = (mtime, time.time())
+        if time.time() - start > 2 * lock_timeout + 10:
+            raise IOError("Couldn't take metadata lock " + lock)
+
+        time.sleep(random.uniform(0.05, 0.25))
+
+
+def sftp_update_metadata(sftp, box, update, compact=False, precompress=False, staged=()):
+    # Compare and swap of metadata.json. (update) gets the metadata read from
+    # the server, None for a new box, and returns the new one. That is written
+    # to a temp file on the server and renamed over metadata.json only if it
+    # still has the content that was read, checked under the metadata lock.
+    # Otherwise it's read again and (update) applied again, so concurrent
+    # publishes of the same box don't lose each other's versions. A
+    # metadata.json.gz already on the server is kept in sync. The (temp,
+    # path) pairs in (staged), box files uploaded under a temp name, are
+    # renamed into place in the same swap, so a publish losing the race never
+    # replaces a box the winner published. Returns the metadata written.
+
+    directory = remote_directory(box)
+    sftp_makedirs(sftp, directory)
+
+    if not precompress:
+        try:
+            sftp.stat(directory + "/metadata.json.gz")
+            precompress = True
+        except IOError:
+            pass
+
+    with metrics.phase('metadata_write'):
+        for attempt in range(1, metadata_retries + 1):
+            current, token = sftp_read_metadata(sftp, box)
+            metadata = update(current)
+
+            suffix = staging_suffix()
+            names = sftp_write_metadata(sftp, box, metadata, suffix, compact, precompress)
+            try:
+                lock = sftp_lock_metadata(sftp, box)
+                try:
+                    if sftp_read_metadata(sftp, box)[1] == token:
+                        # Boxes first, metadata.json must never point to a
+                        # missing box
+                        for temp, path in staged:
+                            sftp_replace(sftp, temp, path)
+                        for name in names:
+                            sftp_replace(sftp, directory + "/" + name + suffix, directory + "/" + name)
+                        return metadata
+                finally:
+                    sftp.rmdir(lock)
+            finally:
+                for name in names:
+                    try:
+                        sftp.remove(directory + "/" + name + suffix)
+                    except IOError:
+                        pass
+
+            display_ok("metadata.json of " + box["company"] + "/" + box["name"] + " changed on the server, merging again...")
+            time.sleep(random.uniform(0, 0.2 * attempt))
+
+    raise IOError("metadata.json kept changing on the server, gave up after %d attempts" % metadata_retries)
+
+
+class AlreadyUploaded(IOError):
+    # A concurrent publish added the same version and provider first
+    pass
+
+
+def merge_box(box, metadata):
+    # Adds (box) to the metadata read from the server, unless a concurrent
+    # publish already added the same version and provider.
+
+    if metadata is not None and already_uploaded(box, metadata):
+        raise AlreadyUploaded(box["company"] + "/" + box["name"] + " " + box["version"] + " (" + box["provider"] + ") "
+                              "was already uploaded")
+
+    return generate_metadata(box, metadata)
+
+
+def upload_box(box, metadata=None):
+    # Uploads the box and then the updated metadata.json over a single SFTP
+    # session.
+
+    staging = box_path(box) + staging_suffix()
+    try:
+        with sftp_session(box["server"]) as sftp:
+            try:
+                if not (box.get("delta") and not box.get("repack") and metadata is not None and
+                        sftp_put_box_delta(sftp, box, metadata, staging)):
+                    sftp_put_box(sftp, box, staging)
+                metadata = sftp_update_metadata(sftp, box, lambda current: merge_box(box, current),
+                                                staged=[(staging, box_path(box))])
+            finally:
+                sftp_discard(sftp, [staging])
+    except AlreadyUploaded:
+        raise PublishError("--->>>> THIS BOX VERSION WAS ALREADY UPLOADED! <<<<---\n"
+                           "Please check box version")
+    except remote_errors() as e:
+        raise PublishError("--->>>> UPLOADING BOX FAILED! <<<<---\n"
+                           "Check Internet connection or access to remote server\n"
+                           "Reason: %s" % e)
+
+    display_ok("Box " + box.get("company") + "/" + box.get("name") + " uploaded successfully!")
+
+    return metadata
+
+
+def display_target(target, message, error=False):
+    # Messages from concurrent uploads are printed whole, one per line
+
+    with output_lock:
+        if error:
+            display_error("[" + target["server"] + ":" + target["remotepath"] + "] " + message)
+        else:
+            display_ok("[" + target["server"] + ":" + target["remotepath"] + "] " + message)
+
+
+def replicate_to_target(box, target, result):
+    # Uploads (box) to a single mirror on its own connection, retrying the box
+    # upload, and only commits the mirror metadata.json once the box is there.
+    # The metadata is committed once, it's not worth sending the box again
+    # when that fails.
+
+    box = dict(box, server=target["server"], remotepath=target["remotepath"], baseurl=target["baseurl"])
+    size = os.path.getsize(box["file"])
+    progress = {"step": 0}
+
+    def callback(transferred, total):
+        step = transferred * 4 // max(total, 1)
+        if step > progress["step"]:
+            progress["step"] = step
+            display_target(target, "%d%% uploaded" % (step * 25))
+
+    start = time.time()
+    try:
+        result["reason"] = "couldn't get current metadata"
+        metadata = get_metadata(box["baseurl"] + "/" + box["company"] + "/" + box["name"])
+        if metadata is not None and already_uploaded(box, metadata):
+            result["status"] = "skipped"
+            result["reason"] = "box version was already uploaded"
+            return
+
+        result["reason"] = "couldn't connect to server"
+        staging = box_path(box) + staging_suffix()
+        for attempt in range(1, upload_retries + 1):
+            sftp = None
+            try:
+                sftp = open_sftp(target["server"])
+                sftp_makedirs(sftp, remote_directory(box) + "/boxes")
+                with metrics.phase('upload') as current, open(box["file"], 'rb') as box_file:
+                    sftp.putfo(metrics.metered(box_file, current), staging, size, callback)
+                break
+            except remote_errors() as e:
+                if sftp is not None:
+                    try:
+                        sftp_discard(sftp, [staging])
+                        sftp.close()
+                    except remote_errors():
+                        pass
+                if attempt == upload_retries:
+                    raise
+                display_target(target, "Upload failed (%s), retrying..." % e, True)
+                progress["step"] = 0
+                time.sleep(attempt * 2)
+                # Reconnect in case the transport died
+                if target["server"] != local_server:
+                    from fabric.state import connections
+                    connections.connect(target["server"])
+
+        result["reason"] = "couldn't update metadata"
+        try:
+            sftp_update_metadata(sftp, box, lambda current: merge_box(box, current),
+                                 staged=[(staging, box_path(box))])
+        except AlreadyUploaded as e:
+            result["status"] = "skipped"
+            result["reason"] = str(e)
+            display_target(target, "Skipped, %s" % e)
+            return
+        finally:
+            sftp_discard(sftp, [staging])
+            sftp.close()
+    except remote_errors() + (VagrantToolsError,) as e:
+        # get_metadata and Fabric aborts raise PublishError
+        result["status"] = "failed"
+        result["reason"] = str(e).replace("\n", " ")
+        display_target(target, "Upload failed: %s" % result["reason"], True)
+    else:
+        result["status"] = "ok"
+        result["elapsed"] = time.time() - start
+        display_target(target, "Box " + box["company"] + "/" + box["name"] + " uploaded successfully!")
+
+
+def replicate_box(box):
+    # Uploads the same box to every mirror in box["targets"] concurrently.
+    # The box is hashed once and each mirror gets its own connection,
+    # progress and retries. Returns the result of every mirror.
+
+    if box.get("repack"):
+        display_error("Repacking isn't supported with targets, uploading box as it is...")
+    if box.get("delta"):
+        display_error("Delta uploads aren't supported with targets, uploading full box...")
+
+    box["checksum"] = hash_file(box["file"])["sha1"]
+
+    results = []
+    threads = []
+    with remote_output_hidden([target["server"] for target in box["targets"]]):
+        for target in box["targets"]:
+            result = {"target": target, "status": "failed", "reason": "not started"}
+            thread = threading.Thread(target=replicate_to_target, args=(box, target, result))
+            thread.daemon = True
+            thread.start()
+            results.append(result)
+            threads.append(thread)
+
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+
+    size = os.path.getsize(box["file"])
+    display_ok("Replication summary:")
+    for result in results:
+        name = result["target"]["server"] + ":" + result["target"]["remotepath"]
+        if result["status"] == "ok":
+            elapsed = max(result["elapsed"], 0.001)
+            display_ok("  %s OK (%.1fs, %.2f MB/s)" % (name, elapsed, size / elapsed / 1024 / 1024))
+        elif result["status"] == "skipped":
+            display_ok("  %s SKIPPED (%s)" % (name, result["reason"]))
+        else:
+            display_error("  %s FAILED (%s)" % (name, result["reason"]))
+
+    return results
+
+
+def load_manifest(manifest):
+    # A manifest is a settings file with a "boxes" list. Every other key is a
+    # default for all the boxes, i.e the server, remotepath and baseurl.
+
+    manifest = load_settings(manifest)
+    if manifest is None or not isinstance(manifest.get("boxes"), list) or not manifest["boxes"]:
+        raise PublishError("Manifest doesn't define any box.\n"
+                           "--->>>> Please set a boxes list in manifest file <<<<---")
+
+    boxes = []
+    for entry in manifest["boxes"]:
+        config = dict((key, value) for key, value in manifest.items() if key != "boxes")
+        config.update(entry)
+        if config.get("targets") is not None:
+            raise PublishError("Targets aren't supported in manifests.\n"
+                               "--->>>> Please set server, remotepath and baseurl in manifest file <<<<---")
+        boxes.append(validate_settings(config))
+
+    return boxes
+
+
+def publish_batch(boxes, processes=None):
+    # Publishes many boxes, providers and versions in one run. Box files are
+    # hashed in parallel, uploaded reusing one SFTP session per server and
+    # every box metadata.json is written once after all its files are up.
+
+    groups = OrderedDict()
+    for box in boxes:
+        check_repack(box)
+        groups.setdefault(box["company"] + "/" + box["name"], []).append(box)
+
+    display_ok("Checking current metadata...")
+    metadata = {}
+    for name, group in groups.items():
+        targets = set((box["server"], box["remotepath"], box["baseurl"]) for box in group)
+        if len(targets) > 1:
+            raise PublishError("Box " + name + " is defined with different server, remotepath or baseurl.\n"
+                               "--->>>> Please use the same destination for every provider of a box <<<<---")
+
+        metadata[name] = get_metadata(group[0]["baseurl"] + "/" + name)
+
+        seen = set()
+        for box in group:
+            if (box["version"], box["provider"]) in seen or \
+               (metadata[name] is not None and already_uploaded(box, metadata[name])):
+                raise PublishError("--->>>> BOX " + name + " " + box["version"] + " (" + box["provider"] + ") WAS ALREADY UPLOADED! <<<<---\n"
+                                   "Please check box version")
+            seen.add((box["version"], box["provider"]))
+
+    # Repacked boxes are hashed while they are uploaded
+    files = sorted(set(box["file"] for box in boxes if not box.get("repack")))
+    display_ok("Hashing " + str(len(files)) + " box files...")
+    if files:
+        pool = multiprocessing.Pool(processes or min(len(files), multiprocessing.cpu_count()))
+        try:
+            # The workers don't report to the recorder, the phase counts the
+            # whole parallel pass
+            with metrics.phase('hashing') as current:
+                checksums = dict(zip(files, pool.map(hash_file, files)))
+                current.add(sum(os.path.getsize(name) for name in files))
+        finally:
+            pool.close()
+            pool.join()
+
+        for box in boxes:
+            if not box.get("repack"):
+                box["checksum"] = checksums[box["file"]]["sha1"]
+
+    servers = OrderedDict()
+    for name, group in groups.items():
+        servers.setdefault(group[0]["server"], []).append(name)
+
+    display_ok("Uploading boxes and metadata to repository...")
+    try:
+        for server, names in servers.items():
+            with sftp_session(server) as sftp:
+                staged = OrderedDict((name, []) for name in names)
+                try:
+                    for name in names:
+                        for box in groups[name]:
+                            display_ok("Uploading " + box["file"] + "...")
+                            staging = box_path(box) + staging_suffix()
+                            staged[name].append((staging, box_path(box)))
+                            if not (box.get("delta") and not box.get("repack") and metadata[name] is not None and
+                                    sftp_put_box_delta(sftp, box, metadata[name], staging)):
+                                sftp_put_box(sftp, box, staging)
+
+                    for name in names:
+                        def merge(current):
+                            for box in groups[name]:
+                                current = merge_box(box, current)
+                            return current
+
+                        metadata[name] = sftp_update_metadata(sftp, groups[name][0], merge, staged=staged[name])
+                        display_ok("Box " + name + " uploaded successfully!")
+                finally:
+                    sftp_discard(sftp, [temp for pairs in staged.values() for temp, path in pairs])
+    except AlreadyUploaded as e:
+        raise PublishError("--->>>> THIS BOX VERSION WAS ALREADY UPLOADED! <<<<---\n"
+                           "Please check box version\n"
+                           "Reason: %s" % e)
+    except remote_errors() as e:
+        raise PublishError("--->>>> UPLOADING BOX FAILED! <<<<---\n"
+                           "Check Internet connection or access to remote server\n"
+                           "Reason: %s" % e)
+
+    return metadata
+
+
+def validate_prune_settings(config, policy):
+    # Pruning only needs to know where the box is published and a retention
+    # policy, no box file.
+
+    if config.get("name") is None or not boxname_parser(config.get("name")):
+        raise PublishError("Name not defined in metadata file, this is a required field.\n"
+                           "--->>>> Please set name value in metadata file <<<<---")
+
+    for field in ["keep_last", "keep_days", "pinned", "gzip_metadata"]:
+        if policy.get(field) is None:
+            policy[field] = config.get(field)
+
+    if isinstance(policy["pinned"], string_types):
+        policy["pinned"] = [policy["pinned"]]
+
+    if policy["keep_last"] is None and policy["keep_days"] is None:
+        raise PublishError("No retention policy defined, pruning would remove every version.\n"
+                           "--->>>> Please set --keep-last and/or --keep-days <<<<---")
+
+    for field in ["keep_last", "keep_days"]:
+        value = policy[field]
+        if value is not None and (isinstance(value, bool) or not isinstance(value, integer_types) or value < 1):
+            option = "--" + field.replace("_", "-")
+            raise PublishError("Invalid retention policy, " + option + " must be a whole number of at least 1.\n"
+                               "--->>>> Please check " + option + " (" + field + " in metadata file) <<<<---")
+
+    targets = config.get("targets") or [config]
+    for target in targets:
+        for field in ["remotepath", "server"]:
+            if target.get(field) is None:
+                raise PublishError(field.capitalize() + " not defined in metadata file, this is a required field.\n"
+                                   "--->>>> Please set " + field + " value in metadata file <<<<---")
+
+    parsedname = boxname_parser(config.get("name"))
+
+    return [dict(target, company=parsedname["company"], name=parsedname["name"]) for target in targets]
+
+
+def retained_versions(metadata, policy, ages):
+    # Returns the versions of (metadata) kept by (policy): the "keep_last"
+    # newest ones, the ones published less than "keep_days" ago according to
+    # (ages), the "pinned" ones and the newest version of every provider, so
+    # no provider disappears from the box.
+
+    ordered = sorted(set(version["version"] for version in metadata["versions"]), key=version_key)
+    index = VersionIndex(metadata)
+    keep = set()
+
+    if policy.get("keep_last"):
+        keep.update(ordered[-policy["keep_last"]:])
+
+    if policy.get("keep_days") is not None:
+        cutoff = time.time() - policy["keep_days"] * 24 * 60 * 60
+        keep.update(version for version in ordered if ages.get(version, 0) >= cutoff)
+
+    pinned = set(version_key(version) for version in policy.get("pinned") or [])
+    keep.update(version for version in ordered if version_key(version) in pinned)
+
+    for provider in index.providers():
+        keep.add(index.latest(provider)[0])
+
+    return keep
+
+
+def prune_box(box, policy, dry_run=False):
+    # Removes the versions of (box) not retained by (policy) from its
+    # metadata.json, rewritten compactly, and then deletes the box files no
+    # version references anymore. The age of a version is the modification
+    # time of its box files on the server. With (dry_run) nothing is changed,
+    # only what would be removed is reported. Returns the reclaimed bytes.
+
+    directory = remote_directory(box)
+    with sftp_session(box["server"]) as sftp:
+        try:
+            files = dict((attributes.filename, attributes) for attributes in sftp.listdir_attr(directory + "/boxes"))
+        except IOError:
+            files = {}
+
+        def box_files(version):
+            return [os.path.basename(urlsplit(provider["url"]).path)
+                    for provider in version.get("providers", [])]
+
+        state = {}
+
+        def prune(metadata):
+            # Applied again if metadata.json changes before it's replaced
+            if metadata is None:
+                raise IOError("no metadata.json found in " + directory)
+
+            ages = {}
+            for version in metadata["versions"]:
+                for name in box_files(version):
+                    if name in files:
+                        ages[version["version"]] = max(ages.get(version["version"], 0), files[name].st_mtime)
+
+            keep = retained_versions(metadata, policy, ages)
+            state["metadata"] = metadata
+            state["removed"] = [version for version in metadata["versions"] if version["version"] not in keep]
+
+            return dict(metadata, versions=[version for version in metadata["versions"] if version["version"] in keep])
+
+        if dry_run:
+            pruned = prune(sftp_read_metadata(sftp, box)[0])
+        else:
+            # Clients must stop seeing a version before its files go away
+            pruned = sftp_update_metadata(sftp, box, prune, True, policy.get("gzip_metadata"))
+
+        metadata = state["metadata"]
+        removed = state["removed"]
+        referenced = set(name for version in pruned["versions"] for name in box_files(version))
+        released = set(name for version in removed for name in box_files(version))
+        garbage = sorted(name for name in files if name not in referenced and
+                         (name in released or files[name].st_mtime < time.time() - orphan_grace))
+
+        before = len(json.dumps(metadata, sort_keys=True, indent=2, separators=(',', ': ')))
+        after = len(json.dumps(pruned, sort_keys=True, separators=(',', ':')))
+        reclaimed = sum(files[name].st_size for name in garbage)
+
+        for version in removed:
+            display_ok("  Removing version " + version["version"] + " (" +
+                       ", ".join(provider["name"] for provider in version.get("providers", [])) + ")")
+        for name in garbage:
+            display_ok("  Deleting boxes/%s (%.1f MB)" % (name, files[name].st_size / 1024.0 / 1024))
+        display_ok("%s %d of %d versions, %.1f MB of box files, metadata.json %d -> %d bytes" %
+                   ("Would remove" if dry_run else "Removing", len(removed), len(metadata["versions"]),
+                    reclaimed / 1024.0 / 1024, before, after))
+
+        if not dry_run:
+            for name in garbage:
+                sftp.remove(directory + "/boxes/" + name)
+
+    return reclaimed
+
+
+#-------------------------------------------------------------------------------
+#-- Library API
+
+def publish_box(config, delta=False, repack=False):
+    # Uploads the box described by (config), with the same fields as a
+    # config.json, and adds it to the metadata.json of the box. With
+    # "targets" it's replicated to every mirror and the result of each one is
+    # returned, otherwise the metadata written.
+
+    box = validate_settings(dict(config))
+    box["delta"] = box.get("delta") or delta
+    box["repack"] = box.get("repack") or repack
+
+    if box.get("targets") is not None:
+        display_ok("Replicating box to " + str(len(box["targets"])) + " mirrors...")
+        results = replicate_box(box)
+        failed = [result for result in results if result["status"] == "failed"]
+        if failed:
+            raise PublishError("--->>>> REPLICATING BOX FAILED! <<<<---\n"
+                               "%d of %d mirrors failed" % (len(failed), len(results)))
+        return results
+
+    check_repack(box)
+
+    display_ok("Checking current metadata...")
+    metadata_url = box.get("baseurl") + "/" + box.get("company") + "/" + box.get("name")
+    current_metadata = get_metadata(metadata_url)
+    if current_metadata is None:
+        display_ok("No current metadata found, creating it...")
+        # This is first upload of box
+    else:
+        display_ok("Updating box " + box.get("company") + "/" + box.get("name") + "...")
+        # Box was uploaded before, we need to update metadata and upload new
+        # version if it's not there
+        if already_uploaded(box, current_metadata):
+            raise PublishError("--->>>> THIS BOX VERSION WAS ALREADY UPLOADED! <<<<---\n"
+                               "Please check box version")
+
+    display_ok("Uploading box and metadata to repository...")
+
+    return upload_box(box, current_metadata)